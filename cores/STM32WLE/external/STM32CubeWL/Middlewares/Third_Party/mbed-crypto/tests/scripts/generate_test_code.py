@@ -164,8 +164,13 @@ import io
 import os
 import re
 import sys
+import json
+import struct
 import string
+import binascii
+import hashlib
 import argparse
+import multiprocessing
 
 
 BEGIN_HEADER_REGEX = r'/\*\s*BEGIN_HEADER\s*\*/'
@@ -195,6 +200,21 @@ DATA_T_CHECK_REGEX = r'data_t\s*\*\s*.*'
 FUNCTION_ARG_LIST_END_REGEX = r'.*\)'
 EXIT_LABEL_REGEX = r'^exit:'
 
+# Patterns used for every line of the .data files
+DEPENDENCY_PATTERN = re.compile(DEPENDENCY_REGEX)
+CONDITION_PATTERN = re.compile(CONDITION_REGEX, re.I)
+INT_LITERAL_PATTERN = re.compile(r'(\d+|0x[0-9a-f]+)$', re.I)
+
+# Input hashes of the suites generated by batch mode, kept in the
+# output dir
+MANIFEST_FILE = '.generate_test_code.json'
+
+# Intermediate data files with this suffix are written in the binary
+# format, see gen_binary_data()
+BINARY_DATA_SUFFIX = '.datab'
+BINARY_DATA_MAGIC = b'MTDB'
+PARAMETER_ESCAPE_REGEX = r'\\([n:?])'
+
 
 class GeneratorInputError(Exception):
     """
@@ -255,6 +275,81 @@ class FileWrapper(io.FileIO, object):
     line_no = property(get_line_no)
 
 
+class IdTable(list):
+    """
+    List of the unique dependencies or expressions of a test suite, the
+    position of an entry being its identifier. Membership tests and
+    index() look the entry up in a dict instead of scanning the list,
+    so interning all entries of a suite takes linear time.
+    """
+
+    def __init__(self):
+        """
+        Create an empty table.
+        """
+        super(IdTable, self).__init__()
+        self._ids = {}
+
+    def __contains__(self, value):
+        return value in self._ids
+
+    def index(self, value, *args):
+        """
+        Gives the identifier of an entry.
+
+        :param value: Entry
+        :return: Identifier
+        """
+        # pylint: disable=unused-argument
+        try:
+            return self._ids[value]
+        except KeyError:
+            raise ValueError('%r is not in list' % (value,))
+
+    def append(self, value):
+        """
+        Add an entry. Its identifier is the next free one.
+
+        :param value: Entry
+        :return:
+        """
+        self._ids.setdefault(value, len(self))
+        super(IdTable, self).append(value)
+
+
+class DataFile(object):
+    """
+    Line iterator over a .data file for parse_test_data(). The file is
+    read and decoded in one go instead of line by line like FileWrapper
+    does, which is slow for data files with thousands of test vectors.
+    """
+
+    def __init__(self, file_name):
+        """
+        Read the file and split it into lines.
+
+        :param file_name: File path to open.
+        """
+        with open(file_name, 'rb') as data_f:
+            data = data_f.read().decode(sys.getdefaultencoding())
+        self.name = file_name
+        self._lines = data.split('\n')
+        if self._lines[-1] == '':
+            del self._lines[-1]
+
+    def __iter__(self):
+        """
+        Iterate over the lines, without line terminators.
+        """
+        return iter(self._lines)
+
+    def __len__(self):
+        """
+        Gives the number of lines.
+        """
+        return len(self._lines)
+
+
 def split_dep(dep):
     """
     Split NOT character '!' from dependency. Used by gen_dependencies()
@@ -386,7 +481,7 @@ def validate_dependency(dependency):
     :return: input dependency stripped of leading & trailing white spaces.
     """
     dependency = dependency.strip()
-    if not re.match(CONDITION_REGEX, dependency, re.I):
+    if not CONDITION_PATTERN.match(dependency):
         raise GeneratorInputError('Invalid dependency %s' % dependency)
     return dependency
 
@@ -651,6 +746,8 @@ def escaped_split(inp_str, split_char):
     """
     if len(split_char) > 1:
         raise ValueError('Expected split character. Found string!')
+    if '\\' not in inp_str:
+        return [x for x in inp_str.split(split_char) if x]
     out = re.sub(r'(\\.)|' + split_char,
                  lambda m: m.group(1) or '\n', inp_str,
                  len(inp_str)).split('\n')
@@ -668,7 +765,8 @@ def parse_test_data(data_f):
     identifiers. Mainly for optimising space for on-target
     execution.
 
-    :param data_f: file object of the data file.
+    :param data_f: file object of the data file, or any iterable of
+                   its lines with a name attribute like DataFile.
     :return: Generator that yields test name, function name,
              dependency list and function argument list.
     """
@@ -677,48 +775,52 @@ def parse_test_data(data_f):
     state = __state_read_name
     dependencies = []
     name = ''
-    for line in data_f:
+    line_no = 0
+    # Test suites repeat the same dependency lists
+    parsed_dependencies = {}
+    for line_no, line in enumerate(data_f, 1):
         line = line.strip()
-        # Skip comments
-        if line.startswith('#'):
-            continue
-
         # Blank line indicates end of test
         if not line:
             if state == __state_read_args:
                 raise GeneratorInputError("[%s:%d] Newline before arguments. "
                                           "Test function and arguments "
                                           "missing for %s" %
-                                          (data_f.name, data_f.line_no, name))
+                                          (data_f.name, line_no, name))
+            continue
+
+        # Skip comments
+        if line[0] == '#':
             continue
 
         if state == __state_read_name:
             # Read test name
             name = line
             state = __state_read_args
-        elif state == __state_read_args:
-            # Check dependencies
-            match = re.search(DEPENDENCY_REGEX, line)
-            if match:
+            continue
+
+        # Check dependencies
+        match = DEPENDENCY_PATTERN.search(line) \
+            if 'depends_on:' in line else None
+        if match:
+            dep_str = match.group('dependencies')
+            if dep_str not in parsed_dependencies:
                 try:
-                    dependencies = parse_dependencies(
-                        match.group('dependencies'))
+                    parsed_dependencies[dep_str] = parse_dependencies(dep_str)
                 except GeneratorInputError as error:
                     raise GeneratorInputError(
-                        str(error) + " - %s:%d" %
-                        (data_f.name, data_f.line_no))
-            else:
-                # Read test vectors
-                parts = escaped_split(line, ':')
-                test_function = parts[0]
-                args = parts[1:]
-                yield name, test_function, dependencies, args
-                dependencies = []
-                state = __state_read_name
+                        str(error) + " - %s:%d" % (data_f.name, line_no))
+            dependencies = list(parsed_dependencies[dep_str])
+        else:
+            # Read test vectors
+            parts = escaped_split(line, ':')
+            yield name, parts[0], dependencies, parts[1:]
+            dependencies = []
+            state = __state_read_name
     if state == __state_read_args:
         raise GeneratorInputError("[%s:%d] Newline before arguments. "
                                   "Test function and arguments missing for "
-                                  "%s" % (data_f.name, data_f.line_no, name))
+                                  "%s" % (data_f.name, line_no, name))
 
 
 def gen_dep_check(dep_id, dep):
@@ -737,7 +839,7 @@ def gen_dep_check(dep_id, dep):
     if not dep:
         raise GeneratorInputError("Dependency should not be an empty string.")
 
-    dependency = re.match(CONDITION_REGEX, dep, re.I)
+    dependency = CONDITION_PATTERN.match(dep)
     if not dependency:
         raise GeneratorInputError('Invalid dependency %s' % dep)
 
@@ -792,22 +894,23 @@ def write_dependencies(out_data_f, test_dependencies, unique_dependencies):
     :param out_data_f: Output intermediate data file
     :param test_dependencies: Dependencies
     :param unique_dependencies: Mutable list to track unique dependencies
-           that are global to this re-entrant function.
+           that are global to this re-entrant function. An IdTable
+           makes the lookups constant time.
     :return: returns dependency check code.
     """
-    dep_check_code = ''
+    dep_check_code = []
     if test_dependencies:
-        out_data_f.write('depends_on')
+        dep_ids = []
         for dep in test_dependencies:
             if dep not in unique_dependencies:
                 unique_dependencies.append(dep)
                 dep_id = unique_dependencies.index(dep)
-                dep_check_code += gen_dep_check(dep_id, dep)
+                dep_check_code.append(gen_dep_check(dep_id, dep))
             else:
                 dep_id = unique_dependencies.index(dep)
-            out_data_f.write(':' + str(dep_id))
-        out_data_f.write('\n')
-    return dep_check_code
+            dep_ids.append(str(dep_id))
+        out_data_f.write('depends_on:' + ':'.join(dep_ids) + '\n')
+    return ''.join(dep_check_code)
 
 
 def write_parameters(out_data_f, test_args, func_args, unique_expressions):
@@ -821,16 +924,17 @@ def write_parameters(out_data_f, test_args, func_args, unique_expressions):
     :param func_args: Function arguments
     :param unique_expressions: Mutable list to track unique
            expressions that are global to this re-entrant function.
+           An IdTable makes the lookups constant time.
     :return: Returns expression check code.
     """
-    expression_code = ''
+    expression_code = []
+    params = ['']
     for i, _ in enumerate(test_args):
         typ = func_args[i]
         val = test_args[i]
 
         # check if val is a non literal int val (i.e. an expression)
-        if typ == 'int' and not re.match(r'(\d+|0x[0-9a-f]+)$',
-                                         val, re.I):
+        if typ == 'int' and not INT_LITERAL_PATTERN.match(val):
             typ = 'exp'
             if val not in unique_expressions:
                 unique_expressions.append(val)
@@ -838,13 +942,14 @@ def write_parameters(out_data_f, test_args, func_args, unique_expressions):
                 # readability and consistency with case of existing
                 # let's use index().
                 exp_id = unique_expressions.index(val)
-                expression_code += gen_expression_check(exp_id, val)
+                expression_code.append(gen_expression_check(exp_id, val))
                 val = exp_id
             else:
                 val = unique_expressions.index(val)
-        out_data_f.write(':' + typ + ':' + str(val))
-    out_data_f.write('\n')
-    return expression_code
+        params.append(typ)
+        params.append(str(val))
+    out_data_f.write(':'.join(params) + '\n')
+    return ''.join(expression_code)
 
 
 def gen_suite_dep_checks(suite_dependencies, dep_check_code, expression_code):
@@ -891,17 +996,17 @@ def gen_from_test_data(data_f, out_data_f, func_info, suite_dependencies):
     :param suite_dependencies: Test suite dependencies
     :return: Returns dependency and expression check code
     """
-    unique_dependencies = []
-    unique_expressions = []
-    dep_check_code = ''
-    expression_code = ''
+    unique_dependencies = IdTable()
+    unique_expressions = IdTable()
+    dep_check_code = []
+    expression_code = []
     for test_name, function_name, test_dependencies, test_args in \
             parse_test_data(data_f):
         out_data_f.write(test_name + '\n')
 
         # Write dependencies
-        dep_check_code += write_dependencies(out_data_f, test_dependencies,
-                                             unique_dependencies)
+        dep_check_code.append(write_dependencies(
+            out_data_f, test_dependencies, unique_dependencies))
 
         # Write test function name
         test_function_name = 'test_' + function_name
@@ -916,17 +1021,148 @@ def gen_from_test_data(data_f, out_data_f, func_info, suite_dependencies):
             raise GeneratorInputError("Invalid number of arguments in test "
                                       "%s. See function %s signature." %
                                       (test_name, function_name))
-        expression_code += write_parameters(out_data_f, test_args, func_args,
-                                            unique_expressions)
+        expression_code.append(write_parameters(
+            out_data_f, test_args, func_args, unique_expressions))
 
         # Write a newline as test case separator
         out_data_f.write('\n')
 
     dep_check_code, expression_code = gen_suite_dep_checks(
-        suite_dependencies, dep_check_code, expression_code)
+        suite_dependencies, ''.join(dep_check_code), ''.join(expression_code))
     return dep_check_code, expression_code
 
 
+def unescape_parameter(param):
+    """
+    Replaces the escaped newlines, colons and question marks in a
+    parameter like parse_arguments() in host_test.function.
+
+    :param param: Parameter from the intermediate data file
+    :return: Unescaped parameter
+    """
+    if '\\' not in param:
+        return param
+    return re.sub(PARAMETER_ESCAPE_REGEX,
+                  lambda m: '\n' if m.group(1) == 'n' else m.group(1), param)
+
+
+def parse_intermediate_data(lines):
+    """
+    Parses the tests back from the text intermediate data file written
+    by gen_from_test_data().
+
+    :param lines: Lines of the intermediate data file
+    :return: Generator that yields test name, dependency identifiers,
+             function identifier and a list of parameter type and
+             unescaped value tuples.
+    """
+    lines = iter(lines)
+    for line in lines:
+        if not line:
+            continue
+        name = line
+        dep_ids = []
+        line = next(lines)
+        if line.startswith('depends_on:'):
+            dep_ids = [int(x) for x in line.split(':')[1:]]
+            line = next(lines)
+        parts = [unescape_parameter(x) for x in escaped_split(line, ':')]
+        params = list(zip(parts[1::2], parts[2::2]))
+        yield name, dep_ids, int(parts[0]), params
+
+
+def quoted_parameter(typ, val):
+    """
+    Strips the enclosing '"' of a string or hex parameter.
+
+    :param typ: Parameter type
+    :param val: Parameter value
+    :return: Value without quotes
+    """
+    if len(val) < 2 or val[0] != '"' or val[-1] != '"':
+        raise GeneratorInputError('Expected %s parameter with "": %s' %
+                                  (typ, val))
+    return val[1:-1]
+
+
+def gen_test_vector_bytes(dep_ids, function_id, params):
+    """
+    Encodes a test vector in the byte layout sent to the target by
+    MbedTlsTest.test_vector_to_bytes() in mbedtls_test.py: dependency
+    count and identifiers, function identifier and parameter count as
+    bytes, then for each parameter its type character ('I', 'E', 'S'
+    or 'H') and, 4 byte aligned, a big endian 32 bit value or length
+    followed by the string (null terminated) or hex data.
+
+    :param dep_ids: Dependency identifiers
+    :param function_id: Function identifier
+    :param params: List of parameter type and value tuples
+    :return: Test vector bytes
+    """
+    if len(dep_ids) > 255 or max(dep_ids + [function_id]) > 255 or \
+            len(params) > 255:
+        raise GeneratorInputError("Test vector does not fit the binary "
+                                  "format: more than 255 dependencies, "
+                                  "functions or parameters")
+    vector = bytearray([len(dep_ids)] + dep_ids + [function_id, len(params)])
+    for typ, val in params:
+        if typ == 'int' or typ == 'exp':
+            vector += b'I' if typ == 'int' else b'E'
+            data = b''
+            value = int(val, 16 if 'x' in val.lower() else 10)
+        elif typ == 'char*':
+            vector += b'S'
+            data = quoted_parameter(typ, val).encode(
+                sys.getdefaultencoding()) + b'\0'
+            value = len(data)
+        elif typ == 'hex':
+            vector += b'H'
+            try:
+                data = binascii.unhexlify(quoted_parameter(typ, val))
+            except (TypeError, ValueError):
+                raise GeneratorInputError('Invalid hex parameter: %s' % val)
+            value = len(data)
+        else:
+            raise GeneratorInputError('Invalid parameter type: %s' % typ)
+        vector += bytearray(-len(vector) % 4)
+        vector += struct.pack('>I', value & 0xffffffff)
+        vector += data
+    return vector
+
+
+def gen_binary_data(lines):
+    """
+    Converts the text intermediate data file to the binary format.
+    Hex parameters take half the space and the target does not parse
+    any text. All integers are big endian 32 bit:
+
+     "MTDB"
+     name count, test count
+     test names, null terminated, padded to 4 bytes
+     for each test: name identifier, vector length, vector from
+                    gen_test_vector_bytes() padded to 4 bytes
+
+    Test names are stored once, tests refer to them by identifier.
+
+    :param lines: Lines of the text intermediate data file
+    :return: Binary intermediate data
+    """
+    names = IdTable()
+    tests = []
+    for name, dep_ids, function_id, params in parse_intermediate_data(lines):
+        if name not in names:
+            names.append(name)
+        vector = gen_test_vector_bytes(dep_ids, function_id, params)
+        tests.append(struct.pack('>II', names.index(name), len(vector)) +
+                     bytes(vector) + bytes(bytearray(-len(vector) % 4)))
+    name_table = b''.join(name.encode(sys.getdefaultencoding()) + b'\0'
+                          for name in names)
+    name_table += bytes(bytearray(-len(name_table) % 4))
+    return b''.join([BINARY_DATA_MAGIC, struct.pack('>II', len(names),
+                                                    len(tests)),
+                     name_table] + tests)
+
+
 def add_input_info(funcs_file, data_file, template_file,
                    c_file, snippets):
     """
@@ -946,40 +1182,56 @@ def add_input_info(funcs_file, data_file, template_file,
     snippets['test_case_data_file'] = data_file
 
 
-def read_code_from_input_files(platform_file, helpers_file,
-                               out_data_file, snippets):
+def read_shared_inputs(template_file, platform_file, helpers_file):
     """
-    Read code from input files and create substitutions for replacement
-    strings in the template file.
+    Read the template, platform and helpers files. They are the same
+    for all test suites, hence batch generation reads them only once.
 
-    :param platform_file: Platform file object
-    :param helpers_file: Helper functions file object
+    :param template_file: Template file name
+    :param platform_file: Platform file name
+    :param helpers_file: Helper functions file name
+    :return: Dictionary with the file names and their contents.
+    """
+    with open(template_file, 'r') as template_f, \
+            open(helpers_file, 'r') as help_f, \
+            open(platform_file, 'r') as platform_f:
+        return {'template_file': template_file,
+                'template_lines': template_f.readlines(),
+                'helpers_file': helpers_file,
+                'helpers_code': help_f.read(),
+                'platform_file': platform_file,
+                'platform_code': platform_f.read()}
+
+
+def read_code_from_input_files(shared_inputs, out_data_file, snippets):
+    """
+    Create substitutions for replacement strings in the template file
+    from the code of the helpers and platform files.
+
+    :param shared_inputs: Input files read by read_shared_inputs()
     :param out_data_file: Output intermediate data file object
     :param snippets: Dictionary to contain code pieces to be
                      substituted in the template.
     :return:
     """
-    # Read helpers
-    with open(helpers_file, 'r') as help_f, open(platform_file, 'r') as \
-            platform_f:
-        snippets['test_common_helper_file'] = helpers_file
-        snippets['test_common_helpers'] = help_f.read()
-        snippets['test_platform_file'] = platform_file
-        snippets['platform_code'] = platform_f.read().replace(
-            'DATA_FILE', out_data_file.replace('\\', '\\\\'))  # escape '\'
+    snippets['test_common_helper_file'] = shared_inputs['helpers_file']
+    snippets['test_common_helpers'] = shared_inputs['helpers_code']
+    snippets['test_platform_file'] = shared_inputs['platform_file']
+    snippets['platform_code'] = shared_inputs['platform_code'].replace(
+        'DATA_FILE', out_data_file.replace('\\', '\\\\'))  # escape '\'
 
 
-def write_test_source_file(template_file, c_file, snippets):
+def write_test_source_file(template_lines, c_file, snippets):
     """
     Write output source file with generated source code.
 
-    :param template_file: Template file name
+    :param template_lines: Lines of the template file
     :param c_file: Output source file
     :param snippets: Generated and code snippets
     :return:
     """
-    with open(template_file, 'r') as template_f, open(c_file, 'w') as c_f:
-        for line_no, line in enumerate(template_f.readlines(), 1):
+    with open(c_file, 'w') as c_f:
+        for line_no, line in enumerate(template_lines, 1):
             # Update line number. +1 as #line directive sets next line number
             snippets['line_no'] = line_no + 1
             code = string.Template(line).substitute(**snippets)
@@ -1007,7 +1259,8 @@ def generate_intermediate_data_file(data_file, out_data_file,
                                     suite_dependencies, func_info, snippets):
     """
     Generates intermediate data file from input data file and
-    information read from functions file.
+    information read from functions file. It is written in the binary
+    format when its name ends with BINARY_DATA_SUFFIX.
 
     :param data_file: Data file name
     :param out_data_file: Output/Intermediate data file
@@ -1017,12 +1270,20 @@ def generate_intermediate_data_file(data_file, out_data_file,
                      substituted in the template.
     :return:
     """
-    with FileWrapper(data_file) as data_f, \
-            open(out_data_file, 'w') as out_data_f:
+    data_f = DataFile(data_file)
+    if out_data_file.endswith(BINARY_DATA_SUFFIX):
+        out_data_f = io.StringIO()
         dep_check_code, expression_code = gen_from_test_data(
             data_f, out_data_f, func_info, suite_dependencies)
-        snippets['dep_check_code'] = dep_check_code
-        snippets['expression_code'] = expression_code
+        binary_data = gen_binary_data(out_data_f.getvalue().split('\n'))
+        with open(out_data_file, 'wb') as binary_f:
+            binary_f.write(binary_data)
+    else:
+        with open(out_data_file, 'w') as out_data_f:
+            dep_check_code, expression_code = gen_from_test_data(
+                data_f, out_data_f, func_info, suite_dependencies)
+    snippets['dep_check_code'] = dep_check_code
+    snippets['expression_code'] = expression_code
 
 
 def generate_code(**input_info):
@@ -1039,6 +1300,8 @@ def generate_code(**input_info):
     suites_dir: Test suites dir
     c_file: Output C file object
     out_data_file: Output intermediate data file object
+    shared_inputs: Optional, template, platform and helpers files
+                   already read by read_shared_inputs()
     :return:
     """
     funcs_file = input_info['funcs_file']
@@ -1058,15 +1321,220 @@ def generate_code(**input_info):
         if not os.path.exists(path):
             raise IOError("ERROR: %s [%s] not found!" % (name, path))
 
+    shared_inputs = input_info.get('shared_inputs') or \
+        read_shared_inputs(template_file, platform_file, helpers_file)
     snippets = {'generator_script': os.path.basename(__file__)}
-    read_code_from_input_files(platform_file, helpers_file,
-                               out_data_file, snippets)
+    read_code_from_input_files(shared_inputs, out_data_file, snippets)
     add_input_info(funcs_file, data_file, template_file,
                    c_file, snippets)
     suite_dependencies, func_info = parse_function_file(funcs_file, snippets)
     generate_intermediate_data_file(data_file, out_data_file,
                                     suite_dependencies, func_info, snippets)
-    write_test_source_file(template_file, c_file, snippets)
+    write_test_source_file(shared_inputs['template_lines'], c_file, snippets)
+
+
+def output_files(data_file, out_dir, binary_data=False):
+    """
+    Gives the generated C file and intermediate data file names for a
+    data file.
+
+    :param data_file: Data file name
+    :param out_dir: Output dir
+    :param binary_data: Binary intermediate data file
+    :return: C file name and intermediate data file name.
+    """
+    data_name = os.path.splitext(os.path.basename(data_file))[0]
+    return (os.path.join(out_dir, data_name + '.c'),
+            os.path.join(out_dir, data_name + (BINARY_DATA_SUFFIX
+                                               if binary_data else '.datax')))
+
+
+def find_test_suites(suites_dir):
+    """
+    Lists the test suites in suites_dir. A data file
+    test_suite_<module>[.<optional sub module>].data is paired with the
+    functions file test_suite_<module>.function.
+
+    :param suites_dir: Test suites dir
+    :return: List of functions file and data file name tuples.
+    """
+    suites = []
+    for file_name in sorted(os.listdir(suites_dir)):
+        if file_name.startswith('test_suite_') and file_name.endswith('.data'):
+            funcs_file = file_name.split('.')[0] + '.function'
+            suites.append((os.path.join(suites_dir, funcs_file),
+                           os.path.join(suites_dir, file_name)))
+    return suites
+
+
+def file_digest(file_name, digests):
+    """
+    Gives the SHA-256 of a file, computing it once per file name.
+
+    :param file_name: File name
+    :param digests: Dictionary of digests already computed
+    :return: Hex digest
+    """
+    if file_name not in digests:
+        with open(file_name, 'rb') as file_f:
+            digests[file_name] = hashlib.sha256(file_f.read()).hexdigest()
+    return digests[file_name]
+
+
+def suite_digest(suite, common_files, digests):
+    """
+    Gives the hash of all inputs of a test suite: its functions and
+    data files, the files common to all suites and the output file
+    names, which are written into the generated code.
+
+    :param suite: Functions file, data file, C file and intermediate
+                  data file names
+    :param common_files: Template, platform, helpers and generator
+                         script file names
+    :param digests: Dictionary of file digests already computed
+    :return: Hex digest
+    """
+    sha = hashlib.sha256()
+    for file_name in list(common_files) + list(suite[:2]):
+        sha.update(file_digest(file_name, digests).encode())
+    sha.update('\n'.join(suite[2:]).encode())
+    return sha.hexdigest()
+
+
+def read_manifest(manifest_file):
+    """
+    Read the input hashes of the suites generated before.
+
+    :param manifest_file: Manifest file name
+    :return: Dictionary of input hashes by data file name.
+    """
+    try:
+        with open(manifest_file, 'r') as manifest_f:
+            return json.load(manifest_f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_manifest(manifest_file, manifest):
+    """
+    Write the input hashes of the generated suites.
+
+    :param manifest_file: Manifest file name
+    :param manifest: Dictionary of input hashes by data file name.
+    :return:
+    """
+    with open(manifest_file + '.tmp', 'w') as manifest_f:
+        json.dump(manifest, manifest_f, indent=1, sort_keys=True)
+    os.rename(manifest_file + '.tmp', manifest_file)
+
+
+# Input files read by the parent process, set in pool workers by
+# init_suite_worker()
+WORKER_SHARED_INPUTS = {}
+
+
+def init_suite_worker(shared_inputs):
+    """
+    Pool worker initializer. Keeps the shared input files so they are
+    sent to each worker once and not with every suite.
+
+    :param shared_inputs: Input files read by read_shared_inputs()
+    :return:
+    """
+    WORKER_SHARED_INPUTS.update(shared_inputs)
+
+
+def generate_suite(job):
+    """
+    Generate the code of one test suite in batch mode.
+
+    :param job: Tuple of suites dir, functions file, data file, C file
+                and intermediate data file names
+    :return: Data file name
+    """
+    suites_dir, funcs_file, data_file, c_file, out_data_file = job
+    shared_inputs = WORKER_SHARED_INPUTS
+    generate_code(funcs_file=funcs_file, data_file=data_file,
+                  template_file=shared_inputs['template_file'],
+                  platform_file=shared_inputs['platform_file'],
+                  helpers_file=shared_inputs['helpers_file'],
+                  suites_dir=suites_dir, c_file=c_file,
+                  out_data_file=out_data_file, shared_inputs=shared_inputs)
+    return data_file
+
+
+def generate_suites(suites_dir, template_file, platform_file, helpers_file,
+                    out_dir, jobs=None, force=False, binary_data=False):
+    """
+    Generates C source code for all test suites in suites_dir. The
+    template, platform and helpers files are read once and suites are
+    generated in a process pool. A suite is skipped when the hash of
+    its inputs matches the one stored in the manifest file in out_dir
+    and its output files exist.
+
+    :param suites_dir: Test suites dir
+    :param template_file: Template file name
+    :param platform_file: Platform file name
+    :param helpers_file: Helper functions file name
+    :param out_dir: Output dir
+    :param jobs: Number of processes, default number of CPUs
+    :param force: Regenerate all suites
+    :param binary_data: Write binary intermediate data files
+    :return: Lists of generated and up to date data file names.
+    """
+    for name, path in [('Template file', template_file),
+                       ('Platform file', platform_file),
+                       ('Helpers code file', helpers_file),
+                       ('Suites dir', suites_dir)]:
+        if not os.path.exists(path):
+            raise IOError("ERROR: %s [%s] not found!" % (name, path))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    manifest_file = os.path.join(out_dir, MANIFEST_FILE)
+    manifest = {} if force else read_manifest(manifest_file)
+    common_files = [template_file, platform_file, helpers_file,
+                    os.path.abspath(__file__).replace('.pyc', '.py')]
+    digests = {}
+    pending = []
+    up_to_date = []
+    for funcs_file, data_file in find_test_suites(suites_dir):
+        suite = (funcs_file, data_file) + output_files(data_file, out_dir,
+                                                       binary_data)
+        digest = suite_digest(suite, common_files, digests)
+        if manifest.get(data_file) == digest and \
+                all(os.path.exists(out) for out in suite[2:]):
+            up_to_date.append(data_file)
+        else:
+            manifest.pop(data_file, None)
+            pending.append(((suites_dir,) + suite, digest))
+    if not pending:
+        return [], up_to_date
+
+    shared_inputs = read_shared_inputs(template_file, platform_file,
+                                       helpers_file)
+    digest_of = dict((job[2], digest) for job, digest in pending)
+    jobs = jobs or multiprocessing.cpu_count()
+    generated = []
+    pool = None
+    try:
+        if jobs == 1 or len(pending) == 1:
+            init_suite_worker(shared_inputs)
+            results = (generate_suite(job) for job, _ in pending)
+        else:
+            pool = multiprocessing.Pool(min(jobs, len(pending)),
+                                        init_suite_worker, (shared_inputs,))
+            results = pool.imap_unordered(generate_suite,
+                                          [job for job, _ in pending])
+        for data_file in results:
+            manifest[data_file] = digest_of[data_file]
+            generated.append(data_file)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        write_manifest(manifest_file, manifest)
+    return generated, up_to_date
 
 
 def main():
@@ -1081,14 +1549,35 @@ def main():
     parser.add_argument("-f", "--functions-file",
                         dest="funcs_file",
                         help="Functions file",
-                        metavar="FUNCTIONS_FILE",
-                        required=True)
+                        metavar="FUNCTIONS_FILE")
 
     parser.add_argument("-d", "--data-file",
                         dest="data_file",
                         help="Data file",
-                        metavar="DATA_FILE",
-                        required=True)
+                        metavar="DATA_FILE")
+
+    parser.add_argument("-a", "--all-suites",
+                        dest="all_suites",
+                        help="Generate all suites in SUITES_DIR, skipping "
+                        "those whose inputs did not change",
+                        action="store_true")
+
+    parser.add_argument("-j", "--jobs",
+                        dest="jobs",
+                        help="Processes generating suites with --all-suites",
+                        metavar="JOBS",
+                        type=int)
+
+    parser.add_argument("--binary-data",
+                        dest="binary_data",
+                        help="Write the intermediate data file in the "
+                        "binary format (%s)" % BINARY_DATA_SUFFIX,
+                        action="store_true")
+
+    parser.add_argument("--force",
+                        dest="force",
+                        help="Regenerate unchanged suites with --all-suites",
+                        action="store_true")
 
     parser.add_argument("-t", "--template-file",
                         dest="template_file",
@@ -1122,11 +1611,20 @@ def main():
 
     args = parser.parse_args()
 
-    data_file_name = os.path.basename(args.data_file)
-    data_name = os.path.splitext(data_file_name)[0]
-
-    out_c_file = os.path.join(args.out_dir, data_name + '.c')
-    out_data_file = os.path.join(args.out_dir, data_name + '.datax')
+    if args.all_suites:
+        generated, up_to_date = generate_suites(
+            args.suites_dir, args.template_file, args.platform_file,
+            args.helpers_file, args.out_dir, args.jobs, args.force,
+            args.binary_data)
+        print("Generated %d test suites, %d up to date" %
+              (len(generated), len(up_to_date)))
+        return
+    if not args.funcs_file or not args.data_file:
+        parser.error("--functions-file and --data-file are required "
+                     "without --all-suites")
+
+    out_c_file, out_data_file = output_files(args.data_file, args.out_dir,
+                                             args.binary_data)
 
     out_c_file_dir = os.path.dirname(out_c_file)
     out_data_file_dir = os.path.dirname(out_data_file)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# Benchmark for the test suites code generator.
+#
+# Copyright (C) 2018, Arm Limited, All Rights Reserved
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# This file is part of Mbed TLS (https://tls.mbed.org)
+
+"""
+Times generate_test_code.py on the largest .data files in the suites
+dir: parsing the data file line by line through FileWrapper and in one
+read through DataFile, writing the intermediate data file and
+generating the whole suite.
+
+Then times writing the intermediate data file of synthetic suites of
+growing size, whose number of unique dependencies and expressions
+grows with the number of tests, to check that it scales linearly.
+"""
+
+import io
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from generate_test_code import FileWrapper, DataFile, parse_test_data
+from generate_test_code import parse_function_file, gen_from_test_data
+from generate_test_code import generate_code, find_test_suites
+
+
+def best_time(func, runs):
+    """
+    Gives the best wall clock time of a few calls.
+
+    :param func: Function to time
+    :param runs: Number of calls
+    :return: Time in seconds
+    """
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def count_tests(data_f):
+    """
+    Parse all tests of a data file.
+
+    :param data_f: Data file object
+    :return: Number of tests
+    """
+    return sum(1 for _ in parse_test_data(data_f))
+
+
+def benchmark_suite(funcs_file, data_file, args, out_dir):
+    """
+    Time the generation steps of one test suite.
+
+    :param funcs_file: Functions file name
+    :param data_file: Data file name
+    :param args: Command line arguments
+    :param out_dir: Output dir
+    :return: Number of tests and times in seconds.
+    """
+    def file_wrapper():
+        with FileWrapper(data_file) as data_f:
+            count_tests(data_f)
+
+    def intermediate_data():
+        gen_from_test_data(DataFile(data_file), io.StringIO(), func_info,
+                           suite_dependencies)
+
+    def generate():
+        data_name = os.path.splitext(os.path.basename(data_file))[0]
+        generate_code(funcs_file=funcs_file, data_file=data_file,
+                      template_file=args.template_file,
+                      platform_file=args.platform_file,
+                      helpers_file=args.helpers_file,
+                      suites_dir=args.suites_dir,
+                      c_file=os.path.join(out_dir, data_name + '.c'),
+                      out_data_file=os.path.join(out_dir,
+                                                 data_name + '.datax'))
+
+    suite_dependencies, func_info = parse_function_file(funcs_file, {})
+    tests = count_tests(DataFile(data_file))
+    return (tests,
+            best_time(file_wrapper, args.runs),
+            best_time(lambda: count_tests(DataFile(data_file)), args.runs),
+            best_time(intermediate_data, args.runs),
+            best_time(generate, args.runs))
+
+
+def synthetic_data(tests):
+    """
+    Gives a synthetic .data file. Every tenth test adds a dependency
+    and every other test an expression.
+
+    :param tests: Number of tests
+    :return: Data file contents
+    """
+    lines = []
+    for i in range(tests):
+        lines.append('Synthetic test #%d' % i)
+        lines.append('depends_on:MBEDTLS_DEP_%d:MBEDTLS_COMMON' % (i // 10))
+        lines.append('func1:"%08x":MBEDTLS_EXP_%d:%d:MBEDTLS_COMMON' %
+                     (i, i // 2, i))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def benchmark_synthetic(tests, runs, out_dir):
+    """
+    Time gen_from_test_data() on a synthetic suite.
+
+    :param tests: Number of tests
+    :param runs: Number of runs, the best one is returned
+    :param out_dir: Dir for the data file
+    :return: Time in seconds
+    """
+    data_file = os.path.join(out_dir, 'test_suite_synthetic.data')
+    with open(data_file, 'w') as data_f:
+        data_f.write(synthetic_data(tests))
+    func_info = {'test_func1': (0, ('hex', 'int', 'int', 'int'))}
+    return best_time(lambda: gen_from_test_data(DataFile(data_file),
+                                                io.StringIO(), func_info,
+                                                []), runs)
+
+
+def main():
+    """
+    Command line parser.
+
+    :return:
+    """
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    suites_dir = os.path.join(os.path.dirname(scripts_dir), 'suites')
+    parser = argparse.ArgumentParser(
+        description='Benchmark test suite code generation.')
+    parser.add_argument("-s", "--suites-dir", dest="suites_dir",
+                        help="Suites dir", metavar="SUITES_DIR",
+                        default=suites_dir)
+    parser.add_argument("-t", "--template-file", dest="template_file",
+                        help="Template file", metavar="TEMPLATE_FILE")
+    parser.add_argument("-p", "--platform-file", dest="platform_file",
+                        help="Platform code file", metavar="PLATFORM_FILE")
+    parser.add_argument("--helpers-file", dest="helpers_file",
+                        help="Helpers file", metavar="HELPERS_FILE")
+    parser.add_argument("-n", "--suites", dest="suites", type=int, default=5,
+                        help="Number of largest suites to time")
+    parser.add_argument("-r", "--runs", dest="runs", type=int, default=3,
+                        help="Runs per measurement, the best one is shown")
+    parser.add_argument("--synthetic", dest="synthetic", type=int,
+                        default=50000,
+                        help="Tests in the largest synthetic suite, "
+                        "0 to skip it")
+    args = parser.parse_args()
+    for attr, name in [('template_file', 'main_test.function'),
+                       ('platform_file', 'host_test.function'),
+                       ('helpers_file', 'helpers.function')]:
+        if getattr(args, attr) is None:
+            setattr(args, attr, os.path.join(args.suites_dir, name))
+
+    suites = sorted(find_test_suites(args.suites_dir),
+                    key=lambda suite: os.path.getsize(suite[1]),
+                    reverse=True)[:args.suites]
+    out_dir = tempfile.mkdtemp()
+    try:
+        print("%-34s %6s %8s %12s %12s %12s %12s" %
+              ('Data file', 'Tests', 'KiB', 'FileWrapper', 'DataFile',
+               '.datax', 'Generate'))
+        for funcs_file, data_file in suites:
+            times = benchmark_suite(funcs_file, data_file, args, out_dir)
+            print("%-34s %6d %8.1f %9.1f ms %9.1f ms %9.1f ms %9.1f ms" %
+                  ((os.path.basename(data_file), times[0],
+                    os.path.getsize(data_file) / 1024.0) +
+                   tuple(t * 1000 for t in times[1:])))
+        if args.synthetic:
+            print("\n%-34s %6s %12s %12s" %
+                  ('Synthetic suite', 'Tests', '.datax', 'Per test'))
+            for tests in [args.synthetic // 8, args.synthetic // 4,
+                          args.synthetic // 2, args.synthetic]:
+                elapsed = benchmark_synthetic(tests, args.runs, out_dir)
+                print("%-34s %6d %9.1f ms %9.2f us" %
+                      ('test_suite_synthetic.data', tests, elapsed * 1000,
+                       elapsed * 1e6 / tests))
+    finally:
+        shutil.rmtree(out_dir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -36,7 +36,9 @@ https://github.com/ARMmbed/greentea
 
 import re
 import os
+import struct
 import binascii
+from collections import deque
 
 from mbed_host_tests import BaseHostTest, event_callback # pylint: disable=import-error
 
@@ -99,11 +101,11 @@ class TestDataParser(object):
 
             # Check dependencies
             dependencies = []
-            line = data_f.next().strip()
+            line = next(data_f).strip()
             match = re.search('depends_on:(.*)', line)
             if match:
                 dependencies = [int(x) for x in match.group(1).split(':')]
-                line = data_f.next().strip()
+                line = next(data_f).strip()
 
             # Read test vectors
             line = line.replace('\\n', '\n')
@@ -115,7 +117,7 @@ class TestDataParser(object):
                 err_str_fmt = "Number of test arguments({}) should be even: {}"
                 raise TestDataParserError(err_str_fmt.format(args_count, line))
             grouped_args = [(args[i * 2], args[(i * 2) + 1])
-                            for i in range(len(args)/2)]
+                            for i in range(len(args) // 2)]
             self.tests.append((name, function_name, dependencies,
                                grouped_args))
 
@@ -126,6 +128,55 @@ class TestDataParser(object):
         return self.tests
 
 
+class BinaryTestDataParser(object):
+    """
+    Reads test names and test vectors from a binary intermediate data
+    file written by generate_test_code.py --binary-data. The vectors are
+    already in the form sent to the target.
+    """
+
+    MAGIC = b'MTDB'
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.tests = []
+
+    def parse(self, data_file):
+        """
+        Data file parser.
+
+        :param data_file: Data file path
+        """
+        with open(data_file, 'rb') as data_f:
+            data = data_f.read()
+        if data[:4] != self.MAGIC or len(data) < 12:
+            raise TestDataParserError("Not a binary data file: %s" %
+                                      data_file)
+        name_count, test_count = struct.unpack_from('>II', data, 4)
+        names = data[12:].split(b'\0', name_count)[:name_count]
+        offset = 12 + sum(len(name) + 1 for name in names)
+        offset += -offset % 4
+        for _ in range(test_count):
+            if offset + 8 > len(data):
+                raise TestDataParserError("Truncated data file: %s" %
+                                          data_file)
+            name_id, length = struct.unpack_from('>II', data, offset)
+            vector = bytearray(data[offset + 8:offset + 8 + length])
+            if name_id >= len(names) or len(vector) != length:
+                raise TestDataParserError("Invalid test in data file: %s" %
+                                          data_file)
+            self.tests.append((names[name_id].decode(), vector))
+            offset += 8 + length + (-length % 4)
+
+    def get_test_data(self):
+        """
+        Returns test names and vectors.
+        """
+        return self.tests
+
+
 class MbedTlsTest(BaseHostTest):
     """
     Host test for Mbed TLS unit tests. This script is loaded at
@@ -143,6 +194,16 @@ class MbedTlsTest(BaseHostTest):
     finished, target sends the result. This class handles the result
     event and prints verdict in the form that Greentea understands.
 
+    All test vectors are serialized once in setup(). By default the
+    next test is sent when the result of the previous one arrives.
+    With MBEDTLS_TEST_WINDOW=<n> in the environment up to n tests are
+    sent ahead, so the serial round trip is not paid per test. The
+    target sends the index of each test with its result, counting
+    tests in the order received. Results must arrive in the order the
+    tests were sent, else the suite fails. The target must be able
+    to buffer the tests sent ahead, e.g. with a large enough serial
+    receive buffer or flow control.
+
     """
     # status/error codes from suites/helpers.function
     DEPENDENCY_SUPPORTED = 0
@@ -161,8 +222,10 @@ class MbedTlsTest(BaseHostTest):
         """
         super(MbedTlsTest, self).__init__()
         self.tests = []
-        self.test_index = -1
-        self.dep_index = 0
+        self.vectors = []
+        self.next_index = 0
+        self.pending = deque()
+        self.window = 1
         self.suite_passed = True
         self.error_str = dict()
         self.error_str[self.DEPENDENCY_SUPPORTED] = \
@@ -180,23 +243,49 @@ class MbedTlsTest(BaseHostTest):
 
     def setup(self):
         """
-        Setup hook implementation. Reads test suite data file and parses out
-        tests.
+        Setup hook implementation. Reads test suite data file, binary
+        if present and not older than the text one, and serializes the
+        test vectors.
         """
         binary_path = self.get_config_item('image_path')
         script_dir = os.path.split(os.path.abspath(__file__))[0]
         suite_name = os.path.splitext(os.path.basename(binary_path))[0]
-        data_file = ".".join((suite_name, 'datax'))
         data_file = os.path.join(script_dir, '..', 'mbedtls',
-                                 suite_name, data_file)
-        if os.path.exists(data_file):
+                                 suite_name, suite_name)
+        window = os.environ.get('MBEDTLS_TEST_WINDOW')
+        self.window = max(1, int(window)) if window else 1
+        if os.path.exists(data_file + '.datab') and \
+                os.path.exists(data_file + '.datax') and \
+                os.path.getmtime(data_file + '.datab') < \
+                os.path.getmtime(data_file + '.datax'):
+            self.log("Ignoring %s.datab, it is older than %s.datax" %
+                     (data_file, data_file))
+            use_binary = False
+        else:
+            use_binary = os.path.exists(data_file + '.datab')
+        if use_binary:
+            data_file += '.datab'
+            self.log("Running tests from %s" % data_file)
+            parser = BinaryTestDataParser()
+            parser.parse(data_file)
+            tests = parser.get_test_data()
+            self.tests = [name for name, _ in tests]
+            self.vectors = [self.vector_with_length(vector)
+                            for _, vector in tests]
+            self.print_test_info()
+        elif os.path.exists(data_file + '.datax'):
+            data_file += '.datax'
             self.log("Running tests from %s" % data_file)
             parser = TestDataParser()
             parser.parse(data_file)
-            self.tests = parser.get_test_data()
+            tests = parser.get_test_data()
+            self.tests = [name for name, _, _, _ in tests]
+            self.vectors = [self.test_vector_to_bytes(function_id,
+                                                      dependencies, args)
+                            for _, function_id, dependencies, args in tests]
             self.print_test_info()
         else:
-            self.log("Data file not found: %s" % data_file)
+            self.log("Data file not found: %s.datax" % data_file)
             self.notify_complete(False)
 
     def print_test_info(self):
@@ -204,18 +293,9 @@ class MbedTlsTest(BaseHostTest):
         Prints test summary read by Greentea to detect test cases.
         """
         self.log('{{__testcase_count;%d}}' % len(self.tests))
-        for name, _, _, _ in self.tests:
+        for name in self.tests:
             self.log('{{__testcase_name;%s}}' % name)
 
-    @staticmethod
-    def align_32bit(data_bytes):
-        """
-        4 byte aligns input byte array.
-
-        :return:
-        """
-        data_bytes += bytearray((4 - (len(data_bytes))) % 4)
-
     @staticmethod
     def hex_str_bytes(hex_str):
         """
@@ -246,6 +326,16 @@ class MbedTlsTest(BaseHostTest):
         data_bytes = bytearray([((i >> x) & 0xff) for x in [24, 16, 8, 0]])
         return data_bytes
 
+    @classmethod
+    def vector_with_length(cls, data_bytes):
+        """
+        Gives a test vector with its length, as sent to the target.
+
+        :param data_bytes: Test vector
+        :return: Byte array and its length
+        """
+        return data_bytes, cls.int32_to_big_endian_bytes(len(data_bytes))
+
     def test_vector_to_bytes(self, function_id, dependencies, parameters):
         """
         Converts test vector into a byte array that can be sent to the target.
@@ -255,61 +345,55 @@ class MbedTlsTest(BaseHostTest):
         :param parameters: Test function input parameters
         :return: Byte array and its length
         """
-        data_bytes = bytearray([len(dependencies)])
-        if dependencies:
-            data_bytes += bytearray(dependencies)
-        data_bytes += bytearray([function_id, len(parameters)])
+        parts = [bytearray([len(dependencies)] + list(dependencies) +
+                           [function_id, len(parameters)])]
+        length = len(parts[0])
         for typ, param in parameters:
             if typ == 'int' or typ == 'exp':
-                i = int(param)
-                data_bytes += 'I' if typ == 'int' else 'E'
-                self.align_32bit(data_bytes)
-                data_bytes += self.int32_to_big_endian_bytes(i)
+                tag = b'I' if typ == 'int' else b'E'
+                data = b''
+                value = int(param, 16 if 'x' in param.lower() else 10)
             elif typ == 'char*':
-                param = param.strip('"')
-                i = len(param) + 1  # + 1 for null termination
-                data_bytes += 'S'
-                self.align_32bit(data_bytes)
-                data_bytes += self.int32_to_big_endian_bytes(i)
-                data_bytes += bytearray(list(param))
-                data_bytes += '\0'   # Null terminate
+                tag = b'S'
+                data = param.strip('"').encode() + b'\0'   # Null terminate
+                value = len(data)
             elif typ == 'hex':
-                binary_data = self.hex_str_bytes(param)
-                data_bytes += 'H'
-                self.align_32bit(data_bytes)
-                i = len(binary_data)
-                data_bytes += self.int32_to_big_endian_bytes(i)
-                data_bytes += binary_data
-        length = self.int32_to_big_endian_bytes(len(data_bytes))
-        return data_bytes, length
+                tag = b'H'
+                data = self.hex_str_bytes(param)
+                value = len(data)
+            else:
+                raise TestDataParserError("Invalid parameter type: %s" % typ)
+            # Type, then the value or length 4 byte aligned in the vector
+            padding = b'\0' * (-(length + 1) % 4)
+            parts += [tag, padding, struct.pack('>I', value & 0xffffffff),
+                      data]
+            length += 1 + len(padding) + 4 + len(data)
+        return self.vector_with_length(bytearray(b''.join(
+            bytes(part) for part in parts)))
 
     def run_next_test(self):
         """
-        Fetch next test information and execute the test.
+        Send the next tests, until window tests wait for their result.
+        Notify completion when all results are in.
 
         """
-        self.test_index += 1
-        self.dep_index = 0
-        if self.test_index < len(self.tests):
-            name, function_id, dependencies, args = self.tests[self.test_index]
-            self.run_test(name, function_id, dependencies, args)
-        else:
+        while len(self.pending) < self.window and \
+                self.next_index < len(self.vectors):
+            self.pending.append(self.next_index)
+            self.run_test(self.next_index)
+            self.next_index += 1
+        if not self.pending:
             self.notify_complete(self.suite_passed)
 
-    def run_test(self, name, function_id, dependencies, args):
+    def run_test(self, index):
         """
-        Execute the test on target by sending next test information.
+        Execute the test on target by sending its serialized vector.
 
-        :param name: Test name
-        :param function_id: function identifier
-        :param dependencies: Dependencies list
-        :param args: test parameters
+        :param index: Test index
         :return:
         """
-        self.log("Running: %s" % name)
-
-        param_bytes, length = self.test_vector_to_bytes(function_id,
-                                                        dependencies, args)
+        self.log("Running: %s" % self.tests[index])
+        param_bytes, length = self.vectors[index]
         self.send_kv(length, param_bytes)
 
     @staticmethod
@@ -326,6 +410,26 @@ class MbedTlsTest(BaseHostTest):
             ValueError("Result should return error number. "
                        "Instead received %s" % value)
 
+    def match_result(self, value):
+        """
+        Matches a result from the target to the oldest test waiting for
+        it. Fails the suite if the target reports another test index.
+
+        :param value: Test index and result code, as <index>:<code>
+        :return: Test index and integer result code, or None on a
+                 mismatch.
+        """
+        index, _, result = value.rpartition(':')
+        expected = self.pending.popleft() if self.pending else None
+        if expected is None or not index.strip().isdigit() or \
+                int(index) != expected:
+            self.log("Error: result for test %s received, expected test %s" %
+                     (index or 'without index', expected))
+            self.suite_passed = False
+            self.notify_complete(False)
+            return None
+        return expected, self.get_result(result)
+
     @event_callback('GO')
     def on_go(self, _key, _value, _timestamp):
         """
@@ -345,12 +449,15 @@ class MbedTlsTest(BaseHostTest):
         to detect test execution.
 
         :param _key: Event key
-        :param value: Value. ignored
+        :param value: Test index and result code
         :param _timestamp: Timestamp ignored.
         :return:
         """
-        int_val = self.get_result(value)
-        name, _, _, _ = self.tests[self.test_index]
+        match = self.match_result(value)
+        if match is None:
+            return
+        index, int_val = match
+        name = self.tests[index]
         self.log('{{__testcase_start;%s}}' % name)
         self.log('{{__testcase_finish;%s;%d;%d}}' % (name, int_val == 0,
                                                      int_val != 0))
@@ -365,11 +472,14 @@ class MbedTlsTest(BaseHostTest):
         Test function not supported. Hence marking test as skipped.
 
         :param _key: Event key
-        :param value: Value. ignored
+        :param value: Test index and result code
         :param _timestamp: Timestamp ignored.
         :return:
         """
-        int_val = self.get_result(value)
+        match = self.match_result(value)
+        if match is None:
+            return
+        _, int_val = match
         if int_val in self.error_str:
             err = self.error_str[int_val]
         else:
@@ -23,6 +23,9 @@ Unit tests for generate_test_code.py
 """
 
 # pylint: disable=wrong-import-order
+import os
+import shutil
+import tempfile
 try:
     # Python 2
     from StringIO import StringIO
@@ -48,7 +51,10 @@ from generate_test_code import END_SUITE_HELPERS_REGEX, escaped_split
 from generate_test_code import parse_test_data, gen_dep_check
 from generate_test_code import gen_expression_check, write_dependencies
 from generate_test_code import write_parameters, gen_suite_dep_checks
-from generate_test_code import gen_from_test_data
+from generate_test_code import gen_from_test_data, generate_suites
+from generate_test_code import MANIFEST_FILE, IdTable
+from generate_test_code import unescape_parameter, gen_test_vector_bytes
+from generate_test_code import gen_binary_data
 
 
 class GenDep(TestCase):
@@ -1426,6 +1432,44 @@ class WriteDependencies(TestCase):
                          'depends_on:0:1\ndepends_on:1:2\ndepends_on:2:0\n')
 
 
+class UniqueIds(TestCase):
+    """
+    Test suite for IdTable.
+    """
+
+    def test_ids(self):
+        """
+        Test that entries get their position as identifier.
+        :return:
+        """
+        table = IdTable()
+        for value in ['DEP3', 'DEP2', 'DEP1']:
+            table.append(value)
+        self.assertEqual(table, ['DEP3', 'DEP2', 'DEP1'])
+        self.assertIn('DEP1', table)
+        self.assertNotIn('DEP4', table)
+        self.assertEqual(table.index('DEP3'), 0)
+        self.assertEqual(table.index('DEP1'), 2)
+        self.assertRaises(ValueError, table.index, 'DEP4')
+
+    def test_write_dependencies(self):
+        """
+        Test that write_dependencies() gives the same output with an
+        IdTable as with a list.
+        :return:
+        """
+        outputs = []
+        for unique_dependencies in [[], IdTable()]:
+            stream = StringIOWrapper('test_suite_ut.data', '')
+            dep_check_code = ''
+            for deps in [['DEP3', 'DEP2'], ['DEP2', 'DEP1'], ['DEP1']]:
+                dep_check_code += write_dependencies(stream, deps,
+                                                     unique_dependencies)
+            outputs.append((dep_check_code, stream.getvalue(),
+                            list(unique_dependencies)))
+        self.assertEqual(outputs[0], outputs[1])
+
+
 class WriteParams(TestCase):
     """
     Test Suite for testing write_parameters().
@@ -1751,5 +1795,188 @@ depends_on:0:1
         self.assertEqual(expression_code, expected_expression_code)
 
 
+class GenBinaryData(TestCase):
+    """
+    Test suite for the binary intermediate data format.
+    """
+
+    def test_unescape(self):
+        """
+        Test that escapes are replaced like host_test.function does.
+        :return:
+        """
+        self.assertEqual(unescape_parameter(r'"a\:b\nc\?"'), '"a:b\nc?"')
+        self.assertEqual(unescape_parameter(r'"a\\nb\x"'), '"a\\\nb\\x"')
+        self.assertEqual(unescape_parameter('"abc"'), '"abc"')
+
+    def test_vector_bytes(self):
+        """
+        Test the test vector layout: header bytes, then type characters
+        and 4 byte aligned big endian values and lengths.
+        :return:
+        """
+        vector = gen_test_vector_bytes(
+            [1, 2], 3, [('int', '-1'), ('exp', '2'), ('char*', '"ab"'),
+                        ('hex', '"a1b2c3"'), ('int', '0x10')])
+        expected = (b'\x02\x01\x02\x03\x05'
+                    b'I\x00\x00\xff\xff\xff\xff'
+                    b'E\x00\x00\x00\x00\x00\x00\x02'
+                    b'S\x00\x00\x00\x00\x00\x00\x03ab\x00'
+                    b'H\x00\x00\x00\x03\xa1\xb2\xc3'
+                    b'I\x00\x00\x00\x10')
+        self.assertEqual(bytes(vector), expected)
+
+    def test_invalid_vector(self):
+        """
+        Test that parameters the format cannot hold are rejected.
+        :return:
+        """
+        self.assertRaises(GeneratorInputError, gen_test_vector_bytes,
+                          [256], 0, [])
+        self.assertRaises(GeneratorInputError, gen_test_vector_bytes,
+                          [], 0, [('hex', '"abc"')])
+        self.assertRaises(GeneratorInputError, gen_test_vector_bytes,
+                          [], 0, [('char*', 'abc')])
+
+    def test_binary_data(self):
+        """
+        Test that the intermediate data file is converted with test
+        names stored once and tests padded to 4 bytes.
+        :return:
+        """
+        lines = '''My test
+depends_on:0
+0:int:1
+
+My test
+1:char*:"a\\:b"
+
+'''.split('\n')
+        expected = (b'MTDB\x00\x00\x00\x01\x00\x00\x00\x02'
+                    b'My test\x00'
+                    b'\x00\x00\x00\x00\x00\x00\x00\x0c'
+                    b'\x01\x00\x00\x01I\x00\x00\x00\x00\x00\x00\x01'
+                    b'\x00\x00\x00\x00\x00\x00\x00\x0c'
+                    b'\x00\x01\x01S\x00\x00\x00\x04a:b\x00')
+        self.assertEqual(gen_binary_data(lines), expected)
+
+
+class GenerateSuites(TestCase):
+    """
+    Test suite for generate_suites()
+    """
+
+    def setUp(self):
+        """
+        Create a suites dir with two data files sharing a functions file.
+        :return:
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.suites_dir = os.path.join(self.tmp_dir, 'suites')
+        self.out_dir = os.path.join(self.tmp_dir, 'out')
+        os.makedirs(self.suites_dir)
+        files = {
+            'main_test.function': '$test_common_helpers\n$functions_code\n'
+                                  '$dep_check_code\n$expression_code\n'
+                                  '$dispatch_code\n$platform_code\n',
+            'host_test.function': 'const char *f = "DATA_FILE";\n',
+            'helpers.function': '/* helpers */\n',
+            'test_suite_ut.function': '''/* BEGIN_CASE */
+void func1( int x )
+{
+}
+/* END_CASE */
+''',
+            'test_suite_ut.a.data': 'Test a\nfunc1:1\n',
+            'test_suite_ut.b.data': 'Test b\nfunc1:MACRO\n',
+        }
+        for name, data in files.items():
+            self.write_suite_file(name, data)
+
+    def tearDown(self):
+        """
+        Remove the suites dir.
+        :return:
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def write_suite_file(self, name, data):
+        """
+        Write a file in the suites dir.
+        :return:
+        """
+        with open(os.path.join(self.suites_dir, name), 'w') as file_f:
+            file_f.write(data)
+
+    def generate(self, **kwargs):
+        """
+        Run generate_suites() on the suites dir in one process.
+        :return: Generated and up to date data file names.
+        """
+        generated, up_to_date = generate_suites(
+            self.suites_dir,
+            os.path.join(self.suites_dir, 'main_test.function'),
+            os.path.join(self.suites_dir, 'host_test.function'),
+            os.path.join(self.suites_dir, 'helpers.function'),
+            self.out_dir, jobs=1, **kwargs)
+        return ([os.path.basename(x) for x in sorted(generated)],
+                [os.path.basename(x) for x in sorted(up_to_date)])
+
+    def test_all_suites(self):
+        """
+        Test that all suites are generated on the first run.
+        :return:
+        """
+        self.assertEqual(self.generate(),
+                         (['test_suite_ut.a.data', 'test_suite_ut.b.data'], []))
+        for name in ['test_suite_ut.a.c', 'test_suite_ut.a.datax',
+                     'test_suite_ut.b.c', 'test_suite_ut.b.datax',
+                     MANIFEST_FILE]:
+            self.assertTrue(os.path.exists(os.path.join(self.out_dir, name)))
+        with open(os.path.join(self.out_dir, 'test_suite_ut.b.c')) as c_f:
+            code = c_f.read()
+        self.assertIn('*out_value = MACRO;', code)
+        self.assertIn(os.path.join(self.out_dir, 'test_suite_ut.b.datax'),
+                      code)
+
+    def test_skip_unchanged(self):
+        """
+        Test that only the suites with changed inputs are regenerated.
+        :return:
+        """
+        self.generate()
+        self.assertEqual(self.generate(),
+                         ([], ['test_suite_ut.a.data', 'test_suite_ut.b.data']))
+        self.write_suite_file('test_suite_ut.a.data', 'Test a\nfunc1:2\n')
+        self.assertEqual(self.generate(),
+                         (['test_suite_ut.a.data'], ['test_suite_ut.b.data']))
+        os.remove(os.path.join(self.out_dir, 'test_suite_ut.b.c'))
+        self.assertEqual(self.generate(),
+                         (['test_suite_ut.b.data'], ['test_suite_ut.a.data']))
+
+    def test_common_file_changed(self):
+        """
+        Test that a change in a shared input regenerates all its suites.
+        :return:
+        """
+        self.generate()
+        self.write_suite_file('helpers.function', '/* changed */\n')
+        self.assertEqual(self.generate(),
+                         (['test_suite_ut.a.data', 'test_suite_ut.b.data'], []))
+        self.assertEqual(self.generate(force=True),
+                         (['test_suite_ut.a.data', 'test_suite_ut.b.data'], []))
+
+    def test_input_error(self):
+        """
+        Test that an input error is raised and the failed suite is not
+        recorded as up to date.
+        :return:
+        """
+        self.write_suite_file('test_suite_ut.b.data', 'Test b\nfunc2:1\n')
+        self.assertRaises(GeneratorInputError, self.generate)
+        self.write_suite_file('test_suite_ut.b.data', 'Test b\nfunc1:1\n')
+        self.assertIn('test_suite_ut.b.data', self.generate()[0])
+
+
 if __name__ == '__main__':
     unittest_main()
@@ -1,6 +1,11 @@
 #!/usr/bin/python3
 
 import sys
+import os
+import io
+import json
+import time
+import zipfile
 from getopt import getopt
 from getopt import GetoptError
 import serial
@@ -8,21 +13,35 @@ from time import sleep
 import threading
 import subprocess
 
+# The in-process path shares the YMODEM engine of tools/uploader_ymodem.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "tools"))
+try:
+    import uploader_ymodem
+except ImportError:
+    uploader_ymodem = None
+
 def usage():
     print("Usage: %s -p <COM PORT>" % sys.argv[0])
     print("       %s -f <ZIP FILE>" % sys.argv[0])
     print("       %s -t <TOOL NAME>" % sys.argv[0])
     print("OPTIONS:")
     print("    --help, print information")
+    print("    --external, always flash with the external tool")
+    print("    --metrics=<FILE>, write the timings and counters of the in-process upload as JSON")
 
 def parse_arg(argv):
     global com_port
     global zip_file
     global tool_name
+    global external
+    global metrics_file
+    tool_name = None
+    external = False
+    metrics_file = None
     try:
-        opts, args = getopt(argv, "p:f:t:", ["help"])
+        opts, args = getopt(argv, "p:f:t:", ["help", "external", "metrics="])
         for opt, arg in opts:
-            if opt == '-h':
+            if opt in ('-h', '--help'):
                 usage()
                 sys.exit()
             elif opt == "-p":
@@ -31,21 +50,92 @@ def parse_arg(argv):
                 zip_file = arg
             elif opt == "-t":
                 tool_name = arg
+            elif opt == "--external":
+                external = True
+            elif opt == "--metrics":
+                metrics_file = arg
             else:
-                Usage()
+                usage()
                 sys.exit(1)
-    except getopt.GetoptError:
+    except GetoptError:
         print("Error: GetoptError!")
         usage()
         sys.exit(1)
 
+def load_image(path):
+    '''
+    Return the application image to send over YMODEM. A DFU package (.zip)
+    holds it next to a manifest.json that names it, anything else is taken
+    as the raw .bin.
+    '''
+    if not zipfile.is_zipfile(path):
+        return uploader_ymodem.FirmwareImage(path)
+    with zipfile.ZipFile(path) as package:
+        manifest = json.loads(package.read("manifest.json").decode())["manifest"]
+        entry = manifest.get("application") or next(iter(manifest.values()))
+        data = package.read(entry["bin_file"])
+    return uploader_ymodem.FirmwareImage(os.path.join(os.path.dirname(path), entry["bin_file"]), data)
+
+def upload_in_process():
+    '''
+    Flash through UploadSession: boot mode and baud rate detection, then
+    the YMODEM transfer, without spawning the external tool or sleeping a
+    fixed second for the bootloader. Returns the session, or None when the
+    image or the device is not one the YMODEM bootloader takes.
+    '''
+    try:
+        image = load_image(zip_file)
+        image.validate()
+    except (uploader_ymodem.UploadError, KeyError, ValueError, IOError, zipfile.BadZipFile) as e:
+        print("Cannot flash {} in-process: {}".format(zip_file, e))
+        return None
+    session = uploader_ymodem.UploadSession(com_port, image)
+    try:
+        session.upload()
+    except (uploader_ymodem.UploadError, serial.SerialException) as e:
+        print("In-process upload failed: {}".format(e))
+        return None
+    finally:
+        if metrics_file:
+            uploader_ymodem.write_metrics(metrics_file, dict(image=zip_file, **session.metrics.summary()))
+    timers = session.metrics.timers
+    print("Upload Complete in {:.1f} s ({:.1f} s data)".format(timers.get("total", 0.0), timers.get("data", 0.0)))
+    return session
+
+def in_boot_mode():
+    '''
+    Whether the device already runs the bootloader, e.g. after an in-process
+    upload broke off. The bootloader does not speak AT, so it must not be
+    sent atdfu.
+    '''
+    if uploader_ymodem is None:
+        return False
+    session = uploader_ymodem.UploadSession(com_port, None)
+    try:
+        return session.check_boot_mode()
+    except serial.SerialException:
+        return False
+    finally:
+        session.port_session.close()
+
 def enter_dfu_mode():
     ser = serial.Serial(com_port, 115200, timeout=5)
     ser.write(b"atdfu\r\n")
     ser.close()
     sleep(1)
 
+def upload_external():
+    if not in_boot_mode():
+        enter_dfu_mode()
+    result = subprocess.run([tool_name, 'dfu', 'usb-serial', '--package', zip_file, '-p', com_port])
+    print(result)
+    return result.returncode == 0
+
 parse_arg(sys.argv[1:])
-enter_dfu_mode()
-result = subprocess.run([tool_name, 'dfu', 'usb-serial', '--package', zip_file, '-p', com_port])
-print(result)
+if uploader_ymodem is not None and not external and upload_in_process() is not None:
+    sys.exit()
+if tool_name is None:
+    print("Upload Failed: no external tool given with -t")
+    sys.exit(1)
+if not upload_external():
+    sys.exit(1)
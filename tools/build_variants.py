@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import re
+import time
+import configparser
+import concurrent.futures
+from getopt import getopt
+from getopt import GetoptError
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from framework_cache_benchmark import pio_run
+
+def usage():
+    print("Usage: %s -d <PROJECT DIR> [-e <ENV>[,<ENV>...]] [-j <JOBS>] [--cache=<DIR>] [--clean] [--pio=<PIO COMMAND>]" % sys.argv[0])
+    print("Builds every environment (one per board variant) of a PlatformIO project in parallel.")
+    print("The first one fills the FrameworkArduino cache, the others take the core objects their")
+    print("variant does not change from it and compile only the rest.")
+    print("OPTIONS:")
+    print("    --help, print information")
+    print("    -e, environments to build, default all in platformio.ini")
+    print("    -j, compilers to run at once over all builds, default the number of cores")
+    print("    --cache, shared framework cache directory, default the one under the PlatformIO core dir")
+    print("    --clean, clean every environment first")
+
+def project_environments(project_dir):
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(os.path.join(project_dir, "platformio.ini"))
+    return [section[4:] for section in config.sections() if section.startswith("env:")]
+
+def build(pio, project_dir, environment, jobs, cache, clean):
+    '''
+    Build one environment. Returns its result: wall-clock time, whether it
+    passed, and the framework cache report line.
+    '''
+    variables = dict(RUI3_FRAMEWORK_CACHE=cache)
+    result = dict(environment=environment, ok=False, elapsed=0.0, cache=None, error=None)
+    try:
+        if clean:
+            pio_run(pio, project_dir, environment, "clean", **variables)
+        result["elapsed"], output = pio_run(pio, project_dir, environment, jobs=jobs, **variables)
+        report = re.search(r"^FrameworkArduino cache: (.*)$", output, re.M)
+        result["cache"] = report.group(1) if report else None
+        result["ok"] = True
+    except (RuntimeError, OSError) as e:
+        result["error"] = str(e)
+    return result
+
+def build_variants(pio, project_dir, environments, jobs=None, cache="yes", clean=False, out=None):
+    '''
+    Build the first environment on its own to seed the shared framework
+    cache, then the others in parallel, splitting jobs between them.
+    Prints and returns one result per environment.
+    '''
+    out = out or sys.stdout
+    jobs = jobs or os.cpu_count() or 1
+    start = time.monotonic()
+    results = [build(pio, project_dir, environments[0], jobs, cache, clean)]
+    rest = environments[1:]
+    if rest:
+        workers = min(len(rest), jobs)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results += list(executor.map(lambda environment: build(
+                pio, project_dir, environment, max(1, jobs // workers), cache, clean), rest))
+    elapsed = time.monotonic() - start
+
+    print("{:32s} {:6s} {:>9s}  {}".format("Environment", "Result", "Time", "Framework cache"), file=out)
+    for result in results:
+        print("{:32s} {:6s} {:>7.1f} s  {}".format(result["environment"], "PASS" if result["ok"] else "FAIL",
+            result["elapsed"], result["cache"] or result["error"] or "-"), file=out)
+    print("{} environments, {} failed, {:.1f} s wall-clock ({:.1f} s summed)".format(
+        len(results), sum(1 for result in results if not result["ok"]), elapsed,
+        sum(result["elapsed"] for result in results)), file=out)
+    return results
+
+def main(argv):
+    project_dir = None
+    environments = None
+    jobs = None
+    cache = "yes"
+    clean = False
+    pio = "pio"
+    try:
+        opts, args = getopt(argv, "d:e:j:", ["help", "cache=", "clean", "pio="])
+    except GetoptError:
+        usage()
+        sys.exit(1)
+    for opt, arg in opts:
+        if opt == "--help":
+            usage()
+            sys.exit()
+        elif opt == "-d":
+            project_dir = arg
+        elif opt == "-e":
+            environments = [environment for environment in arg.split(",") if environment]
+        elif opt == "-j":
+            jobs = int(arg)
+        elif opt == "--cache":
+            cache = arg
+        elif opt == "--clean":
+            clean = True
+        elif opt == "--pio":
+            pio = arg
+    if project_dir is None:
+        usage()
+        sys.exit(1)
+    environments = environments or project_environments(project_dir)
+    if not environments:
+        print("No environments in {}".format(os.path.join(project_dir, "platformio.ini")))
+        sys.exit(1)
+    results = build_variants(pio, project_dir, environments, jobs, cache, clean)
+    if not all(result["ok"] for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import re
+import time
+import tempfile
+import subprocess
+from getopt import getopt
+from getopt import GetoptError
+
+def usage():
+    print("Usage: %s -d <PROJECT DIR> [-e <ENVIRONMENT>] [-n <RUNS>] [--pio=<PIO COMMAND>]" % sys.argv[0])
+    print("Times clean builds of a PlatformIO project without the FrameworkArduino cache,")
+    print("with precompiled HAL headers, with an empty cache and with a warm one.")
+    print("OPTIONS:")
+    print("    --help, print information")
+
+def pio_run(pio, project_dir, environment, target=None, jobs=None, **variables):
+    '''
+    Run pio for project_dir with variables added to its environment, such
+    as RUI3_FRAMEWORK_CACHE, and at most jobs compilers at a time. Returns
+    the elapsed time and the output.
+    '''
+    command = [pio, "run", "-d", project_dir]
+    if environment:
+        command += ["-e", environment]
+    if target:
+        command += ["-t", target]
+    if jobs:
+        command += ["-j", str(jobs)]
+    env = dict(os.environ, **variables)
+    start = time.monotonic()
+    result = subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    elapsed = time.monotonic() - start
+    if result.returncode:
+        sys.stdout.write(result.stdout)
+        raise RuntimeError("{} failed with exit code {}".format(" ".join(command), result.returncode))
+    return elapsed, result.stdout
+
+def benchmark(pio, project_dir, environment, runs):
+    with tempfile.TemporaryDirectory() as cache:
+        modes = [("no cache", "no", "no", False), ("pch", "no", "yes", False), ("cold cache", cache, "no", True),
+            ("warm cache", cache, "no", False)]
+        print("Clean builds of {}{}:".format(project_dir, " ({})".format(environment) if environment else ""))
+        for label, location, pch, fresh in modes:
+            times = []
+            report = None
+            for _ in range(runs if not fresh else 1):
+                variables = dict(RUI3_FRAMEWORK_CACHE=location, RUI3_FRAMEWORK_PCH=pch)
+                pio_run(pio, project_dir, environment, "clean", **variables)
+                elapsed, output = pio_run(pio, project_dir, environment, **variables)
+                times.append(elapsed)
+                report = re.search(r"^FrameworkArduino cache: .*$", output, re.M)
+            print("    {:10s} {:8.1f} s (best of {}) {}".format(label, min(times), len(times), report.group(0) if report else ""))
+
+def main(argv):
+    project_dir = None
+    environment = None
+    runs = 1
+    pio = "pio"
+    try:
+        opts, args = getopt(argv, "d:e:n:", ["help", "pio="])
+    except GetoptError:
+        usage()
+        sys.exit(1)
+    for opt, arg in opts:
+        if opt == "--help":
+            usage()
+            sys.exit()
+        elif opt == "-d":
+            project_dir = arg
+        elif opt == "-e":
+            environment = arg
+        elif opt == "-n":
+            runs = int(arg)
+        elif opt == "--pio":
+            pio = arg
+    if project_dir is None:
+        usage()
+        sys.exit(1)
+    benchmark(pio, project_dir, environment, runs)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
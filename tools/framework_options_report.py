@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import re
+from getopt import getopt
+from getopt import GetoptError
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from framework_cache_benchmark import pio_run
+
+regions = ["AS923", "AU915", "EU868", "KR920", "IN865", "US915", "RU864", "LA915"]
+features = ["lorawan", "p2p", "fatfs"]
+
+def usage():
+    print("Usage: %s -d <PROJECT DIR> -e <ENVIRONMENT> [--pio=<PIO COMMAND>]" % sys.argv[0])
+    print("Builds a PlatformIO project with every framework region and feature, then with each")
+    print("one left out, and reports the framework objects and firmware size each one costs.")
+    print("OPTIONS:")
+    print("    --help, print information")
+
+def build(pio, project_dir, environment, **variables):
+    '''
+    Clean build with variables set. Returns the build time, the number of
+    FrameworkArduino objects and the flash and RAM use pio reports.
+    '''
+    pio_run(pio, project_dir, environment, "clean", RUI3_FRAMEWORK_CACHE="no", **variables)
+    elapsed, output = pio_run(pio, project_dir, environment, RUI3_FRAMEWORK_CACHE="no", **variables)
+    objects = 0
+    for root, _, files in os.walk(os.path.join(project_dir, ".pio", "build", environment, "FrameworkArduino")):
+        objects += sum(1 for name in files if name.endswith(".o"))
+    used = dict(re.findall(r"^(RAM|Flash):.*\(used (\d+) bytes", output, re.M))
+    return elapsed, objects, int(used.get("Flash", 0)), int(used.get("RAM", 0))
+
+def report(pio, project_dir, environment):
+    print("Framework options of {} ({}):".format(project_dir, environment))
+    print("    {:16s} {:>8s} {:>8s} {:>10s} {:>8s}".format("left out", "time", "objects", "flash", "RAM"))
+    full = build(pio, project_dir, environment)
+    print("    {:16s} {:6.1f} s {:8d} {:10d} {:8d}".format("nothing", *full))
+    builds = [("region " + region, dict(RUI3_LORA_REGIONS=",".join(r for r in regions if r != region)))
+        for region in regions]
+    builds += [("feature " + feature, dict(RUI3_FRAMEWORK_FEATURES=",".join(f for f in features if f != feature)))
+        for feature in features]
+    for label, variables in builds:
+        elapsed, objects, flash, ram = build(pio, project_dir, environment, **variables)
+        print("    {:16s} {:6.1f} s {:8d} {:10d} {:8d}   saves {} objects, {} bytes flash, {} bytes RAM".format(
+            label, elapsed, objects, flash, ram, full[1] - objects, full[2] - flash, full[3] - ram))
+
+def main(argv):
+    project_dir = None
+    environment = None
+    pio = "pio"
+    try:
+        opts, args = getopt(argv, "d:e:", ["help", "pio="])
+    except GetoptError:
+        usage()
+        sys.exit(1)
+    for opt, arg in opts:
+        if opt == "--help":
+            usage()
+            sys.exit()
+        elif opt == "-d":
+            project_dir = arg
+        elif opt == "-e":
+            environment = arg
+        elif opt == "--pio":
+            pio = arg
+    if project_dir is None or environment is None:
+        usage()
+        sys.exit(1)
+    report(pio, project_dir, environment)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
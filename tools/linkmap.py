@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import re
+import json
+import time
+import collections
+from getopt import getopt
+from getopt import GetoptError
+
+# Output sections that take RAM but nothing in flash, even with a load address
+noload_section = re.compile(r"^\.(bss|noinit)|heap|stack", re.I)
+
+region_line = re.compile(r"^(\S+)\s+0x([0-9a-fA-F]+)\s+0x([0-9a-fA-F]+)\s*(\S*)")
+output_line = re.compile(r"^(\S+)?\s+0x([0-9a-fA-F]+)\s+0x([0-9a-fA-F]+)(?:\s+load address 0x([0-9a-fA-F]+))?\s*$")
+input_line = re.compile(r"^ (\S+)?\s+0x([0-9a-fA-F]+)\s+0x([0-9a-fA-F]+)\s+(\S.*?)\s*$")
+fill_line = re.compile(r"^ \*fill\*\s+0x([0-9a-fA-F]+)\s+0x([0-9a-fA-F]+)")
+symbol_line = re.compile(r"^\s{16,}0x([0-9a-fA-F]+)\s+(\S+)\s*$")
+member = re.compile(r"^(.*?)\((.*)\)$")
+
+def split_input(path):
+    # "dir/libfoo.a(bar.o)" is object bar.o of library libfoo.a
+    match = member.match(path)
+    if match:
+        return os.path.basename(match.group(1)), match.group(2)
+    return "", os.path.basename(path)
+
+class LinkMap(object):
+    '''
+    Flash and RAM use of a GNU ld map file, attributed to every symbol,
+    object and library. The map is read line by line and only the totals
+    are kept, so large maps parse in one pass with little memory.
+
+    A section counts to flash when its load address is in a read-only
+    memory region and to RAM when its address is in a writable one, so
+    .data counts to both and .bss only to RAM.
+    '''
+    def __init__(self):
+        self.regions = collections.OrderedDict()
+        self.flash = 0
+        self.ram = 0
+        self.libraries = {}
+        self.objects = {}
+        self.symbols = {}
+        self._input = None
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Parse a .map file, or load a summary saved with save().
+        '''
+        link_map = cls()
+        if path.endswith(".json"):
+            with open(path) as f:
+                link_map._from_summary(json.load(f))
+        else:
+            with open(path, errors="replace") as f:
+                link_map.parse(f)
+        return link_map
+
+    def _region(self, address):
+        for name, region in self.regions.items():
+            if region["origin"] <= address < region["origin"] + region["length"]:
+                return name, region
+        return None, None
+
+    def parse(self, lines):
+        state = None
+        pending = None
+        output = None
+        flash = ram = False
+        for line in lines:
+            if state != "map":
+                if line.startswith("Memory Configuration"):
+                    state = "regions"
+                elif line.startswith("Linker script and memory map"):
+                    state = "map"
+                elif state == "regions":
+                    match = region_line.match(line)
+                    if match and match.group(1) != "*default*" and match.group(1) != "Name":
+                        self.regions[match.group(1)] = dict(origin=int(match.group(2), 16),
+                            length=int(match.group(3), 16), writable="w" in match.group(4), used=0)
+                continue
+
+            if line[:1] not in (" ", "\n", ""):
+                # Output section, its name may stand alone with the numbers on the next line
+                match = output_line.match(line)
+                if match is None:
+                    pending = ("output", line.split()[0]) if len(line.split()) == 1 else None
+                    continue
+                pending = None
+                self._end_input()
+                output = match.group(1)
+                flash, ram = self._output(match.group(1), int(match.group(2), 16), int(match.group(3), 16),
+                    int(match.group(4), 16) if match.group(4) else None)
+                continue
+            if pending is not None and pending[0] == "output":
+                match = output_line.match(line)
+                pending_name, pending = pending[1], None
+                if match is not None and match.group(1) is None:
+                    self._end_input()
+                    output = pending_name
+                    flash, ram = self._output(pending_name, int(match.group(2), 16), int(match.group(3), 16),
+                        int(match.group(4), 16) if match.group(4) else None)
+                    continue
+            if not (flash or ram):
+                continue
+
+            match = symbol_line.match(line)
+            if match is not None:
+                if self._input is not None:
+                    self._input["symbols"].append((int(match.group(1), 16), match.group(2)))
+                continue
+            match = input_line.match(line)
+            if match is not None:
+                name = match.group(1)
+                if name is None:
+                    if pending is None or pending[0] != "input":
+                        continue
+                    name = pending[1]
+                pending = None
+                self._end_input()
+                size = int(match.group(3), 16)
+                if size:
+                    library, obj = split_input(match.group(4))
+                    self._input = dict(name=name, address=int(match.group(2), 16), size=size, library=library,
+                        object=obj, flash=flash, ram=ram, symbols=[])
+                continue
+            match = fill_line.match(line)
+            if match is not None:
+                pending = None
+                self._end_input()
+                # Padding, and the heap and stack reserved by moving the location counter
+                self._add(int(match.group(2), 16), flash, ram, "(fill)", "*fill* " + output, None)
+                continue
+            fields = line.split()
+            if len(fields) == 1 and line.startswith(" ") and not line.startswith("  ") and not fields[0].startswith("*"):
+                pending = ("input", fields[0])
+        self._end_input()
+
+    def _output(self, name, address, size, load):
+        '''
+        Start an output section. Returns whether its input sections count
+        to flash and to RAM.
+        '''
+        region_name, region = self._region(address)
+        if region is None:
+            return False, False
+        ram = region["writable"]
+        flash = not ram
+        if ram and load is not None and not noload_section.search(name):
+            load_name, load_region = self._region(load)
+            if load_region is not None and not load_region["writable"]:
+                flash = True
+                load_region["used"] += size
+        region["used"] += size
+        if flash:
+            self.flash += size
+        if ram:
+            self.ram += size
+        return flash, ram
+
+    def _end_input(self):
+        section, self._input = self._input, None
+        if section is None:
+            return
+        end = section["address"] + section["size"]
+        symbols = sorted(symbol for symbol in section["symbols"] if section["address"] <= symbol[0] < end)
+        if not symbols or symbols[0][0] > section["address"]:
+            # Bytes before the first symbol, e.g. a static function in .text.name
+            name = section["name"].split(".", 2)[2] if section["name"].count(".") > 1 else section["name"]
+            symbols.insert(0, (section["address"], name))
+        for i, (address, name) in enumerate(symbols):
+            following = symbols[i + 1][0] if i + 1 < len(symbols) else end
+            # Aliases share an address, the size goes to the last one
+            self._add(following - address, section["flash"], section["ram"], section["library"], section["object"], name)
+
+    def _add(self, size, flash, ram, library, obj, symbol):
+        if not size:
+            return
+        usage = (size if flash else 0, size if ram else 0)
+        keys = [(self.libraries, library or "(objects)"), (self.objects, obj)]
+        if symbol is not None:
+            keys.append((self.symbols, "{} [{}]".format(symbol, obj)))
+        for table, key in keys:
+            entry = table.setdefault(key, [0, 0])
+            entry[0] += usage[0]
+            entry[1] += usage[1]
+
+    def summary(self):
+        return dict(flash=self.flash, ram=self.ram, regions=dict((name, [region["used"], region["length"]])
+            for name, region in self.regions.items()), libraries=self.libraries, objects=self.objects,
+            symbols=self.symbols)
+
+    def _from_summary(self, summary):
+        self.flash = summary["flash"]
+        self.ram = summary["ram"]
+        for name, (used, length) in summary["regions"].items():
+            self.regions[name] = dict(origin=0, length=length, writable=False, used=used)
+        self.libraries = summary["libraries"]
+        self.objects = summary["objects"]
+        self.symbols = summary["symbols"]
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, sort_keys=True)
+
+def top(table, count, index):
+    entries = sorted(table.items(), key=lambda item: (-item[1][index], item[0]))
+    return [(name, usage) for name, usage in entries[:count] if usage[index]]
+
+def report(link_map, count=10, out=None):
+    out = out or sys.stdout
+    print("Flash {} bytes, RAM {} bytes".format(link_map.flash, link_map.ram), file=out)
+    for name, region in link_map.regions.items():
+        if region["used"]:
+            print("    {:12s} {:8d} of {:8d} bytes ({:5.1f}%)".format(
+                name, region["used"], region["length"], 100.0 * region["used"] / region["length"]), file=out)
+    for title, table in (("libraries", link_map.libraries), ("objects", link_map.objects), ("symbols", link_map.symbols)):
+        for index, kind in ((0, "flash"), (1, "RAM")):
+            entries = top(table, count, index)
+            if not entries:
+                continue
+            print("Top {} {} by {}:".format(len(entries), title, kind), file=out)
+            for name, usage in entries:
+                print("    {:8d}  {}".format(usage[index], name), file=out)
+
+def diff(old, new, count=10, out=None):
+    '''
+    Print how flash and RAM use changed from old to new, as totals and the
+    count largest changes per library, object and symbol. Returns the
+    flash and RAM deltas.
+    '''
+    out = out or sys.stdout
+    print("Flash {:+d} bytes ({} -> {}), RAM {:+d} bytes ({} -> {})".format(
+        new.flash - old.flash, old.flash, new.flash, new.ram - old.ram, old.ram, new.ram), file=out)
+    for title, before, after in (("libraries", old.libraries, new.libraries), ("objects", old.objects, new.objects),
+            ("symbols", old.symbols, new.symbols)):
+        changes = []
+        for name in set(before) | set(after):
+            a, b = before.get(name, [0, 0]), after.get(name, [0, 0])
+            if a != b:
+                changes.append((name, b[0] - a[0], b[1] - a[1], name not in before, name not in after))
+        if not changes:
+            continue
+        changes.sort(key=lambda change: (-max(abs(change[1]), abs(change[2])), change[0]))
+        print("Changed {} ({} of {}):".format(title, min(count, len(changes)), len(changes)), file=out)
+        for name, flash, ram, added, removed in changes[:count]:
+            print("    flash {:+8d}  RAM {:+8d}  {}{}".format(flash, ram, name,
+                " (new)" if added else " (removed)" if removed else ""), file=out)
+    return new.flash - old.flash, new.ram - old.ram
+
+def usage():
+    print("Usage: %s [-n <TOP>] [--json=<FILE>] <MAP FILE>" % sys.argv[0])
+    print("       %s [-n <TOP>] --diff <OLD MAP OR JSON> <NEW MAP OR JSON>" % sys.argv[0])
+    print("OPTIONS:")
+    print("    --help, print information")
+    print("    -n, number of entries per table (default 10)")
+    print("    --json, save the summary for a later --diff")
+    print("    --diff, compare two builds")
+
+def main(argv):
+    count = 10
+    json_file = None
+    compare = False
+    try:
+        opts, args = getopt(argv, "n:", ["help", "json=", "diff"])
+    except GetoptError:
+        usage()
+        sys.exit(1)
+    for opt, arg in opts:
+        if opt == "--help":
+            usage()
+            sys.exit()
+        elif opt == "-n":
+            count = int(arg)
+        elif opt == "--json":
+            json_file = arg
+        elif opt == "--diff":
+            compare = True
+    if len(args) != (2 if compare else 1):
+        usage()
+        sys.exit(1)
+    start = time.perf_counter()
+    maps = [LinkMap.load(path) for path in args]
+    elapsed = time.perf_counter() - start
+    if compare:
+        diff(maps[0], maps[1], count)
+    else:
+        report(maps[0], count)
+    if json_file:
+        maps[-1].save(json_file)
+    print("Parsed {} in {:.0f} ms".format(", ".join(args), elapsed * 1000))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -12,9 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import hashlib
 import json
+import subprocess
 import sys
-from os.path import isfile, isdir, join
+from os import environ, listdir, makedirs, walk
+from os.path import dirname, expanduser, isfile, isdir, join
+
+from SCons.Scanner.C import CScanner
 
 env = DefaultEnvironment()
 platform = env.PioPlatform()
@@ -45,6 +51,260 @@ def process_usb_configuration(cpp_defines):
         ]
     )
 
+def framework_cache_dir(build_env):
+    """
+    Directory of the content-addressed FrameworkArduino object cache, or
+    None when board_build.framework_cache (or the RUI3_FRAMEWORK_CACHE
+    environment variable) is "no", the default. "yes" picks a directory
+    shared by all projects, anything else is taken as the directory.
+
+    SCons keys every cached object on its command line without include
+    paths and on the content of its source and headers, so boards share
+    the objects whose flags, defines and headers are the same. The
+    subdirectory adds the compiler version, which the command line does
+    not show.
+    """
+    location = environ.get("RUI3_FRAMEWORK_CACHE", str(board_config.get("build.framework_cache", "no")))
+    if location.lower() in ("no", "false", "off", "0"):
+        return None
+    if location.lower() in ("yes", "true", "on", "1", ""):
+        core_dir = build_env.subst("$PROJECT_CORE_DIR") or join(expanduser("~"), ".platformio")
+        location = join(core_dir, ".cache", "framework-arduinoststm32-rui3")
+    try:
+        compiler = subprocess.check_output(
+            [build_env.subst("$CC"), "--version"], env=build_env["ENV"], universal_newlines=True
+        ).splitlines()[0]
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        compiler = build_env.subst("$CC")
+    return join(location, hashlib.sha1(compiler.encode("utf-8")).hexdigest()[:16])
+
+
+def report_framework_cache(cache):
+    requests = getattr(cache, "requests", 0)
+    if requests:
+        print(
+            "FrameworkArduino cache: %d of %d objects reused (%.0f%%) from %s"
+            % (cache.hits, requests, 100.0 * cache.hits / requests, cache.path)
+        )
+
+# Core include directories most #include lines resolve to, most used first
+hot_include_dirs = [
+    join("external", "STM32CubeWL", "Drivers", "STM32WLxx_HAL_Driver", "Inc"),
+    join("component", "core", "mcu", "stm32wle5xx"),
+    join("external", "STM32CubeWL", "Drivers", "CMSIS", "Include"),
+    join("external", "lora", "LoRaMac-node-4.7.0", "src", "mac"),
+    join("external", "lora", "LoRaMac-node-4.7.0", "src", "system"),
+    join("external", "STM32CubeWL", "Utilities", "misc"),
+    join("external", "STM32CubeWL", "Drivers", "CMSIS", "Device", "ST", "STM32WLxx", "Include"),
+    join("component", "rui_v3_api"),
+    join("component", "service", "mode", "cli"),
+]
+
+
+def core_include_path(dirs):
+    """
+    Drop duplicates and directories missing from the framework package,
+    then move the directories in hot_include_dirs to the front. A directory
+    only moves past another when they share no file name, so every
+    #include still resolves to the same header.
+    """
+    unique = []
+    for path in dirs:
+        if isdir(path) and path not in unique:
+            unique.append(path)
+    core_dir = join(FRAMEWORK_DIR, "cores", "STM32WLE")
+    hot = [join(core_dir, path) for path in hot_include_dirs]
+    rank = [hot.index(path) if path in hot else len(hot) for path in unique]
+    names = [set(listdir(path)) for path in unique]
+    pending = list(range(len(unique)))
+    ordered = []
+    while pending:
+        for i in sorted(pending, key=lambda i: (rank[i], i)):
+            if not any(names[j] & names[i] for j in pending if j < i):
+                break
+        pending.remove(i)
+        ordered.append(unique[i])
+    return ordered
+
+
+def write_include_set(build_env):
+    """
+    Record the include path of this board in $BUILD_DIR/include_path.json,
+    for tooling that wants the same search order without running SCons.
+    """
+    path = build_env.subst(join("$BUILD_DIR", "include_path.json"))
+    include_set = {
+        "board": build_env.subst("$BOARD"),
+        "variant": variant,
+        "CPPPATH": [build_env.subst(str(item)) for item in build_env.get("CPPPATH", [])],
+    }
+    content = json.dumps(include_set, indent=2)
+    if isfile(path):
+        with open(path) as f:
+            if f.read() == content:
+                return
+    if not isdir(dirname(path)):
+        makedirs(dirname(path))
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def framework_pch(build_env):
+    """
+    When board_build.framework_pch (or the RUI3_FRAMEWORK_PCH environment
+    variable) is "yes", precompile stm32wlxx_hal.h, which pulls in the HAL
+    and CMSIS headers, for C and C++ and force-include it in every source
+    built with build_env. GCC picks the one matching the language from the
+    .gch directory. The forced include names the header by its path in the
+    PCH directory, which is kept off CPPPATH: the sources' own #include of
+    stm32wlxx_hal.h must still find the HAL copy, which its include guard
+    then skips. Returns the precompiled header nodes, or [] when off.
+    """
+    enabled = environ.get("RUI3_FRAMEWORK_PCH", str(board_config.get("build.framework_pch", "no")))
+    if enabled.lower() not in ("yes", "true", "on", "1"):
+        return []
+    header = join(
+        FRAMEWORK_DIR, "cores", "STM32WLE", "external", "STM32CubeWL", "Drivers", "STM32WLxx_HAL_Driver", "Inc",
+        "stm32wlxx_hal.h"
+    )
+    pch_dir = join("$BUILD_DIR", "FrameworkArduinoPCH")
+    # Built from a copy taken before the forced include is added
+    pch_env = build_env.Clone()
+    pch = [
+        pch_env.Command(
+            join(pch_dir, "stm32wlxx_hal.h.gch", "c.gch"), header,
+            "$CC -x c-header -o $TARGET -c $CFLAGS $CCFLAGS $_CCCOMCOM $SOURCE",
+            source_scanner=CScanner(),
+        ),
+        pch_env.Command(
+            join(pch_dir, "stm32wlxx_hal.h.gch", "cxx.gch"), header,
+            "$CXX -x c++-header -o $TARGET -c $CXXFLAGS $CCFLAGS $_CCCOMCOM $SOURCE",
+            source_scanner=CScanner(),
+        ),
+    ]
+    build_env.Append(CCFLAGS=["-include", join(pch_dir, "stm32wlxx_hal.h")])
+    return pch
+
+# LoRaWAN regions the core code can be built for, and the ones built by default.
+# LA915 used to be passed as "DREGION_LA915", which defines nothing the code
+# checks. It is on by default like in the Arduino boards menu.
+lora_regions = ["AS923", "AU915", "CN470", "CN779", "EU433", "EU868", "IN865", "KR920", "LA915", "RU864", "US915"]
+default_lora_regions = ["AS923", "AU915", "EU868", "KR920", "IN865", "US915", "RU864", "LA915"]
+
+# Subsystems a project can leave out: their defines and the sources only they
+# use, relative to cores/STM32WLE. The LoRaWAN and P2P sources are wrapped in
+# #ifdef of the feature's define, so without it they build to empty objects and
+# leaving them out links the same firmware. FUOTA is a LoRaWAN package that does
+# not build without SUPPORT_LORA, so it goes with lorawan. Not listed here:
+# SubGHz_Phy has no sources in the core (the radio driver is in the prebuilt
+# stack), spiffs is not shipped, and each HAL module built from source backs an
+# Arduino API any sketch may call. Unused HAL functions are dropped by
+# --gc-sections.
+framework_features = {
+    "lorawan": (
+        ["SUPPORT_LORA"],
+        [
+            join("component", "rui_v3_api", "RAKLorawan.cpp"),
+            join("component", "service", "lora", "service_lora_arssi.c"),
+            join("component", "service", "lora", "service_lora_certification.c"),
+            join("component", "service", "lora", "service_lora_fuota.c"),
+            join("component", "service", "lora", "service_lora_lptp.c"),
+            join("component", "service", "lora", "service_lora_test.c"),
+            join("component", "service", "lora", "packages"),
+            join("component", "service", "mode", "cli", "atcmd_cert.c"),
+            join("component", "service", "mode", "cli", "atcmd_class_b_mode.c"),
+            join("component", "service", "mode", "cli", "atcmd_info.c"),
+            join("component", "service", "mode", "cli", "atcmd_join_send.c"),
+            join("component", "service", "mode", "cli", "atcmd_key_id.c"),
+            join("component", "service", "mode", "cli", "atcmd_multicast.c"),
+            join("component", "service", "mode", "cli", "atcmd_nwk_management.c"),
+            join("component", "service", "mode", "cli", "atcmd_supplement.c"),
+            join("component", "service", "mode", "transparent", "service_mode_transparent.c"),
+        ],
+    ),
+    "p2p": (
+        ["SUPPORT_LORA_P2P"],
+        [
+            join("component", "rui_v3_api", "RAKLoRa.cpp"),
+            join("component", "service", "lora", "service_lora_p2p.c"),
+        ],
+    ),
+    "fatfs": ([], [join("external", "FatFs")]),
+}
+
+
+def board_option_list(name, variable, choices, default):
+    """
+    Comma separated board option name (board_build.* in platformio.ini),
+    overridden by the environment variable of that name. Exits the build
+    on values outside choices.
+    """
+    value = environ.get(variable, board_config.get(name, ""))
+    if isinstance(value, str):
+        value = value.replace(",", " ").split()
+    if not value:
+        return list(default)
+    lookup = dict((choice.lower(), choice) for choice in choices)
+    selected = [lookup.get(item.lower(), item) for item in value]
+    unknown = [item for item in value if item.lower() not in lookup]
+    if unknown:
+        sys.stderr.write(
+            "Error: unknown %s %s, choose from %s\n" % (name, ", ".join(unknown), ", ".join(sorted(choices)))
+        )
+        env.Exit(1)
+    return selected
+
+
+def count_sources(path):
+    if isfile(path):
+        return 1
+    return sum(
+        1 for root, _, files in walk(path) for name in files if name.endswith((".c", ".cpp", ".S", ".s"))
+    )
+
+
+selected_regions = board_option_list("build.lora_regions", "RUI3_LORA_REGIONS", lora_regions, default_lora_regions)
+selected_features = board_option_list(
+    "build.framework_features", "RUI3_FRAMEWORK_FEATURES", framework_features, framework_features
+)
+option_defines = ["REGION_%s" % region for region in selected_regions]
+option_filter = ""
+for feature, (defines, sources) in sorted(framework_features.items()):
+    if feature in selected_features:
+        option_defines.extend(defines)
+        continue
+    excluded = 0
+    for path in sources:
+        path = join(FRAMEWORK_DIR, "cores", "STM32WLE", path)
+        option_filter += " -<%s>" % path if isfile(path) else " -<%s/>" % path
+        excluded += count_sources(path)
+    print("Framework feature %s is off: %d sources not built" % (feature, excluded))
+if sorted(selected_regions) != sorted(default_lora_regions):
+    print("LoRaWAN regions: %s" % ", ".join(selected_regions))
+
+def size_report(target, source, env):
+    """
+    Post-link step: attribute flash and RAM use in ${PROGNAME}.map with
+    tools/linkmap.py and print what changed since the previous build,
+    whose summary is kept in ${PROGNAME}.size.json.
+    """
+    sys.path.insert(0, join(FRAMEWORK_DIR, "tools"))
+    import linkmap
+
+    map_path = env.subst(join("$BUILD_DIR", "${PROGNAME}.map"))
+    summary_path = env.subst(join("$BUILD_DIR", "${PROGNAME}.size.json"))
+    if not isfile(map_path):
+        return
+    link_map = linkmap.LinkMap.load(map_path)
+    if isfile(summary_path):
+        flash, ram = linkmap.diff(linkmap.LinkMap.load(summary_path), link_map, 5)
+        if flash > 0 or ram > 0:
+            print("Warning: %s grew by %d bytes of flash and %d bytes of RAM" % (
+                env.subst("${PROGNAME}"), max(flash, 0), max(ram, 0)))
+    else:
+        linkmap.report(link_map, 5)
+    link_map.save(summary_path)
+
 #
 # Linker requires preprocessing with correct RAM|ROM sizes
 #
@@ -107,21 +367,12 @@ env.Append(
         "DEBUG",
         "USE_HAL_DRIVER",
         "USE_FULL_LL_DRIVER",
-        "SUPPORT_LORA",
-        "SUPPORT_LORA_P2P",
-        "REGION_AS923",
-        "REGION_AU915",
-        "REGION_EU868",
-        "REGION_KR920",
-        "REGION_IN865",
-        "REGION_US915",
-        "REGION_RU864",
-        "DREGION_LA915",
         ("CFG_DEBUG", 0), 
         ("CFG_LOGGER", 1),
         ("CFG_SYSVIEW", 0),         
-    ],
-    CPPPATH=[
+    ]
+    + option_defines,
+    CPPPATH=core_include_path([
         join(FRAMEWORK_DIR, "cores", "STM32WLE", "app", "RAK3172-E", "src"),
         join(FRAMEWORK_DIR, "cores", "STM32WLE", "component", "inc"),
         join(FRAMEWORK_DIR, "cores", "STM32WLE", "component", "core", "mcu", "stm32wle5xx"),
@@ -181,18 +432,12 @@ env.Append(
         join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "STM32CubeWL", "Utilities", "misc"),
         join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "STM32CubeWL", "Utilities", "sequencer"),
         join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "STM32CubeWL", "Utilities", "trace", "adv_trace"),
-        join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "lora", "LoRaMac-node-4.7.0", "src", "mac"),
-        join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "lora", "LoRaMac-node-4.7.0", "src", "boards"),
-        join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "lora", "LoRaMac-node-4.7.0", "src", "mac", "region"),
-        join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "lora", "LoRaMac-node-4.7.0", "src", "radio"),
-        join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "lora", "LoRaMac-node-4.7.0", "src", "peripherals"),
         join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "STM32CubeWL", "Libraries", "queue"),
         join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "STM32CubeWL", "Libraries", "include"),
         join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "STM32CubeWL", "Libraries", "scheduler"),
         join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "FatFs", "source"),
-        join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "spiffs", "src"),
         join(FRAMEWORK_DIR, "cores", "STM32WLE"),
-    ],
+    ]),
     LINKFLAGS=machine_flags
     + [
         "-Os",
@@ -222,24 +467,54 @@ env.Append(
 libs = []
 
 if "build.variant" in board_config:
-    env.Append(CPPPATH=[inc_variant_dir], LIBPATH=[inc_variant_dir])
+    env.Append(LIBPATH=[inc_variant_dir])
     # actually a crucial build fix, systime.h is present multiple times
     env.Prepend(CPPPATH=[inc_variant_dir])
     env.BuildSources(join("$BUILD_DIR", "FrameworkArduinoVariant"), variant_dir)
 
+write_include_set(env)
+
+# The core library is built from its own environment so only its objects
+# go to the framework cache and get the precompiled header
+framework_env = env.Clone()
+# The USB macros name the board but nothing in the core uses them, without
+# them boards share the core objects whose headers are the same
+usb_defines = ("USBCON", "USB_VID", "USB_PID", "USB_MANUFACTURER", "USB_PRODUCT")
+framework_env.Replace(
+    CPPDEFINES=[
+        define for define in framework_env.get("CPPDEFINES", [])
+        if (define[0] if isinstance(define, (list, tuple)) else define) not in usb_defines
+    ]
+)
+pch = framework_pch(framework_env)
+cache_dir = framework_cache_dir(framework_env)
+if cache_dir:
+    framework_env.CacheDir(cache_dir)
+    atexit.register(report_framework_cache, framework_env.get_CacheDir())
+
 libs.append(
-    env.BuildLibrary(
+    framework_env.BuildLibrary(
         join("$BUILD_DIR", "FrameworkArduino"), join(FRAMEWORK_DIR, "cores", "STM32WLE"),
-        src_filter="+<*> -<.git/> -<.svn/> -<%s/> +<%s/> +<%s/> +<%s/> +<%s/> +<%s/> +<%s/>" % (
+        src_filter="+<*> -<.git/> -<.svn/> -<%s/> +<%s/> +<%s/> +<%s/> +<%s/> +<%s/>" % (
             join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "STM32CubeWL"),
             join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "STM32CubeWL", "Drivers", "STM32WLxx_HAL_Driver"),
             join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "STM32CubeWL", "Utilities", "lpm"),
             join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "STM32CubeWL", "Utilities", "misc"),
             join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "STM32CubeWL", "Utilities", "timer"),
             join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "STM32CubeWL", "Utilities", "trace"),
-            join(FRAMEWORK_DIR, "cores", "STM32WLE", "external", "STM32CubeWL", "Middlewares", "Third_Party", "SubGHz_Phy"),
         )
+        + option_filter,
     )
 )
 
-env.Prepend(LIBS=libs)
\ No newline at end of file
+if pch:
+    # Every object waits for the precompiled headers, the library's sources are its objects
+    framework_env.Depends(libs[-1][0].sources, pch)
+
+env.Prepend(LIBS=libs)
+
+# Size report after every link, board_build.size_report = no turns it off
+if str(board_config.get("build.size_report", "yes")).lower() not in ("no", "false", "off", "0"):
+    env.AddPostAction(
+        join("$BUILD_DIR", "${PROGNAME}${PROGSUFFIX}"), env.VerboseAction(size_report, "Analyzing link map")
+    )
\ No newline at end of file
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import io
+import random
+import struct
+import logging
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import uploader_ymodem
+from uploader_ymodem import SOH, STX, CAN
+from ymodem_sim import Pipe, SimulatedDevice, make_link_modem, make_modem, crc_engines
+
+class CrcEngines(unittest.TestCase):
+    '''
+    Every CRC-16/XMODEM engine must give the checksum of the byte-wise
+    table reference, in the frames the send path builds too.
+    '''
+    def test_check_value(self):
+        # Check value of CRC-16/XMODEM
+        for engine in crc_engines():
+            self.assertEqual(make_modem(crc_engine=engine).calc_crc(b"123456789"), 0x31c3, engine)
+
+    def test_random_payloads(self):
+        rng = random.Random(0)
+        reference = make_modem(crc_engine="table")
+        modems = [make_modem(crc_engine=engine) for engine in crc_engines()]
+        for i in range(200):
+            size = rng.choice((0, 1, 3, 127, 128, 1023, 1024, rng.randrange(2048)))
+            data = bytes(rng.getrandbits(8) for _ in range(size))
+            crc = rng.getrandbits(16)
+            for modem in modems:
+                self.assertEqual(modem.calc_crc(data), reference.calc_crc(data),
+                    "{} on payload {} ({} bytes)".format(modem.crc_engine, i, size))
+                # Continuing from a previous CRC, with a memoryview as _fill_frame passes
+                self.assertEqual(modem.calc_crc(memoryview(data), crc), reference.calc_crc(data, crc),
+                    "{} on payload {} ({} bytes) from {:04x}".format(modem.crc_engine, i, size, crc))
+
+    def test_frames(self):
+        rng = random.Random(0)
+        reference = make_modem(crc_engine="table")
+        modems = [make_modem(crc_engine=engine) for engine in crc_engines()]
+        for i in range(100):
+            packet_size = rng.choice((128, 1024))
+            data = bytes(rng.getrandbits(8) for _ in range(rng.randrange(packet_size + 1)))
+            sequence = rng.randrange(0x100)
+            for crc_mode in (1, 0):
+                expected = bytes(reference._fill_frame(packet_size, sequence, crc_mode, data=data))
+                self.assertEqual(expected[:3], (SOH if packet_size == 128 else STX) + bytes([sequence, 0xff - sequence]))
+                for modem in modems:
+                    frame = bytes(modem._fill_frame(packet_size, sequence, crc_mode, data=data))
+                    self.assertEqual(frame, expected, "{} on frame {}".format(modem.crc_engine, i))
+                    valid, payload = modem._verify_recv_checksum(crc_mode, frame[3:])
+                    self.assertTrue(valid, "{} rejected frame {}".format(modem.crc_engine, i))
+                    self.assertEqual(bytes(payload), frame[3:3 + packet_size])
+
+    def test_invalid_engine(self):
+        with self.assertRaises(ValueError):
+            make_modem(crc_engine="crc32")
+
+class SkipUnchanged(unittest.TestCase):
+    '''
+    --skip-unchanged skips a device only when it is identified and was last
+    flashed with the same image, whatever port it is plugged into.
+    '''
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.saved = uploader_ymodem.baudrate_cache, uploader_ymodem.last_upload_cache
+        uploader_ymodem.baudrate_cache = os.path.join(self.cache_dir.name, "baudrate.json")
+        uploader_ymodem.last_upload_cache = os.path.join(self.cache_dir.name, "last_upload.json")
+        vectors = struct.pack("<II", uploader_ymodem.ram_origin + 0x8000, uploader_ymodem.app_origin + 0x101)
+        self.image = uploader_ymodem.FirmwareImage("firmware.bin", vectors + bytes(range(256)) * 16)
+
+    def tearDown(self):
+        uploader_ymodem.baudrate_cache, uploader_ymodem.last_upload_cache = self.saved
+        self.cache_dir.cleanup()
+
+    def upload(self, device, port="COM1"):
+        session = uploader_ymodem.UploadSession(port, self.image, out=io.StringIO(), skip_unchanged=True)
+        session.open_serial = device.open
+        session.enter_boot_mode = lambda: None
+        flashed = []
+        session.enter_dfu_mode = lambda: flashed.append(session.device_id)
+        session.upload()
+        return session, bool(flashed)
+
+    def test_same_device(self):
+        device = SimulatedDevice(115200, latency=0, sn=b"WA1234567890ABCDEF")
+        session, flashed = self.upload(device)
+        self.assertTrue(flashed)
+        self.assertEqual(session.device_id, "sn:WA1234567890ABCDEF")
+        session, flashed = self.upload(device, port="COM2")
+        self.assertFalse(flashed)
+        self.assertTrue(session.skipped)
+
+    def test_other_device_on_the_same_port(self):
+        self.upload(SimulatedDevice(115200, latency=0, sn=b"WA1234567890ABCDEF"))
+        session, flashed = self.upload(SimulatedDevice(115200, latency=0, sn=b"WA1234567890ABCDE0"))
+        self.assertTrue(flashed)
+        self.assertFalse(session.skipped)
+
+    def test_changed_image(self):
+        device = SimulatedDevice(115200, latency=0, sn=b"WA1234567890ABCDEF")
+        self.upload(device)
+        vectors = struct.pack("<II", uploader_ymodem.ram_origin + 0x8000, uploader_ymodem.app_origin + 0x101)
+        self.image = uploader_ymodem.FirmwareImage("firmware.bin", vectors + bytes(range(255, -1, -1)) * 16)
+        session, flashed = self.upload(device)
+        self.assertTrue(flashed)
+        self.assertFalse(session.skipped)
+
+    def test_unidentified_device(self):
+        for sn in (None, b"\xff" * 18, b"\x00" * 18):
+            for _ in range(2):
+                session, flashed = self.upload(SimulatedDevice(115200, latency=0, sn=sn))
+                self.assertTrue(flashed, sn)
+                self.assertIsNone(session.device_id, sn)
+
+class CancelOnError(unittest.TestCase):
+    '''
+    A send whose data phase fails cancels the receiver with CAN, unless
+    called with cancel=False to keep the transfer resumable.
+    '''
+    def setUp(self):
+        logger = logging.getLogger("Modem")
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.CRITICAL)
+
+    def send(self, **kwargs):
+        rx, tx = Pipe(), Pipe()
+        # The receiver asks for CRC mode, then never ACKs a block
+        rx.write(b"C")
+        sender = make_link_modem(rx, tx, mode="xmodem")
+        ok = sender.send(io.BytesIO(bytes(256)), retry=1, timeout=0.05, quiet=True, **kwargs)
+        written = tx.read(1 << 16, timeout=0) or b""
+        return ok, written
+
+    def test_cancel(self):
+        for kwargs in ({}, {"cancel": True}):
+            ok, written = self.send(**kwargs)
+            self.assertFalse(ok)
+            self.assertTrue(written.endswith(CAN * 2), kwargs)
+
+    def test_no_cancel(self):
+        ok, written = self.send(cancel=False)
+        self.assertFalse(ok)
+        self.assertNotIn(CAN, written)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,9 +13,26 @@ import time
 import logging
 import platform
 import types
+import json
+import io
+import re
+import hashlib
+import struct
+import concurrent.futures
+import collections
+
+try:
+    from binascii import crc_hqx
+except ImportError:
+    crc_hqx = None
 
 default_baudrate = 115200
 boot_mode = 0
+cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "uploader_ymodem")
+baudrate_cache = os.path.join(cache_dir, "baudrate.json")
+last_upload_cache = os.path.join(cache_dir, "last_upload.json")
+cache_lock = threading.Lock()
+metrics_lock = threading.Lock()
 
 class RWBuilder(object):
     def __init__(self, rFunc=None, wFunc=None):
@@ -50,8 +67,6 @@ class Protocol(object):
         else:
             raise TypeError("unknown type for writer")
 
-logging.basicConfig(level = logging.DEBUG, format = '%(message)s')
-
 SOH = b'\x01'
 STX = b'\x02'
 EOT = b'\x04'
@@ -59,6 +74,7 @@ ACK = b'\x06'
 NAK = b'\x15'
 CAN = b'\x18'
 CRC = b'\x43'
+GEE = b'\x47'
 
 USE_LENGTH_FIELD    = 0b100000
 USE_DATE_FIELD      = 0b010000
@@ -67,12 +83,238 @@ USE_SN_FIELD        = 0b000100
 ALLOW_1KBLK         = 0b000010
 ALLOW_YMODEMG       = 0b000001
 
+def make_crc_slices(table, count):
+    '''
+    Derive slicing-by-N tables from a byte-wise CRC-16 table:
+    slices[k][i] is the CRC of byte i followed by k zero bytes.
+    '''
+    slices = [table]
+    for _ in range(count - 1):
+        prev = slices[-1]
+        slices.append([((prev[i] << 8) & 0xffff) ^ table[prev[i] >> 8] for i in range(256)])
+    return slices
+
+class FrameBuffer(object):
+    '''
+    Receive buffer used by Modem.recv. Bytes are pulled from the reader in
+    chunks into a fixed bytearray and handed out as memoryviews, so a whole
+    block is parsed and written without reading the port byte by byte.
+    A returned view is only valid until the next call.
+
+    When the reader has an available() function, whatever is already waiting
+    on the line is pulled in together with the bytes asked for.
+    '''
+    def __init__(self, reader, size=8192):
+        self.reader = reader
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _fill(self, count, timeout):
+        if self.start + count > len(self.buffer):
+            # Move the unread tail to the front, the buffer itself never resizes
+            length = len(self)
+            self.buffer[:length] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, length
+        available = getattr(self.reader, "available", None)
+        deadline = time.monotonic() + timeout
+        while len(self) < count:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            size = count - len(self)
+            if callable(available):
+                size = max(size, min(available(), len(self.buffer) - self.end))
+            data = self.reader.read(size, remaining)
+            if not data:
+                break
+            self.view[self.end:self.end + len(data)] = data
+            self.end += len(data)
+        return len(self) >= count
+
+    def read_byte(self, timeout):
+        if not self._fill(1, timeout):
+            return None
+        self.start += 1
+        return bytes(self.view[self.start - 1:self.start])
+
+    def read(self, count, timeout):
+        '''
+        Return a view of the next count bytes, None if they did not arrive in time
+        '''
+        if not self._fill(count, timeout):
+            return None
+        self.start += count
+        return self.view[self.start - count:self.start]
+
+    def purge(self, quiet=1):
+        '''
+        Drop everything buffered and read until the line stays quiet for quiet seconds
+        '''
+        self.start = self.end = 0
+        while self.reader.read(len(self.buffer), quiet):
+            pass
+
+class Metrics(object):
+    '''
+    Counters, timers and histograms collected during an upload.
+
+    Histograms keep count, sum, min and max plus power-of-two millisecond
+    buckets, so recording a block is a few dict updates. When events is an
+    open file, event() writes one JSON line per call to it; without it
+    event() returns at once. labels (e.g. port) are added to every record.
+    '''
+    def __init__(self, events=None, **labels):
+        self.events = events
+        self.labels = labels
+        self.counters = {}
+        self.timers = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, seconds):
+        with self.lock:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def observe(self, name, seconds):
+        ms = seconds * 1000
+        bucket = 1
+        while bucket < ms:
+            bucket <<= 1
+        with self.lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = dict(count=0, sum=0.0, min=ms, max=ms, buckets={})
+            hist["count"] += 1
+            hist["sum"] += ms
+            hist["min"] = min(hist["min"], ms)
+            hist["max"] = max(hist["max"], ms)
+            hist["buckets"][bucket] = hist["buckets"].get(bucket, 0) + 1
+
+    def event(self, kind, **fields):
+        if self.events is None:
+            return
+        record = dict(self.labels, event=kind, time=round(time.time(), 6))
+        record.update(fields)
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with metrics_lock:
+            self.events.write(line)
+            self.events.flush()
+
+    @staticmethod
+    def _percentile(hist, fraction):
+        # Upper bound of the bucket holding the given fraction of samples
+        target = hist["count"] * fraction
+        seen = 0
+        for bucket in sorted(hist["buckets"]):
+            seen += hist["buckets"][bucket]
+            if seen >= target:
+                return min(bucket, hist["max"])
+        return hist["max"]
+
+    def summary(self):
+        '''
+        Everything collected so far as a JSON serialisable dict. bytes_per_s
+        is the size of the acknowledged blocks divided by the time spent in
+        the data phase.
+        '''
+        with self.lock:
+            histograms = {}
+            for name, hist in self.histograms.items():
+                histograms[name + "_ms"] = dict(
+                    count   = hist["count"],
+                    mean    = round(hist["sum"] / hist["count"], 3),
+                    min     = round(hist["min"], 3),
+                    max     = round(hist["max"], 3),
+                    p50     = round(self._percentile(hist, 0.5), 3),
+                    p90     = round(self._percentile(hist, 0.9), 3),
+                    p99     = round(self._percentile(hist, 0.99), 3),
+                    buckets = dict((str(bucket), count) for bucket, count in sorted(hist["buckets"].items())),
+                )
+            data_time = self.timers.get("data")
+            return dict(self.labels,
+                counters    = dict(self.counters),
+                timers      = dict((name, round(value, 6)) for name, value in self.timers.items()),
+                histograms  = histograms,
+                bytes_per_s = round(self.counters.get("bytes", 0) / data_time, 1) if data_time else None,
+            )
+
+class AdaptiveLink(object):
+    '''
+    ACK timeout and block size for the stop-and-wait data phase of
+    Modem.send, adapted to what the link does.
+
+    The timeout (rto) follows RFC 6298: the smoothed ACK round trip plus
+    four times its variation, kept between min_rto and max_rto and doubled
+    after every timeout. Round trips of retransmitted blocks are not
+    sampled, their ACK may belong to an earlier attempt. A receiver only
+    NAKs a broken block after its own timeout and purge, so rto also stays
+    above one and a half times the slowest NAK seen; retransmitting before
+    that only collides with the NAK.
+
+    The error rate is an exponential average over block attempts. Blocks
+    drop from 1024 to 128 bytes when it rises above high and go back to
+    1024 once it falls below low.
+    '''
+    def __init__(self, packet_size, max_rto, min_rto=3.0, high=0.3, low=0.01, gain=1 / 16.0):
+        self.max_packet_size = packet_size
+        self.packet_size = packet_size
+        self.min_rto = min(min_rto, max_rto)
+        self.max_rto = max_rto
+        self.rto = max_rto
+        self.srtt = None
+        self.rttvar = None
+        self.nak_time = 0.0
+        self.high = high
+        self.low = low
+        self.gain = gain
+        self.error_rate = 0.0
+
+    def acked(self, rtt, retransmitted):
+        if not retransmitted:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+                self.srtt += (rtt - self.srtt) / 8
+            self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto, 1.5 * self.nak_time), self.max_rto)
+        self._update(0.0)
+
+    def failed(self, elapsed, timed_out):
+        if timed_out:
+            self.rto = min(self.rto * 2, self.max_rto)
+        else:
+            self.nak_time = max(self.nak_time, elapsed)
+            self.rto = min(max(self.rto, 1.5 * self.nak_time), self.max_rto)
+        self._update(1.0)
+
+    def _update(self, error):
+        self.error_rate += self.gain * (error - self.error_rate)
+        if self.packet_size > 128 and self.error_rate > self.high:
+            self.packet_size = 128
+        elif self.packet_size < self.max_packet_size and self.error_rate < self.low:
+            self.packet_size = self.max_packet_size
+
 class Modem(Protocol):
-    def __init__(self, reader, writer, mode='ymodem1k', program="rzsz"):
+    def __init__(self, reader, writer, mode='ymodem1k', program="rzsz", crc_engine="auto", metrics=None):
         self.logger = logging.getLogger('Modem')
         self.reader = reader
         self.writer = writer
         self.mode   = mode
+        self.crc_engine = crc_engine
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.timings = {}
+        self.resume_point = None
+        self._frames = {}
 
         '''
         YMODEM Header Information and Features
@@ -100,12 +342,51 @@ class Modem(Protocol):
             )[program]
         except KeyError:
             raise ValueError("Invalid program specified: {}".format(program))
-        
+
+    @property
+    def crc_engine(self):
+        return self._crc_engine
+
+    @crc_engine.setter
+    def crc_engine(self, name):
+        '''
+        CRC-16/XMODEM engines, all producing the same result:
+        native  - binascii.crc_hqx (C implementation shipped with CPython)
+        sliced  - slicing-by-4 lookup tables, pure Python fallback
+        table   - byte-wise table lookup, the reference implementation
+        auto    - native when available, sliced otherwise
+        '''
+        if name == "auto":
+            name = "native" if crc_hqx is not None else "sliced"
+        try:
+            self._calc_crc = dict(
+                native  = self.calc_crc_native,
+                sliced  = self.calc_crc_sliced,
+                table   = self.calc_crc_table,
+            )[name]
+        except KeyError:
+            raise ValueError("Invalid CRC engine specified: {}".format(name))
+        if name == "native" and crc_hqx is None:
+            raise ValueError("CRC engine 'native' requires binascii.crc_hqx")
+        self._crc_engine = name
+
     def abort(self, count=2, timeout=60):
         for _ in range(count):
             self.writer.write(CAN, timeout)
 
-    def send(self, stream, retry=30, timeout=10, quiet=False, callback=None, info: dict=None):
+    def send(self, stream, retry=30, timeout=10, quiet=False, callback=None, info: dict=None, window=1, cancel=True, adaptive=False):
+        '''
+        window: number of data blocks kept in flight before waiting for an ACK.
+        1 is the classic stop-and-wait transfer. When the receiver requests
+        YMODEM-g (G) and the program allows it, blocks are streamed without
+        any ACK regardless of window.
+        cancel: send CAN to the receiver when the data phase fails. Pass False
+        to leave the receiver waiting so the transfer can be continued with
+        resume() from resume_point.
+        adaptive: in stop-and-wait mode, wait for each ACK as long as the
+        measured round trips suggest instead of the full timeout, and fall
+        back to 128 byte blocks while the link keeps failing (AdaptiveLink).
+        '''
         if info:
             for key, value in info.items():
                 self.logger.debug("File info: %s: %s", key, value)
@@ -119,6 +400,9 @@ class Modem(Protocol):
             )[self.mode]
         except KeyError:
             raise ValueError("Invalid mode specified: {self.mode!r}".format(self=self))
+
+        self.timings = dict(handshake=0.0, data=0.0, eot=0.0, null=0.0)
+        phase_start = time.monotonic()
         
         '''
         The first package for YMODEM Batch Transmission
@@ -130,7 +414,8 @@ class Modem(Protocol):
 
             error_count = 0
             crc_mode = 0
-            cancel = 0
+            streaming = 0
+            can_received = 0
             while True:
                 char = self.reader.read(1)
                 if char:
@@ -144,15 +429,21 @@ class Modem(Protocol):
                         crc_mode = 1
                         self.logger.debug("[S] STATE: 16-bit CRC mode applied")
                         break
+                    elif char == GEE and self.ymodem_flags & ALLOW_YMODEMG:
+                        self.logger.debug("[S] STATE: Received streaming request (G)")
+                        crc_mode = 1
+                        streaming = 1
+                        self.logger.debug("[S] STATE: YMODEM-g mode applied")
+                        break
                     elif char == CAN:
                         if not quiet:
                             print('received CAN', file=sys.stderr)
-                        if cancel:
+                        if can_received:
                             self.logger.info("[S] STATE: Transmission cancelled (Received 2 CANs at mode request)")
                             return False
                         else:
                             self.logger.debug("[S] STATE: Ready for transmission cancellation")
-                            cancel = 1
+                            can_received = 1
                     elif char == EOT:
                         self.logger.info("[S] STATE: Transmission cancelled (Received EOT at mode request)")
                         return False
@@ -167,8 +458,6 @@ class Modem(Protocol):
 
             self.logger.debug("[S] STATE: Preparing info block")
 
-            header = self._make_send_header(packet_size, 0)
-
             # [required] Name
             data = info["name"].encode("utf-8")
             
@@ -202,15 +491,13 @@ class Modem(Protocol):
             if self.ymodem_flags & USE_MODE_FIELD:
                 data += (" 0").encode("utf-8")
             '''
-            data = data.ljust(packet_size, b"\x00")
-            checksum = self._make_send_checksum(crc_mode, data)
+            frame = self._fill_frame(packet_size, 0, crc_mode, data=data, pad=b"\x00")
                 
             error_count = 0
-            self.writer.write(header + data + checksum)
-            while True:
+            self.writer.write(frame)
+            while not streaming:
                 
                 self.logger.debug("[S] TRANSMISSION: info block sent")
-                sleep(1)
                 char = self.reader.read(1, timeout)
                 if char == ACK:
                     error_count = 0
@@ -227,7 +514,8 @@ class Modem(Protocol):
         self.logger.debug("[S] STATE: Waiting the mode request...")
         error_count = 0
         crc_mode = 0
-        cancel = 0
+        streaming = 0
+        can_received = 0
         while True:
             char = self.reader.read(1)
             if char:
@@ -241,15 +529,21 @@ class Modem(Protocol):
                     crc_mode = 1
                     self.logger.debug("[S] STATE: 16-bit CRC mode applied")
                     break
+                elif char == GEE and self.ymodem_flags & ALLOW_YMODEMG:
+                    self.logger.debug("[S] STATE: Received streaming request (G)")
+                    crc_mode = 1
+                    streaming = 1
+                    self.logger.debug("[S] STATE: YMODEM-g mode applied")
+                    break
                 elif char == CAN:
                     if not quiet:
                         print('received CAN', file=sys.stderr)
-                    if cancel:
+                    if can_received:
                         self.logger.info("[S] TRANSMISSION: Cancelled (Received 2 CANs at mode request)")
                         return False
                     else:
                         self.logger.debug("[S] STATE: Ready for transmission cancellation")
-                        cancel = 1
+                        can_received = 1
                 elif char == EOT:
                     self.logger.info("[S] TRANSMISSION: Cancelled (Received EOT at mode request)")
                     return False
@@ -261,29 +555,86 @@ class Modem(Protocol):
                 self.abort(timeout=timeout)
                 return False
 
+        self._phase_done("handshake", phase_start)
+
+        # Where the data phase starts, advanced with every ACKed block
+        self.resume_point = dict(
+            packet_size = packet_size,
+            crc_mode    = crc_mode,
+            sequence    = 1,
+            offset      = stream.tell() if hasattr(stream, "tell") else 0,
+        )
+        return self._send_data(stream, packet_size, crc_mode, streaming, window, retry, timeout, callback, cancel, adaptive)
+
+    def resume(self, stream, retry=30, timeout=10, callback=None, cancel=True, adaptive=False):
+        '''
+        Continue a transfer whose data phase failed from the last ACKed block
+        in resume_point, skipping the handshake. This only works while the
+        receiver is still waiting for that block, i.e. the failed send() was
+        called with cancel=False. stream must be seekable.
+        '''
+        point = self.resume_point
+        if point is None:
+            return False
+        self.logger.info("[S] STATE: Resuming at offset %d (seq=%d)", point["offset"], point["sequence"])
+        stream.seek(point["offset"])
+        self.timings = dict(handshake=0.0, data=0.0, eot=0.0, null=0.0)
+        return self._send_data(stream, point["packet_size"], point["crc_mode"], 0, 1, retry, timeout, callback, cancel, adaptive)
+
+    def _phase_done(self, name, phase_start):
+        self.timings[name] = time.monotonic() - phase_start
+        self.metrics.timing(name, self.timings[name])
+
+    def _send_data(self, stream, packet_size, crc_mode, streaming, window, retry, timeout, callback, cancel_on_error, adaptive=False):
+        point = self.resume_point
+        phase_start = time.monotonic()
+        # Per-block logging is skipped entirely unless DEBUG is enabled
+        trace = self.logger.isEnabledFor(logging.DEBUG)
+        metrics = self.metrics
+
+        pipelined = streaming or window > 1
+        if pipelined:
+            if not self._send_pipelined(stream, packet_size, crc_mode, None if streaming else window, timeout, callback):
+                self._phase_done("data", phase_start)
+                if cancel_on_error:
+                    self.abort(timeout=timeout)
+                return False
+
         error_count = 0
         success_count = 0
         total_packets = 0
-        sequence = 1
+        sequence = point["sequence"]
         cancel = 0
-        while True:
-            data = stream.read(packet_size)
-            if not data:
+        link = AdaptiveLink(packet_size, timeout) if adaptive and not pipelined else None
+        while not pipelined:
+            if link is not None and link.packet_size != packet_size:
+                self.logger.info("[S] STATE: Switching to %d byte blocks (error rate %.2f)", link.packet_size, link.error_rate)
+                metrics.count("downshifts" if link.packet_size < packet_size else "upshifts")
+                packet_size = point["packet_size"] = link.packet_size
+            # fill with 1AH(^z)
+            frame = self._next_frame(stream, packet_size, sequence, crc_mode)
+            if frame is None:
                 self.logger.debug("[S] TRANSMISSION: Reached EOF")
                 break
             total_packets += 1
 
-            header = self._make_send_header(packet_size, sequence)
-            # fill with 1AH(^z)
-            data = data.ljust(packet_size, b"\x1a")
-            checksum = self._make_send_checksum(crc_mode, data)
-
             while True:
-                self.writer.write(header + data + checksum)
-                self.logger.debug("[S] TRANSMISSION: block {} (seq={}) sent".format(success_count, sequence))
-                char = self.reader.read(1, timeout)
+                sent_at = time.monotonic()
+                self.writer.write(frame)
+                if trace:
+                    self.logger.debug("[S] TRANSMISSION: block %d (seq=%d) sent", success_count, sequence)
+                char = self.reader.read(1, link.rto if link is not None else timeout)
                 if char == ACK:
+                    rtt = time.monotonic() - sent_at
+                    if link is not None:
+                        link.acked(rtt, error_count > 0)
+                    metrics.observe("block_rtt", rtt)
+                    metrics.count("blocks")
+                    metrics.count("bytes", packet_size)
+                    metrics.event("block", block=success_count + 1, seq=sequence, size=packet_size, rtt=round(rtt, 6), retries=error_count)
                     success_count += 1
+                    point["sequence"] = (sequence + 1) % 0x100
+                    point["offset"] += packet_size
                     if callable(callback):
                         callback(total_packets, success_count, error_count)
                     error_count = 0
@@ -300,15 +651,24 @@ class Modem(Protocol):
 
                 self.logger.error('[S] ERROR: Expected ACK but got %r for block %d', char, sequence)
                 error_count += 1
+                metrics.count("retransmits")
+                metrics.count("timeouts" if char is None else "naks" if char == NAK else "unexpected")
+                if link is not None:
+                    link.failed(time.monotonic() - sent_at, char is None)
                 if callable(callback):
                     callback(total_packets, success_count, error_count)
                 if error_count > retry:
                     self.logger.error("[S] ERROR: NAK received {} times, aborting...".format(error_count))
-                    self.abort(timeout=timeout)
+                    self._phase_done("data", phase_start)
+                    if cancel_on_error:
+                        self.abort(timeout=timeout)
                     return False
 
             sequence = (sequence + 1) % 0x100
 
+        self._phase_done("data", phase_start)
+        phase_start = time.monotonic()
+
         while True:
             self.writer.write(EOT)
             self.logger.debug("[S] TRANSMISSION: EOT sent and awaiting ACK")
@@ -319,18 +679,19 @@ class Modem(Protocol):
             else:
                 self.logger.error("[S] ERROR: Expected ACK but got %r", char)
                 error_count += 1
+                metrics.count("retransmits")
                 if error_count > retry:
                     self.logger.warning("[S] WARN: EOT was not ACKd, aborting transfer...")
                     self.abort(timeout=timeout)
                     return False
 
         self.logger.info("[S] TRANSMISSION: Finished (ACK received)")
+        self._phase_done("eot", phase_start)
+        phase_start = time.monotonic()
         
+        frame = self._fill_frame(packet_size, 0, crc_mode, pad=b"\x00")
         while True:
-            header = self._make_send_header(packet_size, 0)
-            data = data.ljust(packet_size, b"\x00")
-            checksum = self._make_send_checksum(crc_mode, data)
-            self.writer.write(header + data + checksum)
+            self.writer.write(frame)
             self.logger.debug("[S] TRANSMISSION: SEND NULL")
             char = self.reader.read(1, timeout)
             if char == ACK:
@@ -338,326 +699,411 @@ class Modem(Protocol):
             else:
                 self.logger.error("[S] ERROR: Expected ACK but got %r", char)
                 error_count += 1
+                metrics.count("retransmits")
                 if error_count > retry:
                     self.logger.warning("[S] WARN: EOT was not ACKd, aborting transfer...")
                     self.abort(timeout=timeout)
                     return False
+        self._phase_done("null", phase_start)
+        self.resume_point = None
+        self.logger.info("[S] TIMING: handshake %.3fs, data %.3fs, EOT %.3fs, null block %.3fs",
+            self.timings["handshake"], self.timings["data"], self.timings["eot"], self.timings["null"])
         return True
 
-    def _make_send_header(self, packet_size, sequence):
-        assert packet_size in (128, 1024), packet_size
-        _bytes = []
-        if packet_size == 128:
-            _bytes.append(ord(SOH))
-        elif packet_size == 1024:
-            _bytes.append(ord(STX))
-        _bytes.extend([sequence, 0xff - sequence])
-        return bytearray(_bytes)
-
-    def _make_send_checksum(self, crc_mode, data):
-        _bytes = []
-        if crc_mode:
-            crc = self.calc_crc(data)
-            _bytes.extend([crc >> 8, crc & 0xff])
+    def _send_pipelined(self, stream, packet_size, crc_mode, window, timeout, callback=None):
+        '''
+        Data phase without a round trip per block. A watcher thread collects
+        ACKs while blocks are written back to back, at most `window` of them
+        unacknowledged. window=None is YMODEM-g: the receiver sends no ACKs
+        and the sender never waits. Any NAK, double CAN or ACK timeout stops
+        the transfer, there is no retransmission in this mode.
+        '''
+        cond = threading.Condition()
+        state = dict(sent=0, acked=0, finished=False, failure=None, progress=time.monotonic())
+        trace = self.logger.isEnabledFor(logging.DEBUG)
+        metrics = self.metrics
+        # Send times of the blocks still waiting for their ACK, oldest first
+        in_flight = collections.deque()
+
+        def watch():
+            cancel = 0
+            while True:
+                with cond:
+                    if state["failure"] or (state["finished"] and (window is None or state["acked"] == state["sent"])):
+                        return
+                char = self.reader.read(1, 0.05)
+                with cond:
+                    if char == ACK and window is not None:
+                        state["acked"] += 1
+                        state["progress"] = time.monotonic()
+                        cancel = 0
+                        if in_flight:
+                            rtt = state["progress"] - in_flight.popleft()
+                            metrics.observe("block_rtt", rtt)
+                            metrics.count("blocks")
+                            metrics.count("bytes", packet_size)
+                            metrics.event("block", block=state["acked"], size=packet_size, rtt=round(rtt, 6), retries=0)
+                    elif char == CAN and not cancel:
+                        self.logger.debug("[S] STATE: Ready for transmission cancellation")
+                        cancel = 1
+                    elif char in (CAN, NAK):
+                        state["failure"] = "received {!r}".format(char)
+                    elif char is not None:
+                        self.logger.error("[S] ERROR: Unexpected %r while streaming", char)
+                    elif window is not None and state["acked"] < state["sent"] and time.monotonic() - state["progress"] > timeout:
+                        state["failure"] = "no ACK within {}s".format(timeout)
+                    cond.notify_all()
+
+        watcher = threading.Thread(target=watch, daemon=True)
+        watcher.start()
+
+        sequence = self.resume_point["sequence"]
+        while True:
+            with cond:
+                while state["failure"] is None and window is not None and state["sent"] - state["acked"] >= window:
+                    cond.wait()
+                if state["failure"] is not None:
+                    break
+            frame = self._next_frame(stream, packet_size, sequence, crc_mode)
+            if frame is None:
+                self.logger.debug("[S] TRANSMISSION: Reached EOF")
+                break
+            sent_at = time.monotonic()
+            if window is not None:
+                with cond:
+                    in_flight.append(sent_at)
+            self.writer.write(frame)
+            with cond:
+                state["sent"] += 1
+                state["progress"] = time.monotonic()
+                sent, acked = state["sent"], state["acked"] if window is not None else state["sent"]
+            if window is None:
+                metrics.count("blocks")
+                metrics.count("bytes", packet_size)
+                metrics.event("block", block=sent, seq=sequence, size=packet_size, rtt=None, retries=0)
+            if trace:
+                self.logger.debug("[S] TRANSMISSION: block %d (seq=%d) streamed", sent, sequence)
+            if callable(callback):
+                callback(sent, acked, 0)
+            sequence = (sequence + 1) % 0x100
+
+        with cond:
+            state["finished"] = True
+            while state["failure"] is None and window is not None and state["acked"] < state["sent"]:
+                cond.wait()
+        watcher.join()
+        if window is None:
+            # Nothing is ACKed in YMODEM-g, and the receiver cancels on any error
+            self.resume_point = None
+        elif self.resume_point is not None:
+            self.resume_point["sequence"] = (self.resume_point["sequence"] + state["acked"]) % 0x100
+            self.resume_point["offset"] += state["acked"] * packet_size
+        if state["failure"] is not None:
+            metrics.count("stream_failures")
+            self.logger.error("[S] ERROR: Streaming stopped after %d blocks: %s", state["sent"], state["failure"])
+            return False
+        if window is not None and callable(callback):
+            callback(state["sent"], state["acked"], 0)
+        return True
+
+    def _fill_frame(self, packet_size, sequence, crc_mode, stream=None, data=b"", pad=b"\x1a"):
+        '''
+        Build a block in the preallocated frame for packet_size and return a
+        memoryview of it, ready to write. The payload is read straight from
+        stream with readinto, or copied from data, and padded with pad.
+        Returns None when stream is at EOF. The frame is reused by the next
+        call, so it must be written before another block is built.
+        '''
+        if packet_size not in self._frames:
+            frame = memoryview(bytearray(3 + packet_size + 2))
+            self._frames[packet_size] = (frame, frame[3:3 + packet_size])
+        frame, payload = self._frames[packet_size]
+
+        if stream is not None:
+            length = self._readinto(stream, payload)
+            if not length:
+                return None
         else:
-            crc = self.calc_checksum(data)
-            _bytes.append(crc)
-        return bytearray(_bytes)
+            length = len(data)
+            payload[:length] = data
+        if length < packet_size:
+            payload[length:] = pad * (packet_size - length)
+
+        frame[0] = ord(SOH) if packet_size == 128 else ord(STX)
+        frame[1] = sequence
+        frame[2] = 0xff - sequence
+        if crc_mode:
+            crc = self.calc_crc(payload)
+            frame[3 + packet_size] = crc >> 8
+            frame[4 + packet_size] = crc & 0xff
+            return frame[:5 + packet_size]
+        frame[3 + packet_size] = self.calc_checksum(payload)
+        return frame[:4 + packet_size]
+
+    def _next_frame(self, stream, packet_size, sequence, crc_mode):
+        # A prepared image hands out finished frames, other streams are framed here
+        if isinstance(stream, ImageStream):
+            return stream.next_frame(self, packet_size, sequence, crc_mode)
+        return self._fill_frame(packet_size, sequence, crc_mode, stream=stream)
+
+    @staticmethod
+    def _readinto(stream, buffer):
+        if not hasattr(stream, "readinto"):
+            data = stream.read(len(buffer))
+            buffer[:len(data)] = data
+            return len(data)
+        total = 0
+        while total < len(buffer):
+            count = stream.readinto(buffer[total:])
+            if not count:
+                break
+            total += count
+        return total
 
-    def recv(self, stream, crc_mode=1, retry=10, timeout=10, delay=1, quiet=0, callback=None, info=None):
+    def recv(self, stream, crc_mode=1, retry=10, timeout=10, delay=1, quiet=0, callback=None, info=None, streaming=0):
+        '''
+        streaming: request YMODEM-g (G) instead of CRC mode when the program
+        allows it. Blocks are then not acknowledged and any broken block
+        cancels the transfer.
+
+        Incoming bytes go through a FrameBuffer: each block is read as one
+        chunk, checked in place and its payload written to stream as a
+        memoryview.
+        '''
+        streaming = streaming and crc_mode and (self.ymodem_flags & ALLOW_YMODEMG)
         self._recv_file_name = ""
         self._remaining_data_length = 0
         self._recv_file_mtime = 0
         self._recv_mode = 0
         self._recv_sn = 0
+        frames = FrameBuffer(self.reader)
+        trace = self.logger.isEnabledFor(logging.DEBUG)
+        metrics = self.metrics
 
         '''
         Parse the first package of YMODEM Batch Transmission to get the target file information
         '''
         if self.mode.startswith("ymodem"):
-            error_count = 0
-            char = 0
-            cancel = 0
-            while True:
-                if error_count >= retry:
-                    self.logger.info("[R] ERROR: error_count reached {}, aborting...".format(retry))
-                    self.abort(timeout=timeout)
-                    return None
-                elif crc_mode and error_count < (retry // 2):
-                    if not self.writer.write(CRC):
-                        self.logger.debug("[R] ERROR: Write failed, sleeping for {}".format(delay))
-                        time.sleep(delay)
-                        error_count += 1
-                else:
-                    crc_mode = 0
-                    if not self.writer.write(NAK):
-                        self.logger.debug("[R] ERROR: Write failed, sleeping for {}".format(delay))
-                        time.sleep(delay)
-                        error_count += 1
-
-                char = self.reader.read(1, timeout=3)
-                if char is None:
-                    self.logger.warning("[R] ERROR: Read timeout in info block")
-                    error_count += 1
-                    continue
-                elif char == SOH:
-                    self.logger.debug("[R] STATE: Received valid header (SOH)")
-                    break
-                elif char == STX:
-                    self.logger.debug("[R] STATE: Received valid header (STX)")
-                    break
-                elif char == CAN:
-                    if cancel:
-                        self.logger.info("[R] TRANSMISSION: Cancelled (Received 2 CANs at info block)")
-                        return None
-                    else:
-                        self.logger.debug("[R] STATE: Ready for transmission cancellation")
-                        cancel = 1
-                else:
-                    error_count += 1
+            char, crc_mode, streaming = self._recv_request(frames, crc_mode, streaming, retry, delay, "info block")
+            if char is None:
+                return None
 
             error_count = 0
-            packet_size = 128
             cancel = 0
             while True:
-                while True:
-                    if char == SOH:
-                        if packet_size != 128:
-                            self.logger.debug("[R] STATE: Set 128 bytes for packet_size")
-                            packet_size = 128
-                        break
-                    elif char == STX:
-                        if packet_size != 1024:
-                            self.logger.debug("[R] STATE: Set 1024 bytes for packet_size")
-                            packet_size = 1024
-                        break
-                    elif char == CAN:
-                        if cancel:
-                            self.logger.info("[R] TRANSMISSION: Cancelled (Received 2 CANs at info block)")
-                            return None
-                        else:
-                            self.logger.debug("[R] STATE: Ready for transmission cancellation")
-                            cancel = 1
-                    else:
-                        err_msg = ("[R] ERROR: Expected SOH, EOT but got {0!r}".format(char))
-                        if not quiet:
-                            print(err_msg, file=sys.stderr)
-                        self.logger.warning(err_msg)
-                        error_count += 1
-                        if error_count > retry:
-                            self.logger.info("[R] ERROR: error_count reached %d, aborting...".format(retry))
-                            self.abort()
-                            return None
-                
-                self.logger.debug('[R] STATE: Preparing for data packets....')
-                error_count = 0
-                cancel = 0
-                seq1 = self.reader.read(1, timeout)
-                if seq1 is None:
-                    self.logger.warning("[R] WARN: Read failed to get first sequence byte")
-                    seq2 = None
-                else:
-                    seq1 = ord(seq1)
-                    seq2 = self.reader.read(1, timeout)
-                    if seq2 is None:
-                        self.logger.warning("[R] WARN: Read failed to get second sequence byte")
-                    else:
-                        seq2 = 0xff - ord(seq2)
-
-                if not (seq1 == seq2 == 0):
-                    self.logger.error("[R] ERROR: expected seq=0, got (seq1=%r, seq2=%r), receiving next block...", seq1, seq2)
-                    self.reader.read(packet_size + 1 + crc_mode)
-                else:
-                    print("crc mode" + str(crc_mode))
-                    data = self.reader.read(packet_size + 1 + crc_mode, timeout)
-                    valid, data = self._verify_recv_checksum(crc_mode, data)
-
-                    if valid:
-                        data = data.lstrip(b"\x00")
+                if char in (SOH, STX):
+                    self.logger.debug('[R] STATE: Preparing for data packets....')
+                    cancel = 0
+                    sequence, data = self._recv_block(frames, char, crc_mode, timeout)
+                    if data is not None and sequence == 0:
+                        data = bytes(data).lstrip(b"\x00")
                         self._recv_file_name = bytes.decode(data.split(b"\x00")[0], "utf-8")
                         self.logger.debug("[R] TRANSMISSION: File - {}".format(self._recv_file_name))
 
                         try:
                             stream = open(os.path.join(info["save_path"], self._recv_file_name), "wb+")
                         except IOError as e:
-                            stream.close()
                             self.logger.error("[R] ERROR: Cannot open save path")
                             return
-                        data = bytes.decode(data.split(b"\x00")[1], "utf-8")
-
-                        if self.ymodem_flags & USE_LENGTH_FIELD:
-                            space_index = data.find(" ")
-                            self._remaining_data_length = int(data if space_index == -1 else data[:space_index])
-                            self.logger.debug("[R] TRANSMISSION: Size - {} bytes".format(self._remaining_data_length))
-                            data = data[space_index + 1:]
-
-                        if self.ymodem_flags & USE_DATE_FIELD:
-                            space_index = data.find(" ")
-                            self._recv_file_mtime = int(data if space_index == -1 else data[:space_index], 8)
-                            self.logger.debug("[R] TRANSMISSION:  Mtime - {} seconds".format(self._recv_file_mtime))
-                            data = data[space_index + 1:]
-
-                        if self.ymodem_flags & USE_MODE_FIELD:
-                            space_index = data.find(" ")
-                            self._recv_mode = int(data if space_index == -1 else data[:space_index])
-                            self.logger.debug("[R] TRANSMISSION: Mode - {}".format(self._recv_mode))
-                            data = data[space_index + 1:]
-
-                        if self.ymodem_flags & USE_SN_FIELD:
-                            space_index = data.find(" ")
-                            self._recv_sn = int(data if space_index == -1 else data[:space_index])
-                            self.logger.debug("[R] TRANSMISSION: SN - {}".format(self._recv_sn))
+                        self._parse_info_fields(bytes.decode(data.split(b"\x00")[1], "utf-8"))
 
-                        self.writer.write(ACK)
+                        if not streaming:
+                            self.writer.write(ACK)
                         break
+                    elif data is not None:
+                        self.logger.error("[R] ERROR: expected seq=0, got seq=%r, receiving next block...", sequence)
+                elif char == CAN:
+                    if cancel:
+                        self.logger.info("[R] TRANSMISSION: Cancelled (Received 2 CANs at info block)")
+                        return None
+                    self.logger.debug("[R] STATE: Ready for transmission cancellation")
+                    cancel = 1
+                    char = frames.read_byte(timeout)
+                    continue
+                else:
+                    self._recv_unexpected(char, quiet)
 
+                error_count += 1
+                if error_count > retry:
+                    self.logger.info("[R] ERROR: error_count reached {}, aborting...".format(retry))
+                    self.abort(timeout=timeout)
+                    return None
                 self.logger.warning('[R] WARN: Purge, requesting retransmission (NAK)')
-                while True:
-                    data = self.reader.read(1, timeout=1)
-                    if data is None:
-                        break
+                frames.purge()
                 self.writer.write(NAK)
-                char = self.reader.read(1, timeout)
-                continue
+                char = frames.read_byte(timeout)
 
-        error_count = 0
-        char = 0
-        cancel = 0
-        while True:
-            if error_count >= retry:
-                self.logger.info("[R] ERROR: error_count reached %d, aborting...".format(retry))
-                self.abort(timeout=timeout)
-                return None
-            elif crc_mode and error_count < (retry // 2):
-                if not self.writer.write(CRC):
-                    self.logger.debug("[R] ERROR: Write failed, sleeping for {}".format(delay))
-                    time.sleep(delay)
-                    error_count += 1
-            else:
-                crc_mode = 0
-                if not self.writer.write(NAK):
-                    self.logger.debug("[R] ERROR: Write failed, sleeping for {}".format(delay))
-                    time.sleep(delay)
-                    error_count += 1
+        char, crc_mode, streaming = self._recv_request(frames, crc_mode, streaming, retry, delay, "data block")
+        if char is None:
+            return None
 
-            char = self.reader.read(1, timeout=3)
-            if char is None:
-                self.logger.warning("[R] WARN: Read timeout in start sequence")
-                error_count += 1
-                continue
-            elif char == SOH:
-                self.logger.debug("[R] STATE: Received valid header (SOH)")
-                break
-            elif char == STX:
-                self.logger.debug("[R] STATE: Received valid header (STX)")
-                break
-            elif char == CAN:
-                if cancel:
-                    self.logger.info("[R] TRANSMISSION: Cancelled (Received 2 CANs at data block)")
-                    return None
-                else:
-                    self.logger.debug("[R] STATE: Ready for transmission cancellation")
-                    cancel = 1
-            else:
-                error_count += 1
-                
         error_count = 0
         success_count = 0
         income_size = 0
-        packet_size = 128
         sequence = 1
         cancel = 0
         while True:
-            while True:
-                if char == SOH:
-                    if packet_size != 128:
-                        self.logger.debug("[R] STATE: Set 128 bytes for packet_size")
-                        packet_size = 128
-                    break
-                elif char == STX:
-                    if packet_size != 1024:
-                        self.logger.debug("[R] STATE: Set 1024 bytes for packet_size")
-                        packet_size = 1024
-                    break
-                elif char == EOT:
-                    self.writer.write(ACK)
-                    self.logger.info("[R] TRANSMISSION: Finished (%d bytes received)", income_size)
-                    return income_size
-                elif char == CAN:
-                    if cancel:
-                        self.logger.info("[R] TRANSMISSION: Cancelled: Received 2xCAN at data block {} (seq={})".format(success_count, sequence))
-                        return None
-                    else:
-                        self.logger.debug("[R] STATE: Ready for transmission cancellation at data block {} (seq={})".format(success_count, sequence))
-                        cancel = 1
-                else:
-                    err_msg = ("[R] ERROR: Expected SOH, EOT but got {0!r}".format(char))
-                    if not quiet:
-                        print(err_msg, file=sys.stderr)
-                    self.logger.warning(err_msg)
-                    error_count += 1
-                    if error_count > retry:
-                        self.logger.info("[R] ERROR: error_count reached {}, aborting...".format(retry))
-                        self.abort()
-                        return None
-
-            seq1 = self.reader.read(1, timeout)
-            if seq1 is None:
-                self.logger.warning("[R] WARN: Read failed to get first sequence byte")
-                seq2 = None
-            else:
-                seq1 = ord(seq1)
-                seq2 = self.reader.read(1, timeout)
-                if seq2 is None:
-                    self.logger.warning("[R] WARN: Read failed to get second sequence byte")
-                else:
-                    seq2 = 0xff - ord(seq2)
-
-            # Packet received in wrong number
-            if not (seq1 == seq2 == sequence):
-                self.logger.error("[R] ERROR: Expected seq=%d but got (seq1=%r, seq2=%r), receiving next block...", sequence, seq1, seq2)
-                self.reader.read(packet_size + 1 + crc_mode)
-            
-            # Packet received
-            else:
-                data = self.reader.read(packet_size + 1 + crc_mode, timeout)
-                valid, data = self._verify_recv_checksum(crc_mode, data)
+            if char in (SOH, STX):
+                cancel = 0
+                seq, data = self._recv_block(frames, char, crc_mode, timeout)
 
                 # Write the original data to the target file
-                if valid:
+                if data is not None and seq == sequence:
                     success_count += 1
-                    self.logger.debug('[R] TRANSMISSION: Data block %d (seq=%d) is valid', success_count, sequence)
+                    error_count = 0
+                    if trace:
+                        self.logger.debug('[R] TRANSMISSION: Data block %d (seq=%d) is valid', success_count, sequence)
 
-                    valid_length = packet_size
+                    valid_length = len(data)
 
                     # The last package adjusts the valid data length according to the file length
                     if (self._remaining_data_length > 0):
                         valid_length = min(valid_length, self._remaining_data_length)
                         self._remaining_data_length -= valid_length
-                    data = data[:valid_length]
 
-                    income_size += len(data)
-                    stream.write(data)
+                    income_size += valid_length
+                    stream.write(data[:valid_length])
+                    metrics.count("blocks")
+                    metrics.count("bytes", valid_length)
 
                     if callable(callback):
                         callback(income_size, self._remaining_data_length)
 
-                    self.writer.write(ACK)
+                    if not streaming:
+                        self.writer.write(ACK)
 
                     sequence = (sequence + 1) % 0x100
 
-                    char = self.reader.read(1, timeout)
+                    char = frames.read_byte(timeout)
                     continue
 
+                elif data is not None:
+                    self.logger.error("[R] ERROR: Expected seq=%d but got seq=%r, receiving next block...", sequence, seq)
+
+            elif char == EOT:
+                self.writer.write(ACK)
+                self.logger.info("[R] TRANSMISSION: Finished (%d bytes received)", income_size)
+                return income_size
+
+            elif char == CAN:
+                if cancel:
+                    self.logger.info("[R] TRANSMISSION: Cancelled: Received 2xCAN at data block {} (seq={})".format(success_count, sequence))
+                    return None
+                self.logger.debug("[R] STATE: Ready for transmission cancellation at data block {} (seq={})".format(success_count, sequence))
+                cancel = 1
+                char = frames.read_byte(timeout)
+                continue
+
+            else:
+                self._recv_unexpected(char, quiet)
+
             # Broken packet received
+            if streaming:
+                self.logger.error("[R] ERROR: Broken block while streaming, cancelling transmission")
+                self.abort(timeout=timeout)
+                return None
+            error_count += 1
+            if error_count > retry:
+                self.logger.info("[R] ERROR: error_count reached {}, aborting...".format(retry))
+                self.abort(timeout=timeout)
+                return None
             self.logger.warning("[R] ERROR: Purge, requesting retransmission (NAK)")
-            while True:
-                data = self.reader.read(1, timeout=1)
-                if data is None:
-                    break
+            metrics.count("retransmits")
+            frames.purge()
             self.writer.write(NAK)
-            char = self.reader.read(1, timeout)
-            continue
+            char = frames.read_byte(timeout)
+
+    def _recv_request(self, frames, crc_mode, streaming, retry, delay, where):
+        '''
+        Ask for a transfer (G, C or NAK) until a block header arrives.
+        Returns (header, crc_mode, streaming), header is None on failure.
+        '''
+        error_count = 0
+        cancel = 0
+        while True:
+            if error_count >= retry:
+                self.logger.info("[R] ERROR: error_count reached {}, aborting...".format(retry))
+                self.abort()
+                return None, crc_mode, streaming
+            elif crc_mode and error_count < (retry // 2):
+                if not self.writer.write(GEE if streaming else CRC):
+                    self.logger.debug("[R] ERROR: Write failed, sleeping for {}".format(delay))
+                    time.sleep(delay)
+                    error_count += 1
+            else:
+                crc_mode = 0
+                streaming = 0
+                if not self.writer.write(NAK):
+                    self.logger.debug("[R] ERROR: Write failed, sleeping for {}".format(delay))
+                    time.sleep(delay)
+                    error_count += 1
+
+            char = frames.read_byte(3)
+            if char is None:
+                self.logger.warning("[R] WARN: Read timeout in {}".format(where))
+                error_count += 1
+            elif char == SOH:
+                self.logger.debug("[R] STATE: Received valid header (SOH)")
+                return char, crc_mode, streaming
+            elif char == STX:
+                self.logger.debug("[R] STATE: Received valid header (STX)")
+                return char, crc_mode, streaming
+            elif char == CAN:
+                if cancel:
+                    self.logger.info("[R] TRANSMISSION: Cancelled (Received 2 CANs at {})".format(where))
+                    return None, crc_mode, streaming
+                self.logger.debug("[R] STATE: Ready for transmission cancellation")
+                cancel = 1
+            else:
+                error_count += 1
+
+    def _recv_block(self, frames, char, crc_mode, timeout):
+        '''
+        Read the rest of the block announced by char (SOH or STX).
+        Returns (sequence, payload view), the payload is None if the block
+        was incomplete or failed its sequence or checksum check.
+        '''
+        packet_size = 128 if char == SOH else 1024
+        block = frames.read(2 + packet_size + 1 + crc_mode, timeout)
+        if block is None:
+            self.logger.warning("[R] WARN: Read timeout in {} byte block".format(packet_size))
+            return None, None
+        sequence = block[0]
+        if sequence != 0xff - block[1]:
+            self.logger.error("[R] ERROR: Broken sequence (seq1=%r, seq2=%r)", block[0], 0xff - block[1])
+            return sequence, None
+        valid, data = self._verify_recv_checksum(crc_mode, block[2:])
+        return sequence, data if valid else None
+
+    def _recv_unexpected(self, char, quiet):
+        err_msg = ("[R] ERROR: Expected SOH, EOT but got {0!r}".format(char))
+        if not quiet:
+            print(err_msg, file=sys.stderr)
+        self.logger.warning(err_msg)
+
+    def _parse_info_fields(self, data):
+        if self.ymodem_flags & USE_LENGTH_FIELD and data:
+            space_index = data.find(" ")
+            self._remaining_data_length = int(data if space_index == -1 else data[:space_index])
+            self.logger.debug("[R] TRANSMISSION: Size - {} bytes".format(self._remaining_data_length))
+            data = data[space_index + 1:] if space_index != -1 else ""
+
+        if self.ymodem_flags & USE_DATE_FIELD and data:
+            space_index = data.find(" ")
+            self._recv_file_mtime = int(data if space_index == -1 else data[:space_index], 8)
+            self.logger.debug("[R] TRANSMISSION:  Mtime - {} seconds".format(self._recv_file_mtime))
+            data = data[space_index + 1:] if space_index != -1 else ""
+
+        if self.ymodem_flags & USE_MODE_FIELD and data:
+            space_index = data.find(" ")
+            self._recv_mode = int(data if space_index == -1 else data[:space_index])
+            self.logger.debug("[R] TRANSMISSION: Mode - {}".format(self._recv_mode))
+            data = data[space_index + 1:] if space_index != -1 else ""
+
+        if self.ymodem_flags & USE_SN_FIELD and data:
+            space_index = data.find(" ")
+            self._recv_sn = int(data if space_index == -1 else data[:space_index])
+            self.logger.debug("[R] TRANSMISSION: SN - {}".format(self._recv_sn))
 
     def _verify_recv_checksum(self, crc_mode, data):
         if crc_mode:
@@ -722,184 +1168,752 @@ class Modem(Protocol):
         0x6e17, 0x7e36, 0x4e55, 0x5e74, 0x2e93, 0x3eb2, 0x0ed1, 0x1ef0,
     ]
 
+    # Tables for slicing-by-4
+    crcslices = make_crc_slices(crctable, 4)
+
     # CRC-16-CCITT
     def calc_crc(self, data, crc=0):
+        return self._calc_crc(data, crc)
+
+    def calc_crc_native(self, data, crc=0):
+        return crc_hqx(data, crc)
+
+    def calc_crc_sliced(self, data, crc=0):
+        t0, t1, t2, t3 = self.crcslices
+        data = bytes(data)
+        tail = len(data) & 3
+        it = iter(data[:len(data) - tail])
+        for b0, b1, b2, b3 in zip(it, it, it, it):
+            crc = t3[(crc >> 8) ^ b0] ^ t2[(crc & 0xff) ^ b1] ^ t1[b2] ^ t0[b3]
+        for char in data[len(data) - tail:]:
+            crc = ((crc << 8) ^ t0[((crc >> 8) ^ char) & 0xff]) & 0xffff
+        return crc
+
+    def calc_crc_table(self, data, crc=0):
         for char in bytearray(data):
             crctbl_idx = ((crc >> 8) ^ char) & 0xff
             crc = ((crc << 8) ^ self.crctable[crctbl_idx]) & 0xffff
         return crc & 0xffff
+
 def usage():
-    print("Usage: %s -p <COM PORT>" % sys.argv[0])
+    print("Usage: %s -p <COM PORT> [-p <COM PORT> ...]" % sys.argv[0])
     print("       %s -f <ZIP FILE>" % sys.argv[0])
     print("       %s -t <TOOL NAME>" % sys.argv[0])
+    print("       %s -j <JOBS>" % sys.argv[0])
+    print("       %s --skip-unchanged" % sys.argv[0])
+    print("       %s --metrics=<FILE> --metrics-log=<FILE> -v" % sys.argv[0])
+    print("       %s --adaptive" % sys.argv[0])
     print("OPTIONS:")
+    print("    -p, may be given several times (or as a comma separated list) to flash all ports in parallel")
+    print("    -j, number of ports flashed at the same time in batch mode (default: all)")
+    print("    --skip-unchanged, do not upload when the device, identified by its AT+SN serial number or AT+DEVEUI,")
+    print("                      already runs the image; devices that cannot be identified are always flashed")
+    print("    --metrics, write timings, counters and block round trip histograms as a JSON summary to FILE")
+    print("    --metrics-log, append one JSON line per block and per upload to FILE")
+    print("    -v, log every protocol step and block (slow)")
+    print("    --adaptive, adapt the ACK timeout and block size to the link (default: 1K blocks, 10 s per ACK)")
     print("    --help, print information")
 
 def parse_arg(argv):
-    global com_port
+    global com_ports
     global zip_file
     global tool_name
+    global jobs
+    global skip_unchanged
+    global metrics_file
+    global metrics_log
+    global verbose
+    global adaptive
+    com_ports = []
+    zip_file = None
+    jobs = None
+    skip_unchanged = False
+    metrics_file = None
+    metrics_log = None
+    verbose = False
+    adaptive = False
     try:
-        opts, args = getopt(argv, "p:f:t:", ["help"])
+        opts, args = getopt(argv, "p:f:t:j:v", ["help", "skip-unchanged", "metrics=", "metrics-log=", "adaptive"])
         for opt, arg in opts:
-            if opt == '-h':
+            if opt in ('-h', '--help'):
                 usage()
                 sys.exit()
             elif opt == "-p":
-                com_port = arg
+                com_ports.extend(port for port in arg.split(",") if port)
             elif opt == "-f":
                 zip_file = arg
             elif opt == "-t":
                 tool_name = arg
+            elif opt == "-j":
+                jobs = int(arg)
+            elif opt == "--skip-unchanged":
+                skip_unchanged = True
+            elif opt == "--metrics":
+                metrics_file = arg
+            elif opt == "--metrics-log":
+                metrics_log = arg
+            elif opt == "-v":
+                verbose = True
+            elif opt == "--adaptive":
+                adaptive = True
             else:
-                Usage()
+                usage()
                 sys.exit(1)
-    except getopt.GetoptError:
+    except (GetoptError, ValueError):
         print("Error: GetoptError!")
         usage()
         sys.exit(1)
+    if not com_ports or not zip_file:
+        usage()
+        sys.exit(1)
 
-def enter_dfu_mode():
-    global boot_mode
-    if not boot_mode:
-        if not check_boot_mode():
-            upload_fail("Device do not enter boot mode")
-    data = b""  
-    ser = serial.Serial(port=com_port, baudrate=default_baudrate, timeout=5)
-    if boot_mode:
-        ser.write(b"at+update\r\n")
-    else:
-        upload_fail("enter dfu mode fail")
-    while (ser.in_waiting):
-        ser.read(1)
-    sleep(1)
-    def getc(size, timeout=1):
-        data = ser.read(size)
-        return data or None
-    def putc(data, timeout=1):
-        return ser.write(data)
-    sender = Modem(getc, putc,mode="ymodem1k")
-    file_stream = open(zip_file, 'rb')
-    file_info = {
-            "name"      :   os.path.basename(zip_file),
-            "abs_path"  :   os.path.abspath(zip_file),
-            "length"    :   os.path.getsize(zip_file),
-            "mtime"     :   os.path.getmtime(zip_file),
-            "source"    :   "win"
-        }
-    if not sender.send(file_stream,info = file_info):
-        upload_fail("Upload Failed")
-    sleep(1)
-    file_stream.close()
-    ser.close()
+class UploadError(Exception):
+    pass
+
+# Flash layout of the RAK3172 from flash_stm32wle5xx.ld: the application is
+# linked behind the 24K bootloader, boards.txt caps upload.maximum_size at ROM
+app_origin = 0x08006000
+app_size = 196 * 1024
+ram_origin = 0x20000000
+ram_size = 64 * 1024
+
+class FirmwareImage(object):
+    '''
+    An image read once and checked before any port is touched. Frames for a
+    packet size and CRC mode are built on first use and kept, so sessions
+    flashing the same image in parallel share them and their transfer loops
+    only write bytes. data may be given instead of reading path.
+    '''
+    def __init__(self, path, data=None, max_size=app_size):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.max_size = max_size
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+            self.mtime = os.path.getmtime(path)
+        else:
+            self.mtime = time.time()
+        self.data = bytes(data)
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        self.md5_verified = None
+        self.validated = False
+        self.lock = threading.Lock()
+        self._frames = {}
+
+    def __len__(self):
+        return len(self.data)
+
+    def _md5_path(self):
+        # The prebuilt images ship as name.bin next to name.md5
+        root, ext = os.path.splitext(self.path)
+        for path in (root + ".md5", self.path + ".md5"):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def validate(self):
+        '''
+        Check the image fits the application flash, that its vector table
+        points into RAM and flash, and that it matches the .md5 next to it
+        when there is one. Raises UploadError on the first failed check.
+        '''
+        if self.validated:
+            return
+        if len(self.data) < 8:
+            raise UploadError("Image {} is empty or truncated ({} bytes)".format(self.name, len(self.data)))
+        if len(self.data) > self.max_size:
+            raise UploadError("Image {} is {} bytes, larger than the {} bytes of application flash".format(
+                self.name, len(self.data), self.max_size))
+        stack, reset = struct.unpack_from("<II", self.data)
+        if not ram_origin < stack <= ram_origin + ram_size:
+            raise UploadError("Image {} is not an application image: initial stack pointer 0x{:08x} is outside RAM".format(
+                self.name, stack))
+        if not reset & 1 or not app_origin <= reset < app_origin + self.max_size:
+            raise UploadError("Image {} is not linked for 0x{:08x}: reset vector is 0x{:08x}".format(
+                self.name, app_origin, reset))
+        md5_path = self._md5_path()
+        if md5_path is not None:
+            with open(md5_path) as f:
+                fields = f.read().split()
+            expected = fields[0].lower() if fields else ""
+            if expected != self.md5:
+                raise UploadError("Image {} does not match {}: md5 is {}, expected {}".format(
+                    self.name, os.path.basename(md5_path), self.md5, expected or "nothing"))
+            self.md5_verified = True
+        self.validated = True
+
+    def frames(self, modem, packet_size, crc_mode):
+        '''
+        All data frames for packet_size and crc_mode, numbered from
+        sequence 1 as Modem.send sends them. Built with modem on first use.
+        '''
+        key = (packet_size, bool(crc_mode))
+        with self.lock:
+            frames = self._frames.get(key)
+            if frames is None:
+                stream = io.BytesIO(self.data)
+                frames = []
+                sequence = 1
+                while True:
+                    frame = modem._fill_frame(packet_size, sequence, crc_mode, stream=stream)
+                    if frame is None:
+                        break
+                    frames.append(bytes(frame))
+                    sequence = (sequence + 1) % 0x100
+                self._frames[key] = frames
+        return frames
+
+    def open(self):
+        return ImageStream(self)
+
+class ImageStream(io.BytesIO):
+    '''
+    A read position in a FirmwareImage. Modem.send takes whole prepared
+    frames from it; it falls back to framing the block when the offset is
+    not on a packet_size boundary, as after the block size changed.
+    '''
+    def __init__(self, image):
+        super(ImageStream, self).__init__(image.data)
+        self.image = image
+
+    def next_frame(self, modem, packet_size, sequence, crc_mode):
+        offset = self.tell()
+        if offset % packet_size:
+            return modem._fill_frame(packet_size, sequence, crc_mode, stream=self)
+        frames = self.image.frames(modem, packet_size, crc_mode)
+        index = offset // packet_size
+        if index >= len(frames):
+            return None
+        self.seek(min(offset + packet_size, len(self.image.data)))
+        frame = frames[index]
+        if frame[1] != sequence:
+            # The CRC only covers the payload, so renumbering keeps it valid
+            frame = bytes((frame[0], sequence, 0xff - sequence)) + frame[3:]
+        return frame
+
+class PortSession(object):
+    '''
+    One serial handle shared by every step of an upload. The port is opened
+    on first use; later requests for another baud rate change it in place
+    with ser.baudrate instead of closing and reopening the port, which
+    takes hundreds of milliseconds on some USB-UART drivers.
+
+    reuse=False closes and reopens the port on every request like the
+    uploader used to, for comparison.
+    '''
+    def __init__(self, open_serial, metrics=None, reuse=True):
+        self.open_serial = open_serial
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.reuse = reuse
+        self.ser = None
+
+    def get(self, baudrate, timeout=5):
+        if self.ser is not None and not self.reuse:
+            self.close()
+        if self.ser is None or not self.ser.is_open:
+            start = time.monotonic()
+            self.ser = self.open_serial(baudrate, timeout)
+            self.metrics.timing("port_open", time.monotonic() - start)
+            self.metrics.count("port_opens")
+            return self.ser
+        if self.ser.baudrate != baudrate:
+            start = time.monotonic()
+            self.ser.baudrate = baudrate
+            self.metrics.timing("baud_switch", time.monotonic() - start)
+            self.metrics.count("baud_switches")
+        self.ser.timeout = timeout
+        return self.ser
+
+    def close(self):
+        if self.ser is not None:
+            try:
+                close_serial(self.ser)
+            except serial.SerialException:
+                pass
+            self.ser = None
+
+class UploadSession(object):
+    '''
+    One upload of an image to the device on one port. All state lives in the
+    session, so sessions for different ports can run in parallel threads.
+    image is a path or a FirmwareImage, which sessions flashing the same
+    image share. callback is handed to Modem.send and receives its block
+    progress. Timings, counters and block round trips are collected in metrics, whose
+    JSON lines go to events when given.
+    '''
+    def __init__(self, port, image, callback=None, out=None, skip_unchanged=False, events=None, adaptive=False):
+        self.port = port
+        self.firmware = image if isinstance(image, FirmwareImage) else None
+        self.image = image.path if self.firmware is not None else image
+        self.callback = callback
+        self.out = out or sys.stdout
+        self.skip_unchanged = skip_unchanged
+        self.adaptive = adaptive
+        self.skipped = False
+        self.boot_mode = 0
+        self.baudrate = None
+        self.device_id = None
+        self.metrics = Metrics(events, port=port)
+        self.port_session = PortSession(lambda baudrate, timeout: self.open_serial(baudrate, timeout), self.metrics)
+
+    def _print(self, *args, **kwargs):
+        kwargs.setdefault("file", self.out)
+        print(*args, **kwargs)
+
+    def open_serial(self, baudrate, timeout=5):
+        # serial_for_url also accepts URLs such as rfc2217:// or socket:// for remote ports
+        return serial.serial_for_url(self.port, baudrate=baudrate, timeout=timeout)
+
+    def serial(self, baudrate, timeout=5):
+        # The port handle shared by all steps, see PortSession
+        return self.port_session.get(baudrate, timeout)
+
+    def upload(self):
+        start = time.monotonic()
+        error = None
+        try:
+            self._upload()
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            self.port_session.close()
+            self.metrics.timing("total", time.monotonic() - start)
+            self.metrics.event("summary", ok=error is None, error=error, skipped=self.skipped, **self.metrics.summary())
+
+    def prepare(self):
+        # Load and check the image once, before the device is touched
+        if self.firmware is None:
+            self.firmware = FirmwareImage(self.image)
+        self.firmware.validate()
+        return self.firmware
+
+    def _upload(self):
+        phase_start = time.monotonic()
+        firmware = self.prepare()
+        self.metrics.timing("prepare", time.monotonic() - phase_start)
+        phase_start = time.monotonic()
+        in_boot_mode = self.check_boot_mode()
+        self.metrics.timing("boot_mode_check", time.monotonic() - phase_start)
+        if not in_boot_mode:
+            phase_start = time.monotonic()
+            try:
+                self.detect_baudrate()
+            finally:
+                self.metrics.timing("baud_detection", time.monotonic() - phase_start)
+            self.device_id = self.query_device_id()
+            if self.skip_unchanged and self.is_unchanged():
+                self._print("{} already runs this image, skipping upload".format(self.device_id))
+                self.skipped = True
+                return
+            self.enter_boot_mode()
+        if self.skip_unchanged and self.device_id is None:
+            self._print("Device cannot be identified, uploading")
+        self.enter_dfu_mode()
+        self.save_last_upload()
+
+    def query_device_id(self):
+        '''
+        Identify the device on its AT console: its serial number (AT+SN) or,
+        when that is not set, its DevEUI (AT+DEVEUI). Returns "sn:<serial>"
+        or "deveui:<eui>", or None when the device gives neither.
+        '''
+        console = self.console(self.serial(self.baudrate))
+        for command, name in ((b"at+sn=?\r\n", "sn"), (b"at+deveui=?\r\n", "deveui")):
+            matched, data = console.command(command, (b"OK\r\n", b"ERROR", b"NO_SUPPORT"), 0.5)
+            match = re.search(rb"AT\+(?:SN|DEVEUI)=([^\r\n]*)", data, re.I)
+            if matched != b"OK\r\n" or match is None:
+                continue
+            # Unprogrammed NVM reads back as 0x00 or 0xff bytes, an unset DevEUI as zeros
+            value = match.group(1).strip(b"\x00\xff \t")
+            if value and value.strip(b"0") and all(0x20 < char < 0x7f for char in value):
+                return "{}:{}".format(name, value.decode("ascii"))
+        return None
+
+    def is_unchanged(self):
+        '''
+        Whether the image is the one last uploaded to this device, by the
+        MD5 recorded after that upload. False when the device is unknown.
+        '''
+        if self.device_id is None:
+            return False
+        return load_last_upload_cache().get(self.device_id) == self.prepare().md5
+
+    def save_last_upload(self):
+        if self.device_id is not None:
+            save_last_upload_cache(self.device_id, self.prepare().md5)
+
+    def enter_dfu_mode(self, attempts=3):
+        '''
+        Transfer the image, trying up to attempts times. A transfer that broke
+        off in its data phase is first resumed from the last ACKed block. The
+        port stays open between attempts unless it failed, then it is opened
+        again. When the bootloader does not take the resumed
+        block, the transfer restarts with at+update; the device is known to
+        be in boot mode by then, so boot mode and baud rate detection are
+        not repeated.
+        '''
+        if not self.boot_mode:
+            if not self.check_boot_mode():
+                raise UploadError("Device do not enter boot mode")
+        firmware = self.prepare()
+        resume_point = None
+        error = "Upload Failed"
+        with firmware.open() as file_stream:
+            for attempt in range(attempts):
+                last = attempt == attempts - 1
+                if attempt:
+                    self._print("{}, retrying ({}/{})".format(error, attempt, attempts - 1))
+                    self.metrics.count("retries")
+                sender = None
+                try:
+                    ser = self.serial(default_baudrate)
+                    ser.reset_input_buffer()
+                    if resume_point is not None:
+                        self._print("Resuming upload at byte {}".format(resume_point["offset"]))
+                        self.metrics.count("resumes")
+                        sender = self._make_modem(ser)
+                        sender.resume_point = resume_point
+                        ok = sender.resume(file_stream, callback=self.callback, cancel=last, adaptive=self.adaptive)
+                        if not ok and not last:
+                            # The bootloader did not take it, start over
+                            sender.abort()
+                            sender.resume_point = None
+                    else:
+                        ser.write(b"at+update\r\n")
+                        sender = self._make_modem(ser, wait_mode_request(ser))
+                        file_info = {
+                                "name"      :   firmware.name,
+                                "abs_path"  :   os.path.abspath(firmware.path),
+                                "length"    :   len(firmware),
+                                "mtime"     :   firmware.mtime,
+                                "source"    :   "win"
+                            }
+                        file_stream.seek(0)
+                        ok = sender.send(file_stream, info=file_info, callback=self.callback, cancel=last, adaptive=self.adaptive)
+                    if ok:
+                        return
+                    error = "Upload Failed"
+                except serial.SerialException as e:
+                    self.port_session.close()
+                    if last:
+                        raise UploadError("Upload Failed: {}".format(e))
+                    error = "Upload Failed: {}".format(e)
+                resume_point = sender.resume_point if sender is not None else None
+        raise UploadError(error)
+
+    def _make_modem(self, ser, pending=b""):
+        # pending holds bytes already taken from ser, returned before reading it again
+        pending = bytearray(pending)
+        def getc(size, timeout=5):
+            if pending:
+                data = bytes(pending[:size])
+                del pending[:size]
+                return data
+            if ser.timeout != timeout:
+                ser.timeout = timeout
+            data = ser.read(size)
+            return data or None
+        def putc(data, timeout=1):
+            return ser.write(data)
+        return Modem(getc, putc,mode="ymodem1k", metrics=self.metrics)
+
+    def detect_baudrate(self):
+        test_baudrate = [
+            115200,
+            9600,
+            921600,
+            57600,
+            38400,
+            19200,
+            230400,
+            460800,
+            76800,
+            56000,
+            31250,
+            28800,
+            14400,
+            4800,
+            250000,
+            1000000,
+            2400,
+            1200]
+        # Try the rate that worked last time on this port first
+        cached = load_baudrate_cache().get(self.port)
+        if cached in test_baudrate:
+            test_baudrate.remove(cached)
+            test_baudrate.insert(0, cached)
+        self._print("Detecting baudrate", end="",flush=True)
+        for i in test_baudrate:
+            self._print(".",end="",flush=True)
+            ser = self.serial(i)
+            ser.reset_input_buffer()
+            ser.reset_output_buffer()
+            ser.write(b'\r\n')
+            ser.write(b'\r\n')
+            sleep(0.1)
+            console = self.console(ser)
+            matched, data = console.command(b'at\r\n', (b"OK\r\n", b"AT_ERROR"), 0.5)
+            if matched is not None:
+                if ask_ok(ser, console=console):
+                    self._print()
+                    save_baudrate_cache(self.port, i)
+                    self.baudrate = i
+                    return
+        self._print()
+        raise UploadError("Detect baudrate fail, can not get the baudrate")
+
+    def enter_boot_mode(self):
+        # From the application, at the rate found by detect_baudrate
+        self._print("Entering boot mode")
+        self.serial(self.baudrate).write(b'at+boot\r\n')
+        sleep(1)
+
+    def console(self, ser):
+        return ATConsole(ser, self.metrics)
+
+    def check_boot_mode(self, attempts=2, timeout=1.0):
+        '''
+        The bootloader answers unknown commands with "AT not support", the
+        application with AT_ERROR. The first command may only wake the
+        device up, so it is sent up to attempts times.
+        '''
+        ser = self.serial(default_baudrate)
+        ser.reset_input_buffer()
+        console = self.console(ser)
+        for _ in range(attempts):
+            matched, data = console.command(b"at+\r\n", (b"AT not support", b"AT_ERROR", b"OK\r\n"), timeout)
+            if matched is not None:
+                break
+        if matched == b"AT not support":
+            self.boot_mode = 1
+            self._print("Device is in boot mode")
+            return True
+        self._print("Device is not in boot mode")
+        return False
+
+def wait_mode_request(ser, timeout=5):
+    '''
+    Skip the console output that follows at+update until the bootloader
+    sends its first mode request (C or NAK). Returns that byte so it can be
+    handed to the Modem, or b"" when nothing arrived within timeout.
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return b""
+        ser.timeout = remaining
+        char = ser.read(1)
+        if char in (CRC, NAK):
+            return char
 
 def close_serial(ser):
     ser.reset_input_buffer()
     ser.reset_output_buffer()
     ser.close()
 
-def ask_ok(ser,times=10):
-    i=0
-    data = b""
-    while(b"OK\r\n" not in data):
-        ser.write(b'a')
-        sleep(0.5)
-        ser.write(b't')
-        sleep(0.5)
-        ser.write(b'\r')
-        sleep(0.5)
-        ser.write(b'\n')
-        sleep(0.5)
-        data = b""
-        while (ser.in_waiting):
-            data  += ser.read(1)
-        if i == times:
-            return False
-        i+=1
-    return True
+def ask_ok(ser, times=10, timeout=0.5, console=None):
+    '''
+    Send at until the device answers OK, at most times + 1 tries.
+    '''
+    console = console or ATConsole(ser)
+    for _ in range(times + 1):
+        matched, data = console.command(b"at\r\n", (b"OK\r\n",), timeout)
+        if matched is not None:
+            return True
+    return False
+
+class ATConsole(object):
+    '''
+    Expect-style access to the AT console on ser. Commands are written in
+    one piece and the replies read as they arrive, so a step returns as
+    soon as one of its patterns shows up instead of after a fixed sleep.
+    Bytes after a match stay buffered for the next expect().
+
+    Every command() is kept in steps with its reply latency, and recorded
+    in metrics as the at_response histogram and an "at" event.
+    '''
+    def __init__(self, ser, metrics=None):
+        self.ser = ser
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.buffer = b""
+        self.steps = []
+
+    def expect(self, patterns, timeout):
+        '''
+        Read until one of patterns shows up or timeout expires. Returns the
+        earliest matching pattern (None on timeout) and the text read up to
+        and including it.
+        '''
+        deadline = time.monotonic() + timeout
+        while True:
+            found = [(self.buffer.find(pattern), pattern) for pattern in patterns]
+            found = [(index, pattern) for index, pattern in found if index != -1]
+            if found:
+                index, pattern = min(found, key=lambda item: item[0])
+                end = index + len(pattern)
+                data, self.buffer = self.buffer[:end], self.buffer[end:]
+                return pattern, data
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                data, self.buffer = self.buffer, b""
+                return None, data
+            self.ser.timeout = remaining
+            self.buffer += self.ser.read(max(1, self.ser.in_waiting))
+
+    def command(self, command, patterns, timeout):
+        start = time.monotonic()
+        self.ser.write(command)
+        matched, data = self.expect(patterns, timeout)
+        latency = time.monotonic() - start
+        name = command.decode("ascii", "replace").strip()
+        self.steps.append(dict(command=name, matched=matched, latency=latency))
+        if matched is not None:
+            self.metrics.observe("at_response", latency)
+        self.metrics.event("at", command=name, latency=round(latency, 6),
+            matched=matched.decode("ascii", "replace").strip() if matched is not None else None)
+        return matched, data
+
+def load_baudrate_cache():
+    try:
+        with open(baudrate_cache) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_baudrate_cache(port, baudrate):
+    # Sessions on other ports may save at the same time
+    with cache_lock:
+        cache = load_baudrate_cache()
+        cache[port] = baudrate
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(baudrate_cache, "w") as f:
+                json.dump(cache, f)
+        except (IOError, OSError):
+            pass
 
+def load_last_upload_cache():
+    try:
+        with open(last_upload_cache) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_last_upload_cache(device_id, md5):
+    # Sessions on other ports may save at the same time
+    with cache_lock:
+        cache = load_last_upload_cache()
+        cache[device_id] = md5
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(last_upload_cache, "w") as f:
+                json.dump(cache, f)
+        except (IOError, OSError):
+            pass
 
 def upload_fail(res):
     print(res)
-    sys.exit()
-
-def detect_baudrate():
-    test_baudrate = [
-        115200,
-        9600,
-        921600,
-        57600,
-        38400,
-        19200,
-        230400,
-        460800,
-        76800,
-        56000,
-        31250,
-        28800,
-        14400,
-        4800,
-        250000,
-        1000000,
-        2400,
-        1200]
-    print("Detecting baudrate", end="",flush=True)
-    for i in test_baudrate:
-        print(".",end="",flush=True)
-        ser = serial.Serial(port=com_port, baudrate=i, timeout=5)
-        ser.reset_input_buffer()
-        ser.reset_output_buffer()
-        ser.write(b'\r\n')
-        ser.write(b'\r\n')
-        sleep(0.5)
-        ser.write(b'at\r\n')
-        sleep(2)
-        data = b""
-        while (ser.in_waiting):
-            data += ser.read(1)
-        if b"OK\r\n" in data or b"AT_ERROR" in data:
-            if ask_ok(ser):
-                print()
-                print("Entering boot mode")
-                ser.write(b'at+boot\r\n')
-                sleep(1)
-                close_serial(ser)
-                return
-        close_serial(ser)
-    upload_fail("Detect baudrate fail, can not get the baudrate")
-
-def check_boot_mode():
-    ser = serial.Serial(port=com_port, baudrate=default_baudrate, timeout=5)
-    ser.write(b'a')
-    sleep(0.5)
-    ser.write(b't')
-    sleep(0.5)
-    ser.write(b'+')
-    sleep(0.5)
-    ser.write(b'\r')
-    sleep(0.5)
-    ser.write(b'\n')
-    sleep(0.5)
-
-    ser.write(b'at+\r\n')
-    sleep(2)
-    data = b""
-    while (ser.in_waiting):
-        data += ser.read(1)
-    if b"AT not support" in data:
-        global boot_mode
-        boot_mode = 1
-        close_serial(ser)
-        print("Device is in boot mode")
-        return True
-    close_serial(ser)
-    print("Device is not in boot mode")
-    return False
-
-parse_arg(sys.argv[1:])
-if not check_boot_mode():
-    detect_baudrate()
-enter_dfu_mode()
-print("Upgrade Complete")
+    sys.exit(1)
+
+def upload_batch(ports, image, jobs=None, out=None, skip_unchanged=False, events=None, adaptive=False):
+    '''
+    Flash image to every port in parallel, one UploadSession per port, and
+    print per-port progress followed by a pass/fail and throughput report.
+    Returns one result dict per port, including its metrics summary.
+    image is loaded and validated once and shared by all sessions.
+    '''
+    out = out or sys.stdout
+    if not isinstance(image, FirmwareImage):
+        image = FirmwareImage(image)
+    image.validate()
+    length = len(image)
+    blocks = max(1, (length + 1023) // 1024)
+    print_lock = threading.Lock()
+
+    def report(port, message):
+        with print_lock:
+            print("[{}] {}".format(port, message), file=out, flush=True)
+
+    def flash(port):
+        steps = [0]
+        def callback(total_packets, success_count, error_count):
+            step = success_count * 10 // blocks
+            if step > steps[0]:
+                steps[0] = step
+                report(port, "{:3d}% ({} blocks, {} errors)".format(step * 10, success_count, error_count))
+        session = UploadSession(port, image, callback=callback, out=io.StringIO(), skip_unchanged=skip_unchanged, events=events, adaptive=adaptive)
+        result = dict(port=port, ok=False, error=None, elapsed=0.0)
+        start = time.monotonic()
+        try:
+            session.upload()
+            result["ok"] = True
+        except (UploadError, serial.SerialException, OSError) as e:
+            result["error"] = str(e)
+        result["elapsed"] = time.monotonic() - start
+        result["skipped"] = session.skipped
+        result["metrics"] = session.metrics.summary()
+        if session.skipped:
+            report(port, "SKIPPED ({} already runs the image)".format(session.device_id))
+        else:
+            report(port, "PASS" if result["ok"] else "FAIL: {}".format(result["error"]))
+        return result
+
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or len(ports)) as executor:
+        results = list(executor.map(flash, ports))
+    elapsed = time.monotonic() - start
+
+    passed = [result for result in results if result["ok"]]
+    flashed = [result for result in passed if not result["skipped"]]
+    print("{:20s} {:6s} {:>9s} {:>12s}".format("Port", "Result", "Time", "Throughput"), file=out)
+    for result in results:
+        data_time = result["metrics"]["timers"].get("data")
+        print("{:20s} {:6s} {:>7.1f} s {:>12s} {}".format(
+            result["port"], "SKIP" if result["skipped"] else "PASS" if result["ok"] else "FAIL", result["elapsed"],
+            "{:.1f} KB/s".format(length / data_time / 1000) if result["ok"] and data_time else "-",
+            result["error"] or ""), file=out)
+    print("{} ports: {} passed ({} skipped), {} failed, {:.1f} KB flashed in {:.1f} s ({:.1f} KB/s aggregate)".format(
+        len(results), len(passed), len(passed) - len(flashed), len(results) - len(passed), len(flashed) * length / 1000,
+        elapsed, len(flashed) * length / elapsed / 1000 if elapsed else 0.0), file=out)
+    return results
+
+def write_metrics(path, summary):
+    with open(path, "w") as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+if __name__ == "__main__":
+    parse_arg(sys.argv[1:])
+    logging.basicConfig(level = logging.DEBUG if verbose else logging.INFO, format = '%(message)s')
+    try:
+        image = FirmwareImage(zip_file)
+        image.validate()
+    except (UploadError, IOError) as e:
+        upload_fail(str(e))
+    events = open(metrics_log, "a") if metrics_log else None
+    try:
+        if len(com_ports) > 1:
+            results = upload_batch(com_ports, image, jobs, skip_unchanged=skip_unchanged, events=events, adaptive=adaptive)
+            if metrics_file:
+                write_metrics(metrics_file, dict(image=zip_file, results=results))
+            if not all(result["ok"] for result in results):
+                sys.exit(1)
+        else:
+            session = UploadSession(com_ports[0], image, skip_unchanged=skip_unchanged, events=events, adaptive=adaptive)
+            try:
+                session.upload()
+            except UploadError as e:
+                upload_fail(str(e))
+            finally:
+                if metrics_file:
+                    write_metrics(metrics_file, dict(image=zip_file, skipped=session.skipped, **session.metrics.summary()))
+            if not session.skipped:
+                print("Upgrade Complete")
+    finally:
+        if events is not None:
+            events.close()
 #result = subprocess.run([tool_name, '-v', '-v', '-v', 'dfu', 'serial', '--package', zip_file, '-p', com_port, '-b', '115200'])
 #print(result)
@@ -0,0 +1,410 @@
+#!/usr/bin/python3
+
+import sys
+import os
+import io
+import random
+import logging
+import tempfile
+import threading
+import contextlib
+import select
+import time
+from getopt import getopt
+from getopt import GetoptError
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import uploader_ymodem
+from uploader_ymodem import ACK, SOH, STX
+from ymodem_sim import SimulatedDevice, pipe_link, make_link_modem, make_modem, crc_engines
+
+# Failures are reported by the benchmarks themselves, injected faults are expected to log errors
+logging.getLogger('Modem').setLevel(logging.CRITICAL)
+
+BENCHMARKS = ("crc", "prepare", "streaming", "detect", "boot", "port", "matrix", "adaptive")
+
+def usage():
+    print("Usage: %s [-n <BLOCKS>] [-s <SEED>] [-l <LATENCY MS>] [-b <BAUDRATE>] [--only=<BENCHMARKS>]" % sys.argv[0])
+    print("OPTIONS:")
+    print("    -n, number of 1 KiB blocks per benchmark (default 190)")
+    print("    -s, seed for the random payloads and injected faults (default 0)")
+    print("    -l, one-way link latency in milliseconds (default 2)")
+    print("    -b, simulated line rate in baud, 0 for unlimited (default 0)")
+    print("    --only, comma separated subset of: %s" % ", ".join(BENCHMARKS))
+    print("    --help, print information")
+    print("Exits with status 1 when a transfer fails or delivers wrong data.")
+
+def detect(device, reuse=True):
+    '''
+    Run UploadSession.detect_baudrate and enter_boot_mode against device and
+    return the time it took, or None when detection failed. reuse=False reopens the port
+    for every candidate rate.
+    '''
+    session = uploader_ymodem.UploadSession("sim", None)
+    session.open_serial = device.open
+    session.port_session.reuse = reuse
+    start = time.monotonic()
+    try:
+        session.detect_baudrate()
+        session.enter_boot_mode()
+    except uploader_ymodem.UploadError:
+        return None
+    finally:
+        session.port_session.close()
+    return time.monotonic() - start if device.booted else None
+
+def benchmark_detection(rates=(115200, 9600, 1200)):
+    baudrate_cache = uploader_ymodem.baudrate_cache
+    with tempfile.TemporaryDirectory() as cache_dir:
+        uploader_ymodem.baudrate_cache = os.path.join(cache_dir, "baudrate.json")
+        try:
+            print("Baud rate detection against a simulated device (includes the 1 s at+boot wait):")
+            for rate in rates:
+                if os.path.exists(uploader_ymodem.baudrate_cache):
+                    os.remove(uploader_ymodem.baudrate_cache)
+                results = []
+                for label in ("cold cache", "warm cache"):
+                    device = SimulatedDevice(rate)
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        elapsed = detect(device)
+                    results.append("{} {}".format(label, "FAILED" if elapsed is None else
+                        "{:6.3f} s ({} opens)".format(elapsed, device.opens)))
+                print("    {:7d} baud: {}".format(rate, ", ".join(results)))
+        finally:
+            uploader_ymodem.baudrate_cache = baudrate_cache
+
+def benchmark_boot_check():
+    '''
+    UploadSession.check_boot_mode against a simulated device running the
+    application and one in the bootloader, with the latency of every AT
+    step. The character by character probe it replaces slept 4.5 s.
+    '''
+    print("Boot mode check against a simulated device:")
+    for label, in_boot in (("application", False), ("bootloader", True)):
+        device = SimulatedDevice(uploader_ymodem.default_baudrate, in_boot=in_boot)
+        session = uploader_ymodem.UploadSession("sim", None, out=io.StringIO())
+        session.open_serial = device.open
+        start = time.monotonic()
+        result = session.check_boot_mode()
+        elapsed = time.monotonic() - start
+        session.port_session.close()
+        rtt = session.metrics.summary()["histograms"].get("at_response_ms")
+        print("    {:12s} {:6.3f} s, boot mode {}, {} AT step(s){}".format(label, elapsed, "yes" if result else "no",
+            rtt["count"] if rtt else 0, ", mean reply {:.1f} ms".format(rtt["mean"]) if rtt else ""))
+
+def benchmark_port_reuse(rates=(115200, 9600, 1200), open_delay=0.2):
+    '''
+    Cold cache baud rate detection with the port reopened for every
+    candidate rate against one handle switched in place (PortSession).
+    '''
+    baudrate_cache = uploader_ymodem.baudrate_cache
+    with tempfile.TemporaryDirectory() as cache_dir:
+        uploader_ymodem.baudrate_cache = os.path.join(cache_dir, "baudrate.json")
+        try:
+            print("Port reopen vs in-place baud switch, {:.0f} ms per open (includes the 1 s at+boot wait):".format(
+                open_delay * 1000))
+            for rate in rates:
+                results = []
+                for label, reuse in (("reopen", False), ("reuse", True)):
+                    if os.path.exists(uploader_ymodem.baudrate_cache):
+                        os.remove(uploader_ymodem.baudrate_cache)
+                    device = SimulatedDevice(rate, open_delay=open_delay)
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        elapsed = detect(device, reuse)
+                    results.append("{} {}".format(label, "FAILED" if elapsed is None else
+                        "{:6.3f} s ({:2d} opens)".format(elapsed, device.opens)))
+                print("    {:7d} baud: {}".format(rate, ", ".join(results)))
+        finally:
+            uploader_ymodem.baudrate_cache = baudrate_cache
+
+class PtyEnd(object):
+    '''One side of a Linux pty pair, read with select() like a serial port.'''
+    def __init__(self, fd):
+        self.fd = fd
+
+    def read(self, size, timeout=1):
+        data = b""
+        deadline = time.monotonic() + timeout
+        while len(data) < size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                break
+            data += os.read(self.fd, size - len(data))
+        return data or None
+
+    def available(self):
+        import fcntl, termios, struct
+        return struct.unpack("i", fcntl.ioctl(self.fd, termios.FIONREAD, b"\0\0\0\0"))[0]
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+        return len(data)
+
+def pty_link():
+    '''Same as pipe_link for a raw mode pty pair, without latency or faults.'''
+    import tty
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    def close():
+        os.close(master)
+        os.close(slave)
+    return (PtyEnd(master), PtyEnd(master)), (PtyEnd(slave), PtyEnd(slave)), close
+
+def transfer(payload, link, window=1, streaming=0, program="pyam", mode="ymodem1k", crc_mode=1, timeout=10,
+        adaptive=False, recv_timeout=None, prepared=False):
+    '''
+    Send payload from one Modem to another over link (see pipe_link) and
+    return the sender's per-phase timings plus the total wall-clock time,
+    the process CPU time of both ends, the number of blocks and of
+    retransmissions and the sender's metrics summary. Returns None when
+    the transfer failed. recv_timeout defaults to timeout. With prepared the
+    payload is sent from a FirmwareImage instead of a plain stream.
+    '''
+    (sender_rx, sender_tx), (receiver_rx, receiver_tx), close = link
+    sender = make_link_modem(sender_rx, sender_tx, program=program, mode=mode)
+    receiver = make_link_modem(receiver_rx, receiver_tx, program=program, mode=mode)
+    result = {}
+
+    with tempfile.TemporaryDirectory() as save_path:
+        def receive():
+            result["size"] = receiver.recv(None, crc_mode=crc_mode, retry=100, timeout=recv_timeout or timeout, quiet=1,
+                info={"save_path": save_path}, streaming=streaming)
+            # Final null block 0 that closes the batch
+            char = receiver_rx.read(1, recv_timeout or timeout)
+            if char in (SOH, STX):
+                receiver_rx.read((128 if char == SOH else 1024) + 3 + crc_mode, recv_timeout or timeout)
+                receiver_tx.write(ACK)
+        thread = threading.Thread(target=receive, daemon=True)
+        thread.start()
+        info = {"name": "firmware.bin", "length": len(payload), "mtime": 0, "source": "win"}
+        start = time.monotonic()
+        cpu_start = time.process_time()
+        try:
+            stream = uploader_ymodem.FirmwareImage("firmware.bin", payload).open() if prepared else io.BytesIO(payload)
+            ok = sender.send(stream, timeout=timeout, quiet=True, info=info, window=window, adaptive=adaptive)
+            thread.join()
+        finally:
+            close()
+        elapsed = time.monotonic() - start
+        cpu = time.process_time() - cpu_start
+        if not ok or result.get("size") is None:
+            return None
+        with open(os.path.join(save_path, "firmware.bin"), "rb") as f:
+            if f.read() != payload:
+                raise AssertionError("Received file differs from the sent payload")
+    counters = sender.metrics.counters
+    return dict(sender.timings, total=elapsed, cpu=cpu, blocks=counters.get("blocks", 0),
+        retransmissions=counters.get("retransmits", 0), metrics=sender.metrics.summary())
+
+def benchmark_streaming(blocks=190, seed=0, latency=0.002, baudrate=0):
+    rng = random.Random(seed)
+    payload = bytes(rng.getrandbits(8) for _ in range(blocks * 1024 - 100))
+    print("Transfer of {} bytes, {:.1f} ms one-way latency, {}:".format(
+        len(payload), latency * 1000, "{} baud".format(baudrate) if baudrate else "unlimited line rate"))
+    baseline = None
+    for label, window, streaming in (
+            ("stop-and-wait", 1, 0),
+            ("window=4", 4, 0),
+            ("window=16", 16, 0),
+            ("YMODEM-g", 1, 1)):
+        timings = transfer(payload, pipe_link(latency, baudrate), window, streaming)
+        if timings is None:
+            print("    {:14s} FAILED".format(label))
+            continue
+        elapsed = timings["total"]
+        if baseline is None:
+            baseline = elapsed
+        rtt = timings["metrics"]["histograms"].get("block_rtt_ms")
+        print("    {:14s} {:8.3f} s {:10.1f} KB/s {:6.2f}x  (handshake {:.3f} s, data {:.3f} s, EOT {:.3f} s, null {:.3f} s{})".format(
+            label, elapsed, len(payload) / elapsed / 1000, baseline / elapsed,
+            timings["handshake"], timings["data"], timings["eot"], timings["null"],
+            ", block RTT p50 {} ms p99 {} ms".format(rtt["p50"], rtt["p99"]) if rtt else ""))
+
+def benchmark_matrix(blocks=64, seed=0, latency=0.002):
+    '''
+    Stop-and-wait transfers for 128 B and 1 KiB blocks in checksum and CRC
+    mode over a clean pty pair and over Pipes with latency, corruption and
+    dropped bytes. Returns False when any transfer failed.
+    '''
+    rng = random.Random(seed)
+    payload = bytes(rng.getrandbits(8) for _ in range(blocks * 1024 - 100))
+    links = (
+        ("pty", lambda: pty_link()),
+        ("pipe", lambda: pipe_link(latency)),
+        ("pipe+corrupt", lambda: pipe_link(latency, corrupt=2e-5, seed=seed)),
+        ("pipe+drop", lambda: pipe_link(latency, drop=2e-5, seed=seed)),
+    )
+    print("Transfer matrix, {} bytes, {:.1f} ms pipe latency, CPU time covers both ends:".format(len(payload), latency * 1000))
+    print("    {:14s} {:>5s} {:>8s} {:>9s} {:>10s} {:>8s} {:>10s}".format(
+        "link", "block", "check", "blocks/s", "KB/s", "retrans", "CPU ms/MB"))
+    passed = True
+    for name, make_link in links:
+        for mode, block in (("ymodem", 128), ("ymodem1k", 1024)):
+            for crc_mode in (0, 1):
+                # The receiver purges until the line is quiet for 1 s, the sender must wait longer
+                stats = transfer(payload, make_link(), program="rbsb", mode=mode, crc_mode=crc_mode, timeout=2)
+                check = "CRC" if crc_mode else "checksum"
+                if stats is None:
+                    passed = False
+                    print("    {:14s} {:5d} {:>8s} FAILED".format(name, block, check))
+                    continue
+                print("    {:14s} {:5d} {:>8s} {:9.1f} {:10.1f} {:8d} {:10.1f}".format(
+                    name, block, check, stats["blocks"] / stats["data"], len(payload) / stats["total"] / 1000,
+                    stats["retransmissions"], stats["cpu"] * 1000 / (len(payload) / 1e6)))
+    return passed
+
+def benchmark_adaptive(blocks=16, seed=0, latency=0.002, rates=(0.0, 1e-4, 1e-3)):
+    '''
+    Stop-and-wait transfers with the fixed 10 s ACK timeout and 1 KiB
+    blocks against AdaptiveLink, over Pipes that corrupt and drop bytes at
+    the given per-byte rates. The receiver gives up on a block after 1 s,
+    like the bootloader. Returns False when any transfer failed.
+    '''
+    rng = random.Random(seed)
+    payload = bytes(rng.getrandbits(8) for _ in range(blocks * 1024 - 100))
+    print("Fixed vs adaptive stop-and-wait, {} bytes, {:.1f} ms pipe latency:".format(len(payload), latency * 1000))
+    print("    {:>10s} {:>9s} {:>10s} {:>8s} {:>8s} {:>8s} {:>8s}".format(
+        "error rate", "mode", "time", "KB/s", "retrans", "timeouts", "128 B"))
+    passed = True
+    for rate in rates:
+        for label, adaptive in (("fixed", False), ("adaptive", True)):
+            stats = transfer(payload, pipe_link(latency, corrupt=rate, drop=rate, seed=seed), adaptive=adaptive,
+                recv_timeout=1)
+            if stats is None:
+                passed = False
+                print("    {:10.0e} {:>9s} FAILED".format(rate, label))
+                continue
+            counters = stats["metrics"]["counters"]
+            print("    {:10.0e} {:>9s} {:8.2f} s {:8.1f} {:8d} {:8d} {:>8s}".format(
+                rate, label, stats["total"], len(payload) / stats["total"] / 1000, stats["retransmissions"],
+                counters.get("timeouts", 0), "yes" if counters.get("downshifts") else "no"))
+    return passed
+
+def benchmark_crc(blocks=190, seed=0):
+    rng = random.Random(seed)
+    payloads = [bytes(rng.getrandbits(8) for _ in range(1024)) for _ in range(blocks)]
+    print("CRC-16/XMODEM over {} x 1 KiB blocks:".format(blocks))
+    for engine in crc_engines():
+        modem = make_modem(crc_engine=engine)
+        start = time.perf_counter()
+        for data in payloads:
+            modem.calc_crc(data)
+        elapsed = time.perf_counter() - start
+        print("    {:8s} {:10.3f} ms {:10.2f} MB/s".format(
+            engine, elapsed * 1000, blocks * 1024 / elapsed / 1e6))
+
+def check_prepared_frames(blocks=64, seed=0):
+    '''
+    Equivalence check: frames taken from a FirmwareImage must equal the ones
+    Modem builds from a stream, also when a resume or block size change
+    leaves the stream off a frame boundary or the sequence renumbered.
+    '''
+    rng = random.Random(seed)
+    payload = bytes(rng.getrandbits(8) for _ in range(blocks * 1024 - 300))
+    image = uploader_ymodem.FirmwareImage("firmware.bin", payload)
+    modem = make_modem()
+    for packet_size, crc_mode, offset, sequence in ((1024, 1, 0, 1), (128, 1, 0, 1), (128, 0, 0, 1),
+            (1024, 1, 1152, 3), (1024, 1, 2048, 7), (128, 1, 128 * 300, 45)):
+        stream, prepared = io.BytesIO(payload), image.open()
+        stream.seek(offset)
+        prepared.seek(offset)
+        while True:
+            # Copied, building the prepared frames reuses the modem's frame buffer
+            expected = modem._fill_frame(packet_size, sequence, crc_mode, stream=stream)
+            expected = bytes(expected) if expected is not None else None
+            frame = modem._next_frame(prepared, packet_size, sequence, crc_mode)
+            if expected is None or frame is None:
+                if expected is not None or frame is not None:
+                    raise AssertionError("Prepared frames end early or late ({} byte blocks from {})".format(packet_size, offset))
+                break
+            if bytes(frame) != expected:
+                raise AssertionError("Prepared frame seq {} differs ({} byte blocks from {})".format(sequence, packet_size, offset))
+            sequence = (sequence + 1) % 0x100
+    print("Prepared frames match the stream framing for {} KiB".format(len(payload) // 1024))
+
+def benchmark_prepare(blocks=190, seed=0, sessions=4):
+    '''
+    Framing cost of sessions sessions sending the same image: every session
+    reading and framing it again, against building the frames once in a
+    FirmwareImage and handing them out.
+    '''
+    rng = random.Random(seed)
+    payload = bytes(rng.getrandbits(8) for _ in range(blocks * 1024))
+    print("Framing {} x 1 KiB blocks for {} sessions:".format(blocks, sessions))
+    print("    {:8s} {:>12s} {:>12s} {:>12s}".format("engine", "stream", "prepare", "prepared"))
+    for engine in crc_engines():
+        modem = make_modem(crc_engine=engine)
+        start = time.perf_counter()
+        for _ in range(sessions):
+            stream = io.BytesIO(payload)
+            sequence = 1
+            while modem._fill_frame(1024, sequence, 1, stream=stream) is not None:
+                sequence = (sequence + 1) % 0x100
+        streamed = time.perf_counter() - start
+        start = time.perf_counter()
+        image = uploader_ymodem.FirmwareImage("firmware.bin", payload)
+        image.frames(modem, 1024, 1)
+        prepare = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(sessions):
+            stream = image.open()
+            sequence = 1
+            while modem._next_frame(stream, 1024, sequence, 1) is not None:
+                sequence = (sequence + 1) % 0x100
+        prepared = time.perf_counter() - start
+        print("    {:8s} {:9.2f} ms {:9.2f} ms {:9.2f} ms".format(engine, streamed * 1000, prepare * 1000, prepared * 1000))
+    stats = transfer(payload[:min(blocks, 32) * 1024], pipe_link(), prepared=True)
+    if stats is None:
+        raise AssertionError("Transfer of a prepared image failed")
+    print("    prepared image over a pipe: {:.2f} s, {:.1f} KB/s".format(stats["total"], min(blocks, 32) * 1024 / stats["total"] / 1000))
+
+def main(argv):
+    blocks = 190
+    seed = 0
+    latency = 0.002
+    baudrate = 0
+    only = BENCHMARKS
+    try:
+        opts, args = getopt(argv, "n:s:l:b:", ["help", "only="])
+    except GetoptError:
+        usage()
+        sys.exit(1)
+    for opt, arg in opts:
+        if opt == "--help":
+            usage()
+            sys.exit()
+        elif opt == "-n":
+            blocks = int(arg)
+        elif opt == "-s":
+            seed = int(arg)
+        elif opt == "-l":
+            latency = float(arg) / 1000
+        elif opt == "-b":
+            baudrate = int(arg)
+        elif opt == "--only":
+            only = arg.split(",")
+    passed = True
+    if "crc" in only:
+        benchmark_crc(blocks, seed)
+    if "prepare" in only:
+        check_prepared_frames(seed=seed)
+        benchmark_prepare(blocks, seed)
+    if "streaming" in only:
+        benchmark_streaming(blocks, seed, latency, baudrate)
+    if "detect" in only:
+        benchmark_detection()
+    if "boot" in only:
+        benchmark_boot_check()
+    if "port" in only:
+        benchmark_port_reuse()
+    if "matrix" in only:
+        passed = benchmark_matrix(min(blocks, 64), seed, latency) and passed
+    if "adaptive" in only:
+        passed = benchmark_adaptive(min(blocks, 16), seed, latency) and passed
+    if not passed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
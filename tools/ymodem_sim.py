@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+
+'''
+In-process stand-ins for the serial link and the device, shared by
+ymodem_benchmark.py and test_uploader_ymodem.py.
+'''
+
+import sys
+import os
+import random
+import threading
+import collections
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import uploader_ymodem
+from uploader_ymodem import Modem, RWBuilder
+
+class Pipe(object):
+    '''
+    One direction of an in-process serial link. Written bytes become readable
+    after the one-way latency plus the time they need on the wire at baudrate
+    (10 bits per byte, 0 for unlimited).
+    '''
+    def __init__(self, latency=0.0, baudrate=0, corrupt=0.0, drop=0.0, seed=0):
+        self.latency = latency
+        self.baudrate = baudrate
+        self.corrupt = corrupt
+        self.drop = drop
+        self.rng = random.Random(seed)
+        self.cond = threading.Condition()
+        self.chunks = collections.deque()
+        self.buffer = bytearray()
+        self.line_free = 0.0
+
+    def _inject(self, data):
+        # corrupt and drop are per-byte probabilities, at most one fault of each kind per write
+        if self.corrupt and self.rng.random() < 1 - (1 - self.corrupt) ** len(data):
+            data = bytearray(data)
+            data[self.rng.randrange(len(data))] ^= 1 << self.rng.randrange(8)
+        if self.drop and self.rng.random() < 1 - (1 - self.drop) ** len(data):
+            data = bytearray(data)
+            del data[self.rng.randrange(len(data))]
+        return data
+
+    def write(self, data):
+        length = len(data)
+        if self.corrupt or self.drop:
+            data = self._inject(data)
+        with self.cond:
+            now = time.monotonic()
+            if self.baudrate:
+                self.line_free = max(self.line_free, now) + len(data) * 10 / self.baudrate
+                arrival = self.line_free + self.latency
+            else:
+                arrival = now + self.latency
+            self.chunks.append((arrival, bytes(data)))
+            self.cond.notify_all()
+        return length
+
+    def _arrive(self, now):
+        while self.chunks and self.chunks[0][0] <= now:
+            self.buffer += self.chunks.popleft()[1]
+
+    def available(self):
+        with self.cond:
+            self._arrive(time.monotonic())
+            return len(self.buffer)
+
+    def clear(self):
+        with self.cond:
+            self.chunks.clear()
+            del self.buffer[:]
+
+    def read(self, size, timeout=1):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self._arrive(now)
+                if len(self.buffer) >= size or now >= deadline:
+                    break
+                wake = deadline
+                if self.chunks:
+                    wake = min(wake, self.chunks[0][0])
+                self.cond.wait(wake - now)
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return data or None
+
+class SimulatedDevice(object):
+    '''
+    AT console of a device listening at a fixed baud rate. Ports opened at
+    any other rate only see line noise. Plugs into UploadSession.open_serial.
+    Every open takes open_delay seconds, like slow USB-UART drivers. With
+    in_boot the bootloader answers instead of the application. The
+    application answers AT+SN=? with sn when given.
+    '''
+    def __init__(self, baudrate, latency=0.005, open_delay=0.0, in_boot=False, sn=None):
+        self.baudrate = baudrate
+        self.latency = latency
+        self.open_delay = open_delay
+        self.in_boot = in_boot
+        self.sn = sn
+        self.opens = 0
+        self.booted = False
+
+    def open(self, baudrate, timeout=5):
+        self.opens += 1
+        time.sleep(self.open_delay)
+        return SimulatedSerial(self, baudrate, timeout)
+
+class SimulatedSerial(object):
+    def __init__(self, device, baudrate, timeout):
+        self.device = device
+        self.rx = Pipe(device.latency, baudrate)
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.is_open = True
+        self.line = b""
+
+    @property
+    def baudrate(self):
+        return self._baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate):
+        self._baudrate = baudrate
+        self.rx.baudrate = baudrate
+
+    @property
+    def in_waiting(self):
+        return self.rx.available()
+
+    def read(self, size=1):
+        return self.rx.read(size, self.timeout or 0) or b""
+
+    def write(self, data):
+        if self.baudrate != self.device.baudrate:
+            self.rx.write(bytes((0xff - b) & 0xfe for b in data[:2]))
+            return len(data)
+        for char in data:
+            if char == ord("\n"):
+                command = self.line.strip().lower()
+                self.line = b""
+                if self.device.in_boot:
+                    if command:
+                        self.rx.write(b"AT not support\r\n")
+                elif command == b"at":
+                    self.rx.write(b"OK\r\n")
+                elif command == b"at+boot":
+                    self.device.booted = True
+                elif command == b"at+sn=?" and self.device.sn is not None:
+                    self.rx.write(b"AT+SN=" + self.device.sn + b"\r\nOK\r\n")
+                elif command:
+                    self.rx.write(b"AT_ERROR\r\n")
+            else:
+                self.line += bytes((char,))
+        return len(data)
+
+    def reset_input_buffer(self):
+        self.rx.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+def pipe_link(latency=0.0, baudrate=0, corrupt=0.0, drop=0.0, seed=0):
+    '''
+    Returns ((sender rx, sender tx), (receiver rx, receiver tx), close) for
+    a pair of in-process Pipes, faults are injected in both directions.
+    '''
+    to_receiver = Pipe(latency, baudrate, corrupt, drop, seed)
+    to_sender = Pipe(latency, baudrate, corrupt, drop, seed + 1)
+    return (to_sender, to_receiver), (to_receiver, to_sender), lambda: None
+
+def make_link_modem(rx, tx, **kwargs):
+    def getc(size, timeout=1):
+        return rx.read(size, timeout)
+    def putc(data, timeout=1):
+        return tx.write(data)
+    reader = RWBuilder(getc)
+    # Lets the receiver pull everything already waiting in one read
+    reader.available = rx.available
+    return Modem(reader, putc, **kwargs)
+
+def make_modem(**kwargs):
+    def getc(size, timeout=1):
+        return None
+    def putc(data, timeout=1):
+        return len(data)
+    return Modem(getc, putc, **kwargs)
+
+def crc_engines():
+    engines = ["sliced", "table"]
+    if uploader_ymodem.crc_hqx is not None:
+        engines.insert(0, "native")
+    return engines